@@ -1,35 +1,215 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, g
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, g, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import os
-from datetime import datetime, timedelta
-from io import BytesIO
+import time
+from datetime import datetime, timedelta, timezone
+from io import StringIO
 from openpyxl import Workbook
 from math import ceil
 import json
 import psycopg2
 import uuid
+import tempfile
+import csv
+import zlib
 from psycopg2.extras import DictCursor
+from psycopg2.pool import PoolError
+from db import ConnectionPool, QueryStats, ReadReplica, SHOP_TIMEZONE, query_stats, run_transaction
+from cache import DASHBOARD_CACHE_STAMP, Generation, LRUCache, TTLCache
+from jobs import JobQueue
+from journal import CheckoutJournal, JournalRejected, JournalUnavailable
+from metrics import Metrics
+from pagination import count_rows, fetch_merged_page, fetch_page
+from partitions import ensure_partitions
+from search import match_clause, ranked_page, trigram_enabled
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'a-strong-default-key-for-development-only')
 app.permanent_session_lifetime = timedelta(days=7)
 
 # --- Centralized Database Connection ---
+# One pool per gunicorn worker; size it with DB_POOL_MIN / DB_POOL_MAX.
+db_pool = ConnectionPool(
+    os.environ.get('DATABASE_URL'),
+    minconn=int(os.environ.get('DB_POOL_MIN', 1)),
+    maxconn=int(os.environ.get('DB_POOL_MAX', 10)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    ping_after=float(os.environ.get('DB_POOL_PING_AFTER', 30)),
+)
+
+# --- Read Replica ---
+# Routes marked @replica_reads (the reports, which never write) read from
+# DATABASE_REPLICA_URL, a streaming replica of DATABASE_URL, while it is at
+# most REPLICA_MAX_LAG seconds behind. After a user writes anything, their
+# reads stay on the primary until the replica has replayed that write. When
+# the replica cannot be reached, reads go to the primary and it is tried
+# again after REPLICA_RETRY_AFTER seconds. To try it locally, clone the
+# primary with `pg_basebackup -R -D <dir>`, start that copy on another port
+# and point DATABASE_REPLICA_URL at it.
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+read_replica = ReadReplica(
+    ConnectionPool(
+        DATABASE_REPLICA_URL,
+        minconn=int(os.environ.get('DB_REPLICA_POOL_MIN', 1)),
+        maxconn=int(os.environ.get('DB_REPLICA_POOL_MAX', 10)),
+        timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        ping_after=float(os.environ.get('DB_POOL_PING_AFTER', 30)),
+        connect_timeout=int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2)),
+    ),
+    max_lag=float(os.environ.get('REPLICA_MAX_LAG', 5)),
+    retry_after=float(os.environ.get('REPLICA_RETRY_AFTER', 30)),
+) if DATABASE_REPLICA_URL else None
+
+def replica_reads(f):
+    """Lets the route read from the replica; it must not write."""
+    f.replica_reads = True
+    return f
+
+def _connect_for_request():
+    """Returns ``(pool, conn)``: the replica for @replica_reads routes if it will do, else the primary."""
+    if read_replica is not None and getattr(app.view_functions.get(request.endpoint), 'replica_reads', False):
+        conn, route = read_replica.getconn(session.get('replica_min_lsn'))
+        metrics.inc('pos_db_replica_routing_total', {'endpoint': request.endpoint, 'route': route})
+        if conn is not None:
+            session.pop('replica_min_lsn', None)
+            return read_replica, conn
+    return db_pool, db_pool.getconn()
+
 def get_db():
     if 'db' not in g:
-        db_url = os.environ.get('DATABASE_URL')
-        g.db = psycopg2.connect(db_url)
-        # --- NEW: Set the timezone for the entire session ---
-        with g.db.cursor() as cursor:
-            cursor.execute("SET TIMEZONE='Asia/Kolkata'")
+        g.db_pool, g.db = _connect_for_request()
     return g.db
 
+@app.after_request
+def remember_write_position(response):
+    # Anything but a GET may have written; the replica must replay up to
+    # here before this user reads from it again.
+    if read_replica is not None and request.method not in ('GET', 'HEAD') and g.get('db_pool') is db_pool:
+        try:
+            cursor = g.db.cursor()
+            cursor.execute("SELECT pg_current_wal_lsn()::text")
+            session['replica_min_lsn'] = cursor.fetchone()[0]
+            g.db.rollback()
+        except psycopg2.Error:
+            g.db.rollback()
+    return response
+
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        g.pop('db_pool').putconn(db)
+
+# --- Request Instrumentation ---
+# Every response carries a Server-Timing header with the time spent in SQL and
+# in the whole request (visible in the browser's network panel). Statements
+# slower than SLOW_QUERY_MS are logged with the route that ran them; set it
+# to 0 to log everything or leave it empty to turn the log off.
+# QUERY_COUNT_HEADER=1 also adds X-Query-Count (used by benchmark.py). For
+# streamed responses the numbers only cover work done before the body starts.
+QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER') == '1'
+SLOW_QUERY_MS = os.environ.get('SLOW_QUERY_MS', '200')
+# Set on the class: query_stats is thread-local, and the request and job
+# worker threads would otherwise never see it.
+QueryStats.slow_threshold = float(SLOW_QUERY_MS) / 1000 if SLOW_QUERY_MS else None
+
+# --- Metrics ---
+# Served at /metrics in the Prometheus text format. Each gunicorn worker
+# writes its numbers to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds and
+# a scrape merges all of them. Scrapers authenticate with
+# "Authorization: Bearer $METRICS_TOKEN"; without a token only admins can read it.
+metrics = Metrics(
+    os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pos-metrics')),
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)),
+)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+metrics.counter('pos_http_requests_total', 'HTTP requests by endpoint, method and status.')
+metrics.histogram('pos_http_request_duration_seconds', 'Request latency by endpoint.')
+metrics.counter('pos_db_queries_total', 'SQL statements executed, by endpoint.')
+metrics.counter('pos_db_query_seconds_total', 'Time spent in SQL statements, by endpoint.')
+metrics.counter('pos_checkout_invoices_total', 'Invoices created by checkout.')
+metrics.counter('pos_checkout_lines_total', 'Invoice lines created by checkout.')
+metrics.counter('pos_checkout_revenue_total', 'Invoice totals (incl. tax) created by checkout.')
+metrics.counter('pos_checkout_stock_rejections_total', 'Checkouts cancelled because a product was out of stock.')
+metrics.counter('pos_checkout_duplicates_total', 'Resubmitted checkouts answered with the invoice already created.')
+metrics.gauge('pos_checkout_journal_pending', 'Write-behind checkouts waiting for the database.')
+metrics.gauge('pos_checkout_journal_oldest_seconds', 'Age of the oldest write-behind checkout still waiting.')
+metrics.gauge('pos_jobs_queued', 'Background jobs waiting in job_queue.')
+metrics.gauge('pos_jobs_oldest_seconds', 'Age of the oldest queued background job.')
+metrics.gauge('pos_jobs_dead_letters', 'Background jobs that gave up, in job_dead_letters.')
+metrics.counter('pos_jobs_processed_total', 'Background jobs completed, by kind.')
+metrics.counter('pos_jobs_retries_total', 'Background job failures that will be retried, by kind.')
+metrics.counter('pos_jobs_dead_lettered_total', 'Background jobs moved to job_dead_letters, by kind.')
+metrics.counter('pos_db_replica_routing_total', 'Connections for @replica_reads routes: replica, or why the primary was used.')
+metrics.counter('pos_db_transaction_retries_total', 'Transactions retried after a deadlock or serialization failure.')
+metrics.histogram('pos_checkout_lines_per_invoice', 'Distinct products per checkout.', buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+metrics.gauge('pos_db_pool_connections', 'Pooled database connections by state, per worker.')
+metrics.gauge('pos_db_pool_max_connections', 'Configured pool size, per worker.')
+metrics.counter('pos_db_pool_checkouts_total', 'Connections handed out by the pool.')
+metrics.counter('pos_db_pool_waits_total', 'Checkouts that had to wait for a free connection.')
+metrics.counter('pos_db_pool_wait_seconds_total', 'Time spent waiting for a free connection.')
+metrics.counter('pos_db_pool_timeouts_total', 'Checkouts that gave up waiting.')
+metrics.counter('pos_cache_hits_total', 'Cache hits by cache.')
+metrics.counter('pos_cache_misses_total', 'Cache misses by cache.')
+metrics.counter('pos_cache_evictions_total', 'Entries evicted to stay within the size limits.')
+metrics.gauge('pos_cache_entries', 'Entries currently cached, per worker.')
+
+def _collect_pool_and_caches():
+    pool = db_pool.stats()
+    yield 'pos_db_pool_connections', {'state': 'in_use'}, pool['in_use']
+    yield 'pos_db_pool_connections', {'state': 'idle'}, pool['idle']
+    yield 'pos_db_pool_max_connections', {}, pool['max_size']
+    yield 'pos_db_pool_checkouts_total', {}, pool['checkouts']
+    yield 'pos_db_pool_waits_total', {}, pool['waits']
+    yield 'pos_db_pool_wait_seconds_total', {}, pool['wait_time']
+    yield 'pos_db_pool_timeouts_total', {}, pool['timeouts']
+    for name, cache in (('dashboard', dashboard_cache), ('receipt', receipt_cache)):
+        stats = cache.stats()
+        yield 'pos_cache_hits_total', {'cache': name}, stats['hits']
+        yield 'pos_cache_misses_total', {'cache': name}, stats['misses']
+        yield 'pos_cache_evictions_total', {'cache': name}, stats.get('evictions', 0)
+        yield 'pos_cache_entries', {'cache': name}, stats['entries']
+    jobs = job_queue.stats()
+    yield 'pos_jobs_queued', {}, jobs['queued']
+    yield 'pos_jobs_oldest_seconds', {}, jobs['oldest_age']
+    yield 'pos_jobs_dead_letters', {}, jobs['dead_letters']
+    for counter, name in (('processed', 'pos_jobs_processed_total'), ('retried', 'pos_jobs_retries_total'),
+                          ('dead_lettered', 'pos_jobs_dead_lettered_total')):
+        for kind, value in jobs[counter].items():
+            yield name, {'kind': kind}, value
+    if CHECKOUT_WRITE_BEHIND:
+        journal = checkout_journal.stats()
+        yield 'pos_checkout_journal_pending', {}, journal['pending']
+        yield 'pos_checkout_journal_oldest_seconds', {}, journal['oldest_pending_age']
+
+metrics.register_collector(_collect_pool_and_caches)
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    query_stats.reset(label=request.endpoint)
+
+@app.after_request
+def add_timing_headers(response):
+    total = time.perf_counter() - g.get('request_started', time.perf_counter())
+    response.headers['Server-Timing'] = (
+        f'db;dur={query_stats.duration * 1000:.1f};desc="{query_stats.count} queries", '
+        f'total;dur={total * 1000:.1f}'
+    )
+    if QUERY_COUNT_HEADER:
+        response.headers['X-Query-Count'] = str(query_stats.count)
+
+    # Unmatched URLs share one label so stray paths cannot blow up the series count.
+    endpoint = request.endpoint or 'unmatched'
+    metrics.inc('pos_http_requests_total', {'endpoint': endpoint, 'method': request.method, 'status': str(response.status_code)})
+    metrics.observe('pos_http_request_duration_seconds', total, {'endpoint': endpoint})
+    if query_stats.count:
+        metrics.inc('pos_db_queries_total', {'endpoint': endpoint}, query_stats.count)
+        metrics.inc('pos_db_query_seconds_total', {'endpoint': endpoint}, query_stats.duration)
+    metrics.maybe_flush()
+    return response
 
 # --- Decorators ---
 def admin_required(f):
@@ -104,99 +284,138 @@ def logout():
     return redirect(url_for('login'))
 
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    if session.pop('_just_logged_in', None):
-        flash('Login successful!', 'success')
-
-    db = get_db()
-    c = db.cursor(cursor_factory=DictCursor)
-    
-    # AFTER (The new, more reliable code)
-    c.execute("SELECT SUM(total_amount) AS total FROM invoices WHERE created_on::date = CURRENT_DATE")
-    total_revenue_today = c.fetchone()['total'] or 0
-    
-    c.execute("SELECT COUNT(id) AS count FROM invoices WHERE created_on::date = CURRENT_DATE")
-    total_invoices_today = c.fetchone()['count'] or 0
-
-    c.execute("SELECT SUM(ii.quantity) AS total FROM invoice_items ii JOIN invoices i ON ii.invoice_id = i.id WHERE i.created_on::date = CURRENT_DATE")
-    total_items_today = c.fetchone()['total'] or 0
+# --- Dashboard Widgets ---
+# Each loader returns the template variables for one widget. dashboard() serves
+# them through dashboard_cache, so a fully cached page never touches the
+# database. Writes that change these figures call dashboard_cache.invalidate().
+def _widget_today(c):
+    # Today's cards come from the rollups kept by checkout()
+    c.execute("SELECT total_revenue, invoice_count, items_sold FROM daily_sales WHERE sale_date = CURRENT_DATE")
+    today = c.fetchone()
 
     c.execute("""
-        SELECT p.name FROM invoice_items ii
-        JOIN products p ON ii.product_id = p.id JOIN invoices i ON ii.invoice_id = i.id
-        WHERE i.created_on::date = CURRENT_DATE
-        GROUP BY p.name ORDER BY SUM(ii.quantity) DESC LIMIT 1
+        SELECT p.name FROM daily_product_sales d
+        JOIN products p ON d.product_id = p.id
+        WHERE d.sale_date = CURRENT_DATE
+        GROUP BY p.name ORDER BY SUM(d.quantity) DESC LIMIT 1
     """)
     top_product_result = c.fetchone()
-    top_product_today = top_product_result['name'] if top_product_result else "N/A"
 
-   # --- NEW, TIMEZONE-CORRECT CHART QUERY ---
+    return dict(total_revenue_today=today['total_revenue'] if today else 0,
+                total_invoices_today=today['invoice_count'] if today else 0,
+                total_items_today=today['items_sold'] if today else 0,
+                top_product_today=top_product_result['name'] if top_product_result else "N/A")
+
+def _widget_sales_trend(c):
     c.execute("""
         SELECT
             TO_CHAR(day_series.day, 'YYYY-MM-DD') AS sale_date,
-            COALESCE(SUM(i.total_amount), 0) AS total
+            COALESCE(d.total_revenue, 0) AS total
         FROM
             (SELECT GENERATE_SERIES(CURRENT_DATE - INTERVAL '6 days', CURRENT_DATE, INTERVAL '1 day')::date AS day) AS day_series
         LEFT JOIN
-            invoices i ON i.created_on::date = day_series.day
-        GROUP BY
-            day_series.day
+            daily_sales d ON d.sale_date = day_series.day
         ORDER BY
             day_series.day;
     """)
     chart_data = c.fetchall()
-    last_7_days = [row['sale_date'] for row in chart_data]
-    daily_totals = [float(row['total']) for row in chart_data]
+    return dict(last_7_days=[row['sale_date'] for row in chart_data],
+                daily_totals=[float(row['total']) for row in chart_data])
+
+# All-time figures come from daily_product_sales, which keeps the days of
+# months that archive.py has moved out of invoice_items.
+def _widget_top_products(c):
     c.execute("""
-        SELECT p.name, SUM(ii.line_total) as total_revenue FROM invoice_items ii
-        JOIN products p ON ii.product_id = p.id
+        SELECT p.name, SUM(d.revenue) as total_revenue FROM daily_product_sales d
+        JOIN products p ON d.product_id = p.id
         GROUP BY p.name ORDER BY total_revenue DESC LIMIT 5
     """)
     top_products_data = c.fetchall()
-    top_products_labels = [row['name'] for row in top_products_data]
-    top_products_values = [float(row['total_revenue']) for row in top_products_data]
+    return dict(top_products_labels=json.dumps([row['name'] for row in top_products_data]),
+                top_products_values=json.dumps([float(row['total_revenue']) for row in top_products_data]))
 
+def _widget_category_sales(c):
     c.execute("""
-        SELECT p.category, SUM(ii.line_total) as total_revenue FROM invoice_items ii
-        JOIN products p ON ii.product_id = p.id
+        SELECT p.category, SUM(d.revenue) as total_revenue FROM daily_product_sales d
+        JOIN products p ON d.product_id = p.id
         GROUP BY p.category ORDER BY total_revenue DESC
     """)
     category_sales_data = c.fetchall()
-    category_labels = [row['category'] for row in category_sales_data if row['category']]
-    category_values = [float(row['total_revenue']) for row in category_sales_data if row['category']]
+    return dict(category_labels=json.dumps([row['category'] for row in category_sales_data if row['category']]),
+                category_values=json.dumps([float(row['total_revenue']) for row in category_sales_data if row['category']]))
+
+# Products at or below their own reorder level. Every low-stock query uses
+# this predicate and orders by shortfall so it is served by the partial
+# index idx_products_low_stock (see migrate_db.py).
+LOW_STOCK_WHERE = "stock <= reorder_level"
 
-    c.execute("SELECT name, stock FROM products ORDER BY stock ASC LIMIT 5")
+def _widget_low_stock(c):
+    c.execute("SELECT name, stock, reorder_level FROM products WHERE " + LOW_STOCK_WHERE +
+              " ORDER BY reorder_level - stock DESC, id DESC LIMIT 5")
     low_stock_items = c.fetchall()
+    c.execute("SELECT COUNT(*) FROM products WHERE " + LOW_STOCK_WHERE)
+    return dict(low_stock_items=low_stock_items, low_stock_count=c.fetchone()[0])
 
-    c.execute("SELECT customer_name, total_amount FROM invoices ORDER BY id DESC LIMIT 5")
-    recent_transactions = c.fetchall()
+def _widget_recent_transactions(c):
+    # In created_on order the newest partition is read first and usually suffices.
+    c.execute("SELECT customer_name, total_amount FROM invoices ORDER BY created_on DESC, id DESC LIMIT 5")
+    return dict(recent_transactions=c.fetchall())
 
+def _widget_top_customers(c):
     c.execute("""
-        SELECT customer_name, SUM(total_amount) as total_spent 
-        FROM invoices 
-        WHERE customer_name IS NOT NULL AND customer_name != '' 
-        GROUP BY customer_name 
-        ORDER BY total_spent DESC 
+        SELECT display_name AS customer_name, lifetime_spend AS total_spent
+        FROM customers
+        ORDER BY lifetime_spend DESC, id DESC
         LIMIT 5
     """)
-    most_valuable_customers = c.fetchall()
-
-    return render_template('dashboard.html',
-                           total_revenue_today=total_revenue_today,
-                           total_items_today=total_items_today,
-                           total_invoices_today=total_invoices_today,
-                           top_product_today=top_product_today,
-                           last_7_days=last_7_days,
-                           daily_totals=daily_totals,
-                           top_products_labels=json.dumps(top_products_labels),
-                           top_products_values=json.dumps(top_products_values),
-                           category_labels=json.dumps(category_labels),
-                           category_values=json.dumps(category_values),
-                           low_stock_items=low_stock_items,
-                           recent_transactions=recent_transactions,
-                           most_valuable_customers=most_valuable_customers)
+    return dict(most_valuable_customers=c.fetchall())
+
+DASHBOARD_WIDGETS = {
+    'today': _widget_today,
+    'sales_trend': _widget_sales_trend,
+    'top_products': _widget_top_products,
+    'category_sales': _widget_category_sales,
+    'low_stock': _widget_low_stock,
+    'recent_transactions': _widget_recent_transactions,
+    'top_customers': _widget_top_customers,
+}
+
+# Seconds each widget may be served from cache; override with e.g.
+# DASHBOARD_CACHE_TTL_TOP_PRODUCTS=900. The short TTLs only matter at midnight;
+# every write that changes a widget invalidates the cache immediately.
+DASHBOARD_CACHE_TTLS = {
+    'today': 60,
+    'sales_trend': 60,
+    'top_products': 600,
+    'category_sales': 600,
+    'low_stock': 300,
+    'recent_transactions': 300,
+    'top_customers': 600,
+}
+
+dashboard_cache = TTLCache(
+    {name: int(os.environ.get(f'DASHBOARD_CACHE_TTL_{name.upper()}', ttl)) for name, ttl in DASHBOARD_CACHE_TTLS.items()},
+    generation=Generation(DASHBOARD_CACHE_STAMP),
+)
+# Widgets read from the replica can miss up to REPLICA_MAX_LAG seconds of
+# checkouts, so they are cached no longer than that: a checkout's
+# invalidation refilled from the replica is not served stale for a full TTL.
+DASHBOARD_CACHE_TTL_REPLICA = float(os.environ.get('DASHBOARD_CACHE_TTL_REPLICA', read_replica.max_lag if read_replica else 0))
+
+@app.route('/dashboard')
+@login_required
+@replica_reads
+def dashboard():
+    if session.pop('_just_logged_in', None):
+        flash('Login successful!', 'success')
+
+    context = {}
+    for name, loader in DASHBOARD_WIDGETS.items():
+        context.update(dashboard_cache.get_or_load(
+            name, lambda loader=loader: loader(get_db().cursor(cursor_factory=DictCursor)),
+            max_ttl=lambda: DASHBOARD_CACHE_TTL_REPLICA if g.get('db_pool') is read_replica else None))
+
+    return render_template('dashboard.html', **context)
 
 # --- Admin Routes ---
 @app.route('/view_users')
@@ -280,6 +499,26 @@ def delete_user(user_id):
     flash(f'User {target_username} deleted successfully.', 'success')
     return redirect(url_for('view_users'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif session.get('role') != 'admin':
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/system_stats')
+@admin_required
+def system_stats():
+    stats = dict(db_pool=db_pool.stats(), dashboard_cache=dashboard_cache.stats(), receipt_cache=receipt_cache.stats(),
+                 jobs=job_queue.stats())
+    if CHECKOUT_WRITE_BEHIND:
+        stats['checkout_journal'] = checkout_journal.stats()
+    if read_replica is not None:
+        stats['read_replica'] = read_replica.stats()
+    return jsonify(stats)
+
 # --- Inventory Routes ---
 @app.route('/inventory', defaults={'page': 1})
 @app.route('/inventory/page/<int:page>')
@@ -287,27 +526,49 @@ def delete_user(user_id):
 def inventory(page):
     cursor = get_db().cursor(cursor_factory=DictCursor)
     search_query = request.args.get('search', '')
-    count_query = "SELECT COUNT(*) AS count FROM products"
-    select_query = "SELECT id, name, category, price, stock, to_char(created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on FROM products"
-    params = []
+    where_clauses, params = [], []
     if search_query:
-        search_term = f"%{search_query}%"
-        count_query += " WHERE name ILIKE%s"
-        select_query += " WHERE name ILIKE%s"
-        params.append(search_term)
+        match_sql, match_params = match_clause(['name'], search_query)
+        where_clauses.append(match_sql)
+        params.extend(match_params)
 
     per_page = 10
-    offset = (page - 1) * per_page
-    cursor.execute(count_query, params)
-    total_products = cursor.fetchone()['count']
+    total_products, count_is_exact = count_rows(cursor, "FROM products", where_clauses, params, exact=request.args.get('exact') == '1')
     total_pages = ceil(total_products / per_page) if total_products > 0 else 0
+
+    select_sql = "SELECT id, name, category, price, stock, to_char(created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on FROM products"
+    page_args = dict(after=request.args.get('after'), before=request.args.get('before'), per_page=per_page)
+    if search_query and trigram_enabled(cursor):
+        listing = ranked_page(cursor, select_sql, where_clauses, params, ['name'], search_query, **page_args)
+    else:
+        listing = fetch_page(cursor, select_sql, where_clauses, params, ['id'], lambda row: [row['id']], **page_args)
     
-    select_query += " ORDER BY id DESC LIMIT %s OFFSET %s"
-    params.extend([per_page, offset])
-    cursor.execute(select_query, params)
-    products = cursor.fetchall()
-    
-    return render_template('inventory.html', products=products, page=page, total_pages=total_pages, search_query=search_query)
+    return render_template('inventory.html', products=listing.rows, page=page, total_pages=total_pages, count_is_exact=count_is_exact,
+                           next_cursor=listing.next_cursor, prev_cursor=listing.prev_cursor, search_query=search_query)
+
+@app.route('/low_stock', defaults={'page': 1})
+@app.route('/low_stock/page/<int:page>')
+@admin_required
+def low_stock(page):
+    cursor = get_db().cursor(cursor_factory=DictCursor)
+    per_page = 10
+    # Counting reads only the partial index; the planner's estimate for a
+    # column-to-column comparison is a flat guess, so always count exactly.
+    total_products, count_is_exact = count_rows(cursor, "FROM products", [LOW_STOCK_WHERE], [], exact=True)
+    total_pages = ceil(total_products / per_page) if total_products > 0 else 0
+
+    listing = fetch_page(cursor, "SELECT id, name, category, stock, reorder_level, reorder_level - stock AS shortfall FROM products",
+                         [LOW_STOCK_WHERE], [], ['(reorder_level - stock)', 'id'], lambda row: [row['shortfall'], row['id']],
+                         after=request.args.get('after'), before=request.args.get('before'), per_page=per_page)
+    return render_template('low_stock.html', products=listing.rows, page=page, total_pages=total_pages, count_is_exact=count_is_exact,
+                           total_products=total_products, next_cursor=listing.next_cursor, prev_cursor=listing.prev_cursor)
+
+# Matches the column default in migrate_db.py.
+REORDER_LEVEL_DEFAULT = 10
+
+def _reorder_level(value):
+    """The submitted reorder level, the default when left blank."""
+    return int(value) if value not in (None, '') else REORDER_LEVEL_DEFAULT
 
 @app.route('/add_product', methods=['POST'])
 @admin_required
@@ -317,17 +578,22 @@ def add_product():
         category = request.form['category']
         price = float(request.form['price'])
         stock = int(request.form['stock'])
+        reorder_level = _reorder_level(request.form.get('reorder_level'))
         if stock <= 0 or price <= 0:
             flash('Price and stock quantity must be positive numbers.', 'danger')
             return redirect(url_for('inventory'))
+        if reorder_level < 0:
+            flash('Reorder level cannot be negative.', 'danger')
+            return redirect(url_for('inventory'))
         
         conn = get_db()
         cursor = conn.cursor(cursor_factory=DictCursor)
         cursor.execute(
-            'INSERT INTO products (name, category, price, stock) VALUES (%s, %s, %s, %s)',
-            (name, category, price, stock)
+            'INSERT INTO products (name, category, price, stock, reorder_level) VALUES (%s, %s, %s, %s, %s)',
+            (name, category, price, stock, reorder_level)
         )
         conn.commit()
+        dashboard_cache.invalidate()
         flash(f"Product '{name}' added successfully!", 'success')
     except (KeyError, ValueError):
         flash('Invalid form data submitted. Please check all fields.', 'danger')
@@ -343,8 +609,17 @@ def edit_product(id):
         category = request.form['category']
         price = request.form['price']
         stock = request.form['stock']
-        cursor.execute('UPDATE products SET name = %s, category = %s, price = %s, stock = %s WHERE id = %s', (name, category, price, stock, id))
+        try:
+            reorder_level = _reorder_level(request.form.get('reorder_level'))
+        except ValueError:
+            reorder_level = -1
+        if reorder_level < 0:
+            flash('Reorder level must be a whole number of 0 or more.', 'danger')
+            return redirect(url_for('edit_product', id=id))
+        cursor.execute('UPDATE products SET name = %s, category = %s, price = %s, stock = %s, reorder_level = %s WHERE id = %s',
+                       (name, category, price, stock, reorder_level, id))
         conn.commit()
+        dashboard_cache.invalidate()
         flash('Product updated successfully!', 'success')
         return redirect(url_for('inventory'))
     cursor.execute("SELECT * FROM products WHERE id = %s", (id,))
@@ -361,13 +636,26 @@ def delete_product(id):
     cursor = conn.cursor(cursor_factory=DictCursor)
     cursor.execute("DELETE FROM products WHERE id = %s", (id,))
     conn.commit()
+    dashboard_cache.invalidate()
     flash('Product deleted successfully.', 'info')
     return redirect(url_for('inventory'))
 
 # --- Sales & Reporting Routes ---
 
+def _invoice_date_filter(where_clauses, params, start_date, end_date, alias='i'):
+    # Half-open ranges on the raw column (midnight to midnight, shop time)
+    # so the index on created_on can be used and only the months in range
+    # are read. Repeat the filter for every partitioned table in a query.
+    if start_date:
+        where_clauses.append(f"{alias}.created_on >= %s::date::timestamp AT TIME ZONE %s")
+        params.extend([start_date, SHOP_TIMEZONE])
+    if end_date:
+        where_clauses.append(f"{alias}.created_on < (%s::date + 1)::timestamp AT TIME ZONE %s")
+        params.extend([end_date, SHOP_TIMEZONE])
+
 @app.route('/sales_report')
 @login_required
+@replica_reads
 def sales_report():
     cursor = get_db().cursor(cursor_factory=DictCursor)
     page = request.args.get('page', 1, type=int)
@@ -375,62 +663,119 @@ def sales_report():
     end_date = request.args.get('end_date', '')
     search_query = request.args.get('search', '')
     invoices, total_invoices, total_pages, summary = [], 0, 0, {"total_revenue": 0, "total_invoices": 0, "total_items_sold": 0}
+    next_cursor = prev_cursor = None
+    archived_months = None
 
     if start_date or end_date or search_query:
+        # Months moved out of the database by archive.py cannot be reported on.
+        cursor.execute("""
+            SELECT to_char(MIN(month), 'Mon YYYY') AS first, to_char(MAX(month), 'Mon YYYY') AS last FROM archived_months
+            WHERE COALESCE(month + INTERVAL '1 month' > NULLIF(%s, '')::date, true) AND COALESCE(month <= NULLIF(%s, '')::date, true)
+        """, (start_date, end_date))
+        archived_months = cursor.fetchone()
+        if archived_months['first'] is None:
+            archived_months = None
+
         where_clauses, params = [], []
 
-        # --- CORRECTED & SIMPLIFIED DATE LOGIC ---
-        if start_date:
-            where_clauses.append("i.created_on::date >= %s")
-            params.append(start_date)
-        if end_date:
-            where_clauses.append("i.created_on::date <= %s")
-            params.append(end_date)
-        # --- END OF LOGIC ---
+        _invoice_date_filter(where_clauses, params, start_date, end_date)
 
         if search_query:
-            search_term = f"%{search_query}%"
-            where_clauses.append("(i.customer_name ILIKE %s OR i.cashier_username ILIKE %s)")
-            params.extend([search_term, search_term])
+            # Matched against the customers and users tables, which are far
+            # smaller than invoices; the invoices are then read by index. The
+            # names on the invoice itself still count, for invoices without a
+            # customer and cashiers since deleted (trigram-indexed, see
+            # migrate_db.py), so every branch of the OR has an index.
+            customer_sql, customer_params = match_clause(['display_name'], search_query)
+            cashier_sql, cashier_params = match_clause(['username'], search_query)
+            invoice_sql, invoice_params = match_clause(['i.customer_name', 'i.cashier_username'], search_query)
+            where_clauses.append(f"(i.customer_id = ANY(ARRAY(SELECT id FROM customers WHERE {customer_sql})) "
+                                 f"OR i.cashier_username = ANY(ARRAY(SELECT username FROM users WHERE {cashier_sql})) "
+                                 f"OR {invoice_sql})")
+            params.extend(customer_params + cashier_params + invoice_params)
 
         where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-
-        count_query = f"SELECT COUNT(i.id) AS count FROM invoices i {where_sql}"
-        cursor.execute(count_query, params)
-        total_invoices = cursor.fetchone()['count']
-
-        if total_invoices > 0:
-            per_page = 10
+        item_clauses = []
+        _invoice_date_filter(item_clauses, params, start_date, end_date, alias='ii')
+        item_where_sql = " WHERE " + " AND ".join(item_clauses) if item_clauses else ""
+
+        # --- Single-pass report: the filtered invoices are read once, and every
+        # page row carries the summary totals computed from that same set. ---
+        select_sql = f"""
+            WITH filtered AS MATERIALIZED (
+                SELECT i.id, i.customer_name, i.payment_mode, i.total_amount, i.created_on, i.cashier_username
+                FROM invoices i {where_sql}
+            ),
+            item_counts AS (
+                SELECT ii.invoice_id, SUM(ii.quantity) AS item_count
+                FROM invoice_items ii JOIN filtered f ON ii.invoice_id = f.id AND ii.created_on = f.created_on
+                {item_where_sql}
+                GROUP BY ii.invoice_id
+            ),
+            report AS (
+                SELECT f.id, f.customer_name, f.payment_mode, f.total_amount,
+                       to_char(f.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on,
+                       f.cashier_username, c.item_count, f.created_on AS created_at
+                FROM filtered f LEFT JOIN item_counts c ON c.invoice_id = f.id
+            ),
+            totals AS (
+                SELECT SUM(total_amount) AS total_revenue, COUNT(*) AS total_invoices, SUM(item_count) AS total_items
+                FROM report
+            )
+            SELECT report.*, totals.* FROM report CROSS JOIN totals
+        """
+        per_page = 10
+
+        def fetch_report(after, before):
+            page_args = dict(after=after, before=before, per_page=per_page)
+            if search_query and trigram_enabled(cursor):
+                return ranked_page(cursor, select_sql, [], params, ['customer_name', 'cashier_username'], search_query, **page_args)
+            return fetch_page(cursor, select_sql, [], params, ['created_at', 'id'],
+                              lambda row: [row['created_at'], row['id']], **page_args)
+
+        listing = fetch_report(request.args.get('after'), request.args.get('before'))
+        if not listing.rows and (request.args.get('after') or request.args.get('before')):
+            # A stale cursor pointing past the end; start again from the top.
+            page = 1
+            listing = fetch_report(None, None)
+
+        if listing.rows:
+            totals = listing.rows[0]
+            total_invoices = totals['total_invoices']
             total_pages = ceil(total_invoices / per_page)
-            offset = (page - 1) * per_page
-
-            select_query = f"""
-                SELECT i.id, i.customer_name, i.payment_mode, i.total_amount, 
-                       to_char(i.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on, 
-                       i.cashier_username, 
-                       (SELECT SUM(quantity) FROM invoice_items WHERE invoice_id = i.id) as item_count 
-                FROM invoices i {where_sql} ORDER BY i.created_on DESC LIMIT %s OFFSET %s
-            """
-            cursor.execute(select_query, params + [per_page, offset])
-            invoices = cursor.fetchall()
-
-            summary_query = f"SELECT SUM(i.total_amount) AS total_revenue, COUNT(i.id) AS total_invoices FROM invoices i {where_sql}"
-            cursor.execute(summary_query, params)
-            summary_data = cursor.fetchone()
-
-            items_sold_query = f"SELECT SUM(ii.quantity) AS total_items FROM invoice_items ii JOIN invoices i ON ii.invoice_id = i.id {where_sql}"
-            cursor.execute(items_sold_query, params)
-            items_sold_data = cursor.fetchone()
-
+            invoices = listing.rows
+            next_cursor, prev_cursor = listing.next_cursor, listing.prev_cursor
             summary = {
-                "total_revenue": summary_data['total_revenue'] or 0,
-                "total_invoices": summary_data['total_invoices'] or 0,
-                "total_items_sold": items_sold_data['total_items'] or 0
+                "total_revenue": totals['total_revenue'] or 0,
+                "total_invoices": totals['total_invoices'] or 0,
+                "total_items_sold": totals['total_items'] or 0
             }
 
-    return render_template('sales_report.html', invoices=invoices, summary=summary, total_invoices=total_invoices, page=page, total_pages=total_pages, start_date=start_date, end_date=end_date, search_query=search_query)
+    return render_template('sales_report.html', invoices=invoices, summary=summary, total_invoices=total_invoices, page=page, total_pages=total_pages,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor, start_date=start_date, end_date=end_date, search_query=search_query,
+                           archived_months=archived_months)
 
 # --- Legacy Sales Page ---
+def _sales_match_clause(term, source=None):
+    """Matches ``term`` against the customer or product name of sales rows.
+
+    ``source`` picks the rows: 'invoice' for invoice_items ii, 'manual' for
+    sales s, None for the sales_ledger view s. An OR across joined tables
+    cannot use any one trigram index, so products and invoices are matched on
+    their own first and the rows are then found through their own columns.
+    """
+    product_sql, product_params = match_clause(['name'], term)
+    invoice_sql, invoice_params = match_clause(['customer_name'], term)
+    customer_sql, customer_params = match_clause(['s.customer_name'], term)
+    products = f"ARRAY(SELECT id FROM products WHERE {product_sql})"
+    invoices = f"ARRAY(SELECT id FROM invoices WHERE {invoice_sql})"
+    if source == 'invoice':
+        return f"(ii.product_id = ANY({products}) OR ii.invoice_id = ANY({invoices}))", product_params + invoice_params
+    if source == 'manual':
+        return f"(s.product_id = ANY({products}) OR {customer_sql})", product_params + customer_params
+    return (f"(s.product_id = ANY({products}) OR s.invoice_id = ANY({invoices}) OR (s.source = 'manual' AND {customer_sql}))",
+            product_params + invoice_params + customer_params)
+
 @app.route('/sales', defaults={'page': 1}, methods=['GET', 'POST'])
 @app.route('/sales/page/<int:page>', methods=['GET', 'POST'])
 @login_required
@@ -444,20 +789,24 @@ def sales(page):
         customer_name = request.form['customer_name']
         payment_mode = request.form['payment_mode']
 
-        cursor.execute("SELECT price, stock FROM products WHERE id = %s", (product_id,))
-        product_data = cursor.fetchone()
+        def record_sale():
+            # The same conditional decrement as checkout, for a one-line cart.
+            product = _reserve_stock(cursor, {int(product_id): quantity})[int(product_id)]
+            total_price = float(product['price']) * quantity
+            cursor.execute('INSERT INTO sales (product_id, quantity, total_price, customer_name, payment_mode) VALUES (%s, %s, %s, %s, %s)', (product_id, quantity, total_price, customer_name, payment_mode))
 
-        if not product_data:
-            flash('Invalid product selected.', 'danger')
-        elif product_data['stock'] < quantity:
-            flash(f"Not enough stock for this product. Only {product_data['stock']} available.", 'danger')
+        if quantity <= 0:
+            flash('Quantity must be at least 1.', 'danger')
+            return redirect(url_for('sales'))
+        try:
+            run_transaction(conn, record_sale, attempts=TRANSACTION_ATTEMPTS, on_retry=_count_retry('sale'))
+        except InsufficientStock as e:
+            if e.name is None:
+                flash('Invalid product selected.', 'danger')
+            else:
+                flash(f"Not enough stock for this product. Only {e.available} available.", 'danger')
         else:
-            price = float(product_data['price'])
-            total_price = price * quantity
-            cursor.execute('INSERT INTO sales (product_id, quantity, total_price, customer_name, payment_mode) VALUES (%s, %s, %s, %s, %s)', (product_id, quantity, total_price, customer_name, payment_mode))
-            new_stock = product_data['stock'] - quantity
-            cursor.execute("UPDATE products SET stock = %s WHERE id = %s", (new_stock, product_id))
-            conn.commit()
+            dashboard_cache.invalidate()
             flash('Sale recorded successfully. Stock updated.', 'success')
         return redirect(url_for('sales'))
     
@@ -466,56 +815,140 @@ def sales(page):
     
     search_query = request.args.get('search', '')
     per_page = 10
-    offset = (page - 1) * per_page
-    
-    count_query = "SELECT COUNT(s.id) AS count FROM sales s JOIN products p ON s.product_id = p.id"
-    select_query = "SELECT s.id, p.name, s.quantity, s.total_price, s.customer_name, s.payment_mode, to_char(s.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on FROM sales s JOIN products p ON s.product_id = p.id"
-    params = []
+    where_clauses, params = [], []
     
     if search_query:
-        search_term = f"%{search_query}%"
-        where_clause = " WHERE s.customer_name ILIKE%s OR p.name ILIKE%s"
-        count_query += where_clause
-        select_query += where_clause
-        params.extend([search_term, search_term])
-
-    cursor.execute(count_query, params)
-    total_sales_records = cursor.fetchone()['count']
+        match_sql, match_params = _sales_match_clause(search_query)
+        where_clauses.append(match_sql)
+        params.extend(match_params)
+
+    # Checkout lines and hand-entered sales, see the sales_ledger view in migrate_db.py.
+    total_sales_records, count_is_exact = count_rows(cursor, "FROM sales_ledger s JOIN products p ON s.product_id = p.id", where_clauses, params,
+                                                     exact=request.args.get('exact') == '1')
     total_pages = ceil(total_sales_records / per_page) if total_sales_records > 0 else 0
 
-    select_query += " ORDER BY s.id DESC LIMIT %s OFFSET %s"
-    params.extend([per_page, offset])
-    cursor.execute(select_query, params)
-    sales_data = cursor.fetchall()
+    page_args = dict(after=request.args.get('after'), before=request.args.get('before'), per_page=per_page)
+    if search_query and trigram_enabled(cursor):
+        select_sql = ("SELECT s.id, p.name, s.quantity, s.total_price, s.customer_name, s.payment_mode, to_char(s.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on, "
+                      "s.source, s.invoice_id, s.source || '-' || s.id AS ledger_key "
+                      "FROM sales_ledger s JOIN products p ON s.product_id = p.id")
+        listing = ranked_page(cursor, select_sql, where_clauses, params, ['customer_name', 'name'], search_query,
+                              tiebreak='ledger_key', **page_args)
+    else:
+        # Paging the view itself would sort the whole union; each source is
+        # paged on its own (created_on, id) index instead and the pages merged.
+        invoice_where, invoice_params, manual_where, manual_params = [], [], [], []
+        if search_query:
+            match_sql, match_params = _sales_match_clause(search_query, 'invoice')
+            invoice_where, invoice_params = [match_sql], match_params
+            match_sql, match_params = _sales_match_clause(search_query, 'manual')
+            manual_where, manual_params = [match_sql], match_params
+        # Invoice ids are unique on their own. Also matching created_on makes
+        # the planner expect almost no lines per invoice and give up the
+        # ordered index scan for a hash join over every partition.
+        listing = fetch_merged_page(cursor, [
+            ("SELECT ii.id, p.name, ii.quantity, ii.line_total AS total_price, i.customer_name, i.payment_mode, "
+             "to_char(i.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on, 'invoice' AS source, ii.invoice_id, i.created_on AS created_at "
+             "FROM invoices i JOIN invoice_items ii ON ii.invoice_id = i.id JOIN products p ON ii.product_id = p.id",
+             invoice_where, invoice_params, ['i.created_on', "'invoice'::text", 'ii.id']),
+            ("SELECT s.id, p.name, s.quantity, s.total_price, s.customer_name, s.payment_mode, "
+             "to_char(s.created_on, 'YYYY-MM-DD HH24:MI:SS') AS created_on, 'manual' AS source, NULL AS invoice_id, s.created_on AS created_at "
+             "FROM sales s JOIN products p ON s.product_id = p.id",
+             manual_where, manual_params, ['s.created_on', "'manual'::text", 's.id']),
+        ], lambda row: [row['created_at'], row['source'], row['id']], **page_args)
+    sales_data = listing.rows
     
-    cursor.execute("SELECT COUNT(*) AS count FROM sales")
-    total_sales = cursor.fetchone()['count']
-    cursor.execute("SELECT SUM(total_price) AS total FROM sales")
-    total_revenue = cursor.fetchone()['total'] or 0.0
-    cursor.execute('SELECT p.name, SUM(s.quantity) as total_qty FROM sales s JOIN products p ON s.product_id = p.id GROUP BY p.name ORDER BY total_qty DESC LIMIT 1')
+    cursor.execute("SELECT COUNT(*) AS count, SUM(total_price) AS total FROM sales_ledger")
+    totals = cursor.fetchone()
+    total_sales = totals['count']
+    total_revenue = totals['total'] or 0.0
+    cursor.execute('SELECT p.name, SUM(s.quantity) as total_qty FROM sales_ledger s JOIN products p ON s.product_id = p.id GROUP BY p.name ORDER BY total_qty DESC LIMIT 1')
     top_product_res = cursor.fetchone()
     top_product_name = top_product_res['name'] if top_product_res else "N/A"
 
-    return render_template('sales.html', products=products, sales=sales_data, total_sales=total_sales, total_revenue=total_revenue, top_product=top_product_name, page=page, total_pages=total_pages, search_query=search_query)
+    return render_template('sales.html', products=products, sales=sales_data, total_sales=total_sales, total_revenue=total_revenue, top_product=top_product_name,
+                           page=page, total_pages=total_pages, count_is_exact=count_is_exact, next_cursor=listing.next_cursor, prev_cursor=listing.prev_cursor,
+                           search_query=search_query)
+
+# --- Sales Export ---
+# Rows are read through a server-side cursor one batch at a time, so a worker
+# never holds the whole sales history in memory.
+EXPORT_BATCH_SIZE = 2000
+EXPORT_HEADERS = ['S.No.', 'Product Name', 'Quantity', 'Total Price (₹)', 'Customer Name', 'Payment Mode', 'Timestamp']
+
+def _iter_sales_export(conn, start_date='', end_date=''):
+    where_clauses, params = [], []
+    _invoice_date_filter(where_clauses, params, start_date, end_date, alias='s')
+    where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+    cursor = conn.cursor(name='export_sales', cursor_factory=DictCursor)
+    cursor.itersize = EXPORT_BATCH_SIZE
+    try:
+        cursor.execute('SELECT s.id, p.name, s.quantity, s.total_price, s.customer_name, s.payment_mode, s.created_on FROM sales_ledger s JOIN products p ON s.product_id = p.id'
+                       + where_sql + ' ORDER BY s.created_on DESC, s.source DESC, s.id DESC', params)
+        serial = 0
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            rows = []
+            for row in batch:
+                serial += 1
+                formatted_timestamp = row['created_on'].strftime('%Y-%m-%d %H:%M:%S')
+                rows.append([serial, row['name'], row['quantity'], float(row['total_price']), row['customer_name'], row['payment_mode'], formatted_timestamp])
+            yield rows
+    finally:
+        cursor.close()
+
+def _stream_sales_csv(conn, compress, start_date, end_date):
+    # gzip framing (wbits=31) lets us compress chunk by chunk as rows arrive.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encode(rows):
+        buffer = StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    yield encode([EXPORT_HEADERS])
+    for rows in _iter_sales_export(conn, start_date, end_date):
+        chunk = encode(rows)
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
 
 @app.route('/export_sales')
 @admin_required
+@replica_reads
 def export_sales():
-    cursor = get_db().cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT s.id, p.name, s.quantity, s.total_price, s.customer_name, s.payment_mode, s.created_on FROM sales s JOIN products p ON s.product_id = p.id ORDER BY s.id DESC')
-    sales_data = cursor.fetchall()
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Sales Report"
-    headers = ['S.No.', 'Product Name', 'Quantity', 'Total Price (₹)', 'Customer Name', 'Payment Mode', 'Timestamp']
-    ws.append(headers)
-    for i, row in enumerate(sales_data, start=1):
-        # This is the changed line:
-        formatted_timestamp = row['created_on'].strftime('%Y-%m-%d %H:%M:%S')
-        ws.append([i, row['name'], row['quantity'], float(row['total_price']), row['customer_name'], row['payment_mode'], formatted_timestamp])
-
-    file_stream = BytesIO()
+    export_format = request.args.get('format', 'xlsx')
+    # An optional period (shop dates, inclusive); only its months are read.
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
+
+    if export_format in ('csv', 'csv.gz'):
+        compress = export_format == 'csv.gz'
+        # The body is produced after the request's teardown has already
+        # handed g.db back to the pool, so the stream gets a connection of its
+        # own. It is picked here, while the session (and its replica_min_lsn)
+        # can still be saved, and returned when the server closes the response.
+        pool, conn = _connect_for_request()
+        response = Response(stream_with_context(_stream_sales_csv(conn, compress, start_date, end_date)),
+                            mimetype='application/gzip' if compress else 'text/csv',
+                            headers={'Content-Disposition': f'attachment; filename=sales_report.{export_format}'})
+        response.call_on_close(lambda: pool.putconn(conn))
+        return response
+
+    # A write-only workbook spools rows to disk instead of building them in
+    # memory; the finished file is then streamed back in chunks.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Sales Report")
+    ws.append(EXPORT_HEADERS)
+    for rows in _iter_sales_export(get_db(), start_date, end_date):
+        for row in rows:
+            ws.append(row)
+
+    file_stream = tempfile.TemporaryFile()
     wb.save(file_stream)
     file_stream.seek(0)
     return send_file(file_stream, as_attachment=True, download_name='sales_report.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -561,10 +994,481 @@ def delete_sale(sale_id):
 @app.route('/billing')
 @login_required
 def billing():
+    # The product list is loaded by the page itself from /api/catalog, which
+    # the browser keeps and refreshes with deltas.
+    return render_template('billing.html')
+
+# --- Product Catalog API ---
+# Every product row carries a catalog_version, the id of the transaction that
+# last changed it, stamped by a trigger (see migrate_db.py). Clients send the
+# last version they saw and receive only the products changed or deleted
+# since. Stock shown on the till is advisory; checkout() re-validates it.
+def _catalog_version(cursor):
+    # Transactions commit out of id order, so the version handed out is the
+    # snapshot's xmin: every transaction below it has ended, while one at or
+    # above it may still commit rows, which the next delta (>= version) picks up.
+    cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS version")
+    return cursor.fetchone()['version']
+
+def _catalog_changed(cursor, since):
+    cursor.execute("""
+        SELECT EXISTS (SELECT 1 FROM products WHERE catalog_version >= %s)
+            OR EXISTS (SELECT 1 FROM product_tombstones WHERE catalog_version >= %s) AS changed
+    """, (since, since))
+    return cursor.fetchone()['changed']
+
+def _catalog_entry(row):
+    return {'id': row['id'], 'name': row['name'], 'category': row['category'], 'price': float(row['price']), 'stock': row['stock']}
+
+@app.route('/api/catalog')
+@login_required
+def catalog():
     cursor = get_db().cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT id, name, category, price, stock FROM products WHERE stock > 0 ORDER BY name")
-    products = cursor.fetchall()
-    return render_template('billing.html', products=products)
+    # Read before the rows, so nothing committed after the reads below is missed.
+    version = _catalog_version(cursor)
+    since = request.args.get('since', type=int)
+    if since is not None and since > version:
+        # The client is ahead of us (e.g. the database was reset): resend everything.
+        since = None
+    # The ETag names the version a full catalog was built at, and stays
+    # current for as long as nothing has been stamped since.
+    seen = next((int(tag[len('catalog-'):]) for tag in request.if_none_match
+                 if tag.startswith('catalog-') and tag[len('catalog-'):].isdigit()), None)
+    unchanged_since = since if since is not None else seen
+
+    if unchanged_since is not None and unchanged_since <= version and not _catalog_changed(cursor, unchanged_since):
+        response = Response(status=304)
+        version = unchanged_since
+    else:
+        deleted = []
+        if since is None:
+            cursor.execute("SELECT id, name, category, price, stock FROM products WHERE stock > 0 ORDER BY name")
+        else:
+            # Deltas include products that just sold out so the till can drop them.
+            cursor.execute("SELECT id, name, category, price, stock FROM products WHERE catalog_version >= %s", (since,))
+        products = [_catalog_entry(row) for row in cursor.fetchall()]
+        if since is not None:
+            cursor.execute("SELECT product_id FROM product_tombstones WHERE catalog_version >= %s", (since,))
+            deleted = [row['product_id'] for row in cursor.fetchall()]
+        response = jsonify(version=version, full=since is None, products=products, deleted=deleted)
+
+    response.set_etag(f'catalog-{version}')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- Bulk Receipt Printing ---
+RECEIPT_BATCH_LIMIT = int(os.environ.get('RECEIPT_BATCH_LIMIT', 500))
+
+def _receipt_totals(invoice):
+    total_amount = float(invoice['total_amount'])
+    subtotal = total_amount / 1.18
+    return subtotal, subtotal * 0.09, subtotal * 0.09
+
+@app.route('/receipts')
+@login_required
+def receipts():
+    """Many receipts in one printable page: ?ids=12,13,14 or ?start_date=&end_date=."""
+    where_clauses, params = [], []
+    ids = [int(part) for part in request.args.get('ids', '').split(',') if part.strip().isdigit()]
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
+    if ids:
+        where_clauses.append("i.id = ANY(%s::int[])")
+        params.append(ids)
+    elif start_date or end_date:
+        _invoice_date_filter(where_clauses, params, start_date, end_date)
+    else:
+        flash('Choose the invoices or a date range to print.', 'danger')
+        return redirect(url_for('sales_report'))
+
+    cursor = get_db().cursor(cursor_factory=DictCursor)
+    cursor.execute(f"""
+        SELECT i.*, {RECEIPT_DATE_COLUMNS}
+        FROM invoices i WHERE {" AND ".join(where_clauses)}
+        ORDER BY i.created_on, i.id
+        LIMIT %s
+    """, params + [RECEIPT_BATCH_LIMIT + 1])
+    invoices = cursor.fetchall()
+    truncated = len(invoices) > RECEIPT_BATCH_LIMIT
+    invoices = invoices[:RECEIPT_BATCH_LIMIT]
+
+    # Every line item of the batch in one query, grouped per invoice below.
+    items_by_invoice = {invoice['id']: [] for invoice in invoices}
+    if invoices:
+        # The batch's time span limits the lookup to the partitions it covers.
+        cursor.execute("""
+            SELECT ii.invoice_id, p.name, ii.quantity, ii.price_at_sale, ii.line_total
+            FROM invoice_items ii JOIN products p ON ii.product_id = p.id
+            WHERE ii.invoice_id = ANY(%s::int[]) AND ii.created_on BETWEEN %s AND %s
+            ORDER BY ii.invoice_id, ii.id
+        """, (list(items_by_invoice), min(invoice['created_on'] for invoice in invoices),
+              max(invoice['created_on'] for invoice in invoices)))
+        for item in cursor.fetchall():
+            items_by_invoice[item['invoice_id']].append(item)
+
+    batch = []
+    for invoice in invoices:
+        subtotal, cgst_amount, sgst_amount = _receipt_totals(invoice)
+        batch.append({'invoice': invoice, 'items': items_by_invoice[invoice['id']],
+                      'subtotal': subtotal, 'cgst_amount': cgst_amount, 'sgst_amount': sgst_amount})
+    return render_template('receipts.html', receipts=batch, truncated=truncated)
+
+# --- Receipt Cache ---
+# Invoices are never edited after checkout, so a rendered receipt stays valid
+# for good. print_layout.html has no session or flash content, which makes the
+# whole page safe to share between users. Sizes can be tuned with
+# RECEIPT_CACHE_MAX_ENTRIES / RECEIPT_CACHE_MAX_BYTES.
+RECEIPT_DATE_COLUMNS = "to_char(created_on, 'YYYY-MM-DD') AS formatted_date, to_char(created_on, 'HH12:MI:SS PM') AS formatted_time"
+
+receipt_cache = LRUCache(
+    max_entries=int(os.environ.get('RECEIPT_CACHE_MAX_ENTRIES', 500)),
+    max_bytes=int(os.environ.get('RECEIPT_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+    sizeof=lambda html: len(html.encode('utf-8')),
+    generation=Generation(os.environ.get('RECEIPT_CACHE_STAMP', os.path.join(tempfile.gettempdir(), 'pos-receipt-cache.stamp'))),
+)
+
+def _render_receipt(invoice, items):
+    subtotal, cgst_amount, sgst_amount = _receipt_totals(invoice)
+    return render_template('receipt.html', 
+                           invoice=invoice, 
+                           items=items,
+                           subtotal=subtotal,
+                           cgst_amount=cgst_amount,
+                           sgst_amount=sgst_amount,
+                           invoice_date=invoice['formatted_date'],
+                           invoice_time=invoice['formatted_time'])
+
+@app.route('/receipt/<int:invoice_id>/invalidate', methods=['POST'])
+@admin_required
+def invalidate_receipt(invoice_id):
+    """For the rare manual correction of an invoice in the database."""
+    receipt_cache.invalidate(invoice_id)
+    flash(f'Receipt #{invoice_id} will be re-rendered on its next view.', 'success')
+    return redirect(url_for('receipt', invoice_id=invoice_id))
+
+# --- Background Jobs ---
+# Post-commit work (see jobs.py). Unless JOBS_IN_PROCESS=0, every web process
+# runs a worker thread; otherwise run `python jobs.py` alongside the app.
+# JOB_QUEUE=inline applies the work inside the checkout transaction instead,
+# as before the queue existed; the default 'auto' does so only while the
+# job_queue table is missing, and 'queue' always queues.
+JOBS_IN_PROCESS = os.environ.get('JOBS_IN_PROCESS', '1') == '1'
+job_queue = JobQueue(
+    max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 5)),
+    interval=float(os.environ.get('JOB_POLL_INTERVAL', 1)),
+    mode=os.environ.get('JOB_QUEUE', 'auto'),
+)
+
+def _apply_checkout_rollups(cursor, payloads):
+    """Adds a batch of checkouts to the daily rollups and their customers' totals."""
+    days = [payload['sale_date'] for payload in payloads]
+    cursor.execute("""
+        INSERT INTO daily_sales (sale_date, total_revenue, invoice_count, items_sold)
+        SELECT l.sale_date, SUM(l.revenue), COUNT(*), SUM(l.items_sold)
+        FROM unnest(%s::date[], %s::numeric[], %s::int[]) AS l(sale_date, revenue, items_sold)
+        GROUP BY l.sale_date ORDER BY l.sale_date
+        ON CONFLICT (sale_date) DO UPDATE SET
+            total_revenue = daily_sales.total_revenue + EXCLUDED.total_revenue,
+            invoice_count = daily_sales.invoice_count + EXCLUDED.invoice_count,
+            items_sold = daily_sales.items_sold + EXCLUDED.items_sold
+    """, (days, [payload['revenue'] for payload in payloads], [payload['items_sold'] for payload in payloads]))
+
+    lines = [(payload['sale_date'], *line) for payload in payloads for line in payload['lines']]
+    line_days, product_ids, quantities, line_totals = (list(column) for column in zip(*lines))
+    cursor.execute("""
+        INSERT INTO daily_product_sales (sale_date, product_id, quantity, revenue)
+        SELECT l.sale_date, l.product_id, SUM(l.quantity), SUM(ROUND(l.line_total, 2))
+        FROM unnest(%s::date[], %s::int[], %s::int[], %s::numeric[]) AS l(sale_date, product_id, quantity, line_total)
+        GROUP BY l.sale_date, l.product_id ORDER BY l.sale_date, l.product_id
+        ON CONFLICT (sale_date, product_id) DO UPDATE SET
+            quantity = daily_product_sales.quantity + EXCLUDED.quantity,
+            revenue = daily_product_sales.revenue + EXCLUDED.revenue
+    """, (line_days, product_ids, quantities, line_totals))
+
+    visits = [payload for payload in payloads if payload.get('customer_id') is not None]
+    if visits:
+        customer_ids = [payload['customer_id'] for payload in visits]
+        # Locked in id order, like products, so concurrent batches cannot deadlock.
+        cursor.execute("SELECT id FROM customers WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (customer_ids,))
+        cursor.execute("""
+            UPDATE customers c SET
+                lifetime_spend = c.lifetime_spend + l.spend,
+                visit_count = c.visit_count + l.visits,
+                first_visit = LEAST(c.first_visit, l.first_visit),
+                last_visit = GREATEST(c.last_visit, l.last_visit)
+            FROM (
+                SELECT customer_id, SUM(spend) AS spend, COUNT(*) AS visits, MIN(visited) AS first_visit, MAX(visited) AS last_visit
+                FROM unnest(%s::int[], %s::numeric[], %s::timestamptz[]) AS l(customer_id, spend, visited)
+                GROUP BY customer_id
+            ) l
+            WHERE c.id = l.customer_id
+        """, (customer_ids, [payload['revenue'] for payload in visits], [payload['created_on'] for payload in visits]))
+
+# The dashboard may have been rebuilt between the checkout and its job.
+job_queue.register('checkout_rollups', _apply_checkout_rollups, committed=lambda payloads: dashboard_cache.invalidate())
+
+# invoices, invoice_items and sales are partitioned by month; the coming
+# months' partitions are created well before the first sale lands in them.
+job_queue.every(float(os.environ.get('PARTITION_CHECK_INTERVAL', 3600)), ensure_partitions)
+
+@app.before_request
+def start_background_jobs():
+    if JOBS_IN_PROCESS:
+        job_queue.ensure_started(db_pool)
+
+
+# --- Stock Reservation ---
+TRANSACTION_ATTEMPTS = int(os.environ.get('TRANSACTION_ATTEMPTS', 3))
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, name, available):
+        super().__init__(f"not enough stock for product {product_id}")
+        self.product_id = product_id
+        self.name = name
+        self.available = available
+
+
+class DuplicateCheckout(Exception):
+    """The checkout's idempotency key already belongs to an invoice."""
+
+
+def _count_retry(operation):
+    return lambda error: metrics.inc('pos_db_transaction_retries_total',
+                                     {'operation': operation, 'error': type(error).__name__})
+
+
+def _reserve_stock(cursor, quantities):
+    """Locks the products of ``quantities`` ({product id: quantity}) and takes the stock.
+
+    Rows are locked in product id order, so two tills selling overlapping
+    carts queue behind each other instead of deadlocking, and the decrement
+    only applies where enough stock is left. Raises InsufficientStock for the
+    first product that is short (the caller rolls back); otherwise returns
+    the locked rows by id.
+    """
+    product_ids = sorted(quantities)
+    cursor.execute("SELECT id, name, stock, price FROM products WHERE id = ANY(%s::int[]) ORDER BY id FOR UPDATE",
+                   (product_ids,))
+    products = {row['id']: row for row in cursor.fetchall()}
+    cursor.execute("""
+        UPDATE products AS p SET stock = p.stock - l.quantity
+        FROM unnest(%s::int[], %s::int[]) AS l(product_id, quantity)
+        WHERE p.id = l.product_id AND p.stock >= l.quantity
+        RETURNING p.id
+    """, (product_ids, [quantities[product_id] for product_id in product_ids]))
+    reserved = {row['id'] for row in cursor.fetchall()}
+    for product_id in product_ids:
+        if product_id not in reserved:
+            product = products.get(product_id)
+            # A product deleted since the cart was built has no name and no stock.
+            raise InsufficientStock(product_id, product['name'] if product else None, product['stock'] if product else 0)
+    return products
+
+
+def _place_order(conn, quantities, customer_name, payment_mode, cashier, idempotency_key=None, created_on=None):
+    """Reserves stock and writes one invoice with its lines and rollup job, uncommitted.
+
+    Returns ``(invoice, invoice_items, product names by id)``. Raises
+    DuplicateCheckout if an invoice with ``idempotency_key`` already exists.
+    ``created_on`` backdates a checkout that was queued (see _drain_checkout).
+    """
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    # --- Batched checkout: the number of round trips does not grow with the cart ---
+    products = _reserve_stock(cursor, quantities)
+
+    total_amount = 0
+    lines = []
+    for product_id in sorted(quantities):
+        price_at_sale = products[product_id]['price']
+        line_total = float(price_at_sale) * quantities[product_id] # FIX: Cast Decimal to float
+        total_amount += line_total
+        lines.append((product_id, quantities[product_id], price_at_sale, line_total))
+
+    TAX_RATE = 0.18
+    final_total_with_tax = total_amount * (1 + TAX_RATE)
+
+    # FIX: Changed from lastrowid to RETURNING id
+    # A repeated key waits in checkout_keys for the first transaction and then
+    # claims nothing, so no invoice is inserted; the caller rolls back the
+    # stock it reserved. Until migration 11 swaps in the partitioned invoices,
+    # a key written by older code may only be in invoices' own unique index,
+    # hence ON CONFLICT DO NOTHING. The customer row is only created, never locked:
+    # their totals are added by the rollup job.
+    cursor.execute("""
+        WITH name AS (
+            SELECT name_key FROM customer_name_key(%(customer_name)s) AS name_key WHERE name_key <> ''
+        ),
+        existing AS (SELECT c.id FROM customers c JOIN name USING (name_key)),
+        created AS (
+            INSERT INTO customers (name_key, display_name)
+            SELECT name_key, regexp_replace(btrim(%(customer_name)s), '\\s+', ' ', 'g') FROM name WHERE NOT EXISTS (SELECT 1 FROM existing)
+            ON CONFLICT (name_key) DO NOTHING
+            RETURNING id
+        ),
+        claimed AS (
+            INSERT INTO checkout_keys (idempotency_key, invoice_id, created_on)
+            SELECT %(idempotency_key)s, nextval('invoices_id_seq'), COALESCE(%(created_on)s::timestamptz, CURRENT_TIMESTAMP)
+            WHERE %(idempotency_key)s::uuid IS NOT NULL
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING invoice_id, created_on
+        )
+        INSERT INTO invoices (id, customer_name, payment_mode, total_amount, cashier_username, idempotency_key, created_on, customer_id)
+        SELECT COALESCE(claimed.invoice_id, nextval('invoices_id_seq')), %(customer_name)s, %(payment_mode)s, %(total)s, %(cashier)s,
+               %(idempotency_key)s, COALESCE(claimed.created_on, %(created_on)s::timestamptz, CURRENT_TIMESTAMP),
+               (SELECT id FROM existing UNION ALL SELECT id FROM created LIMIT 1)
+        FROM (SELECT 1) AS checkout LEFT JOIN claimed ON true
+        WHERE %(idempotency_key)s::uuid IS NULL OR claimed.invoice_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING *, (created_on AT TIME ZONE %(timezone)s)::date AS sale_date, """ + RECEIPT_DATE_COLUMNS,
+        dict(customer_name=customer_name, payment_mode=payment_mode, total=final_total_with_tax, cashier=cashier,
+             idempotency_key=idempotency_key, created_on=created_on, timezone=SHOP_TIMEZONE))
+    invoice = cursor.fetchone()
+    if invoice is None:
+        raise DuplicateCheckout()
+    if invoice['customer_id'] is None and (customer_name or '').strip():
+        # A till created this customer a moment ago, after our snapshot.
+        cursor.execute("UPDATE invoices SET customer_id = (SELECT id FROM customers WHERE name_key = customer_name_key(%s)) "
+                       "WHERE id = %s RETURNING customer_id", (customer_name, invoice['id']))
+        invoice['customer_id'] = cursor.fetchone()['customer_id']
+
+    product_ids, line_quantities, prices, line_totals = (list(column) for column in zip(*lines))
+    cursor.execute("""
+        INSERT INTO invoice_items (invoice_id, created_on, product_id, quantity, price_at_sale, line_total)
+        SELECT %s, %s, l.* FROM unnest(%s::int[], %s::int[], %s::numeric[], %s::numeric[]) AS l
+        RETURNING product_id, quantity, price_at_sale, line_total
+    """, (invoice['id'], invoice['created_on'], product_ids, line_quantities, prices, line_totals))
+    invoice_items = cursor.fetchall()
+
+    # --- Dashboard rollups are applied after commit, in batches ---
+    # Upserting daily_sales here would hold today's row locked until commit
+    # and so serialize every checkout; the job is just an insert. Without
+    # the queue (JOB_QUEUE=inline) that is what happens.
+    job_queue.defer(cursor, 'checkout_rollups', {
+        'sale_date': invoice['sale_date'].isoformat(),
+        'created_on': invoice['created_on'].isoformat(),
+        'customer_id': invoice['customer_id'],
+        'revenue': str(invoice['total_amount']),
+        'items_sold': sum(line_quantities),
+        'lines': [[product_id, quantity, line_total] for product_id, quantity, line_total in zip(product_ids, line_quantities, line_totals)],
+    })
+
+    names = {product_id: product['name'] for product_id, product in products.items()}
+    return invoice, invoice_items, names
+
+
+# --- Idempotent Checkout ---
+# The till sends a fresh idempotency key with every cart, so a form submitted
+# twice (a double click, a retry after a timeout) creates one invoice. With
+# CHECKOUT_WRITE_BEHIND=1 checkout only validates the cart and appends it to a
+# local journal; a background thread writes the journal to PostgreSQL in
+# order, and the till polls /checkout/<key> until the receipt is ready.
+CHECKOUT_WRITE_BEHIND = os.environ.get('CHECKOUT_WRITE_BEHIND') == '1'
+checkout_journal = CheckoutJournal(
+    os.environ.get('CHECKOUT_JOURNAL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'checkout-journal.sqlite3')),
+    interval=float(os.environ.get('CHECKOUT_JOURNAL_INTERVAL', 1)),
+)
+
+def _idempotency_key(value):
+    """The key in its canonical form, or None if ``value`` is not a UUID."""
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError):
+        return None
+
+def _invoice_for_key(conn, idempotency_key):
+    if idempotency_key is None:
+        return None
+    cursor = conn.cursor()
+    # The second branch only runs before migration 11's swap, while
+    # invoices still has its unique index on the key (see _place_order).
+    cursor.execute("""
+        SELECT invoice_id FROM checkout_keys WHERE idempotency_key = %(key)s
+        UNION ALL
+        SELECT id FROM invoices WHERE idempotency_key = %(key)s AND to_regclass('idx_invoices_idempotency_key') IS NOT NULL
+        LIMIT 1
+    """, dict(key=idempotency_key))
+    row = cursor.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+def _check_cart(cursor, quantities, cart):
+    """Looks at the cart's products without locking them; returns what is wrong with it, or None.
+
+    For write-behind checkouts, which are only journalled here: the drain
+    reserves the stock for real and may still refuse the sale.
+    """
+    cursor.execute("SELECT id, name, stock, price FROM products WHERE id = ANY(%s::int[])", (sorted(quantities),))
+    products = {row['id']: row for row in cursor.fetchall()}
+    for product_id in sorted(quantities):
+        item = cart.get(str(product_id)) or {}
+        product = products.get(product_id)
+        if product is None or product['stock'] < quantities[product_id]:
+            metrics.inc('pos_checkout_stock_rejections_total')
+            return (f"Not enough stock for {item.get('name') or (product and product['name'])}. "
+                    f"Only {product['stock'] if product else 0} available. Transaction cancelled.")
+        try:
+            shown = round(float(item.get('price', product['price'])), 2)
+        except (TypeError, ValueError):
+            shown = None
+        if shown != round(float(product['price']), 2):
+            return f"The price of {product['name']} is now ₹{product['price']:.2f}. Please check the cart and try again."
+    return None
+
+def _checkout_committed(invoice, invoice_items, names, warm_receipt=True):
+    job_queue.wake()
+    dashboard_cache.invalidate()
+    if warm_receipt:
+        # Warm the receipt cache from what we already have, so the redirect
+        # to the receipt is served without touching the database.
+        items = [dict(item, name=names[item['product_id']]) for item in invoice_items]
+        receipt_cache.put(invoice['id'], _render_receipt(invoice, items))
+    metrics.inc('pos_checkout_invoices_total')
+    metrics.inc('pos_checkout_lines_total', value=len(invoice_items))
+    metrics.inc('pos_checkout_revenue_total', value=float(invoice['total_amount']))
+    metrics.observe('pos_checkout_lines_per_invoice', len(invoice_items))
+
+def _drain_checkout(key, order):
+    """Writes one journalled checkout to PostgreSQL; returns its invoice id."""
+    quantities = {int(product_id): quantity for product_id, quantity in order['quantities'].items()}
+    created_on = datetime.fromtimestamp(order['queued_at'], timezone.utc)
+    try:
+        conn = db_pool.getconn()
+    except (PoolError, psycopg2.OperationalError) as e:
+        raise JournalUnavailable(str(e))
+    try:
+        try:
+            invoice, invoice_items, names = run_transaction(
+                conn, lambda: _place_order(conn, quantities, order['customer_name'], order['payment_mode'], order['cashier'],
+                                           idempotency_key=key, created_on=created_on),
+                attempts=TRANSACTION_ATTEMPTS, on_retry=_count_retry('checkout'))
+        except (DuplicateCheckout, InsufficientStock) as e:
+            # Already written by a drain that stopped before marking the entry.
+            existing = _invoice_for_key(conn, key)
+            if existing is not None:
+                return existing
+            if isinstance(e, DuplicateCheckout):
+                raise
+            metrics.inc('pos_checkout_stock_rejections_total')
+            raise JournalRejected(f"Not enough stock for {e.name or f'product #{e.product_id}'}. Only {e.available} available.")
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            # The same order would be refused again on every retry.
+            raise JournalRejected(f"The database refused this sale: {e.diag.message_primary or e}")
+        except psycopg2.OperationalError as e:
+            if conn.closed:
+                raise JournalUnavailable(str(e))
+            raise
+    finally:
+        db_pool.putconn(conn)
+    # Receipts render with url_for(), which needs a request; the first
+    # visit to /receipt renders and caches this one.
+    _checkout_committed(invoice, invoice_items, names, warm_receipt=False)
+    return invoice['id']
+
+if CHECKOUT_WRITE_BEHIND:
+    # Drains whatever an earlier run left in the journal.
+    checkout_journal.ensure_started(_drain_checkout)
+
 
 @app.route('/checkout', methods=['POST'])
 @login_required
@@ -575,6 +1479,9 @@ def checkout():
     if not customer_name or not customer_name.strip():
         flash('Customer name is a mandatory field.', 'danger')
         return redirect(url_for('billing'))
+    if not payment_mode or not payment_mode.strip():
+        flash('Payment mode is a mandatory field.', 'danger')
+        return redirect(url_for('billing'))
     
     try:
         cart = json.loads(form_data.get('cart_data', '{}'))
@@ -586,83 +1493,110 @@ def checkout():
         flash('Cannot process an empty cart.', 'danger')
         return redirect(url_for('billing'))
 
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    try:
+        quantities = {int(product_id): int(item['quantity']) for product_id, item in cart.items()}
+    except (KeyError, TypeError, ValueError):
+        flash('There was an error processing your cart. Please try again.', 'danger')
+        return redirect(url_for('billing'))
+    if any(quantity <= 0 for quantity in quantities.values()):
+        flash('Quantities must be at least 1.', 'danger')
+        return redirect(url_for('billing'))
 
+    idempotency_key = _idempotency_key(form_data.get('idempotency_key'))
+    if CHECKOUT_WRITE_BEHIND:
+        # Journalling is for when PostgreSQL is slow or down, so a failed
+        # check lets the cart through; the drain checks it again anyway.
+        try:
+            conn = get_db()
+            problem = _check_cart(conn.cursor(cursor_factory=DictCursor), quantities, cart)
+            conn.rollback()
+        except (PoolError, psycopg2.Error):
+            problem = None
+        if problem:
+            flash(problem, 'danger')
+            return redirect(url_for('billing'))
+        key = idempotency_key or str(uuid.uuid4())
+        checkout_journal.enqueue(key, {
+            'quantities': {str(product_id): quantity for product_id, quantity in quantities.items()},
+            'customer_name': customer_name,
+            'payment_mode': payment_mode,
+            'cashier': session['username'],
+            'queued_at': time.time(),
+        })
+        checkout_journal.ensure_started(_drain_checkout)
+        return redirect(url_for('checkout_status', key=key))
+
+    conn = get_db()
     try:
-        total_amount = 0
-        for product_id, item in cart.items():
-            cursor.execute("SELECT stock, price FROM products WHERE id = %s", (product_id,))
-            product_in_db = cursor.fetchone()
-            if not product_in_db or product_in_db['stock'] < item['quantity']:
-                flash(f"Not enough stock for {item['name']}. Transaction cancelled.", 'danger')
-                conn.rollback()
-                return redirect(url_for('billing'))
-            total_amount += float(product_in_db['price']) * item['quantity'] # FIX: Cast Decimal to float
-
-        TAX_RATE = 0.18
-        final_total_with_tax = total_amount * (1 + TAX_RATE)
-        
-        # FIX: Changed from lastrowid to RETURNING id
-        cursor.execute('INSERT INTO invoices (customer_name, payment_mode, total_amount, cashier_username) VALUES (%s, %s, %s, %s) RETURNING id', 
-                       (customer_name, payment_mode, final_total_with_tax, session['username']))
-        invoice_id = cursor.fetchone()['id']
-        
-        for product_id, item in cart.items():
-            cursor.execute("SELECT price FROM products WHERE id = %s", (product_id,))
-            price_at_sale = cursor.fetchone()['price']
-            line_total = float(price_at_sale) * item['quantity'] # FIX: Cast Decimal to float
-            cursor.execute('INSERT INTO invoice_items (invoice_id, product_id, quantity, price_at_sale, line_total) VALUES (%s, %s, %s, %s, %s)', 
-                           (invoice_id, product_id, item['quantity'], price_at_sale, line_total))
-            
-            cursor.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (item['quantity'], product_id))
-            
-            cursor.execute('INSERT INTO sales (product_id, quantity, total_price, customer_name, payment_mode) VALUES (%s, %s, %s, %s, %s)', 
-                           (product_id, item['quantity'], line_total, customer_name, payment_mode))
-        
-        conn.commit()
-        flash(f'Invoice #{invoice_id} created successfully! Sales history updated.', 'success')
-        return redirect(url_for('receipt', invoice_id=invoice_id))
-        
+        invoice, invoice_items, names = run_transaction(
+            conn, lambda: _place_order(conn, quantities, customer_name, payment_mode, session['username'],
+                                       idempotency_key=idempotency_key),
+            attempts=TRANSACTION_ATTEMPTS, on_retry=_count_retry('checkout'))
+    except (DuplicateCheckout, InsufficientStock) as e:
+        # A resubmitted form whose first submission went through (and may
+        # have taken the last of the stock) gets that sale's receipt.
+        existing = _invoice_for_key(conn, idempotency_key)
+        if existing is not None:
+            metrics.inc('pos_checkout_duplicates_total')
+            flash(f'Invoice #{existing} was already created for this sale.', 'info')
+            return redirect(url_for('receipt', invoice_id=existing))
+        if isinstance(e, DuplicateCheckout):
+            raise
+        metrics.inc('pos_checkout_stock_rejections_total')
+        item = cart.get(str(e.product_id)) or {}
+        flash(f"Not enough stock for {item.get('name') or e.name}. Only {e.available} available. Transaction cancelled.", 'danger')
+        return redirect(url_for('billing'))
     except psycopg2.Error as e: # FIX: Changed from sqlite3.Error
-        conn.rollback()
         flash(f'A database error occurred: {e}. Transaction cancelled.', 'danger')
         return redirect(url_for('billing'))
 
+    _checkout_committed(invoice, invoice_items, names)
+    flash(f"Invoice #{invoice['id']} created successfully! Sales history updated.", 'success')
+    return redirect(url_for('receipt', invoice_id=invoice['id']))
+
+@app.route('/checkout/<key>')
+@login_required
+def checkout_status(key):
+    """Where a queued checkout lands: its receipt once it has reached PostgreSQL."""
+    key = _idempotency_key(key)
+    entry = checkout_journal.get(key) if key and CHECKOUT_WRITE_BEHIND else None
+    if entry is not None and entry['status'] == 'pending':
+        checkout_journal.ensure_started(_drain_checkout)
+        return render_template('checkout_pending.html', entry=entry)
+    if entry is not None and entry['status'] == 'failed':
+        flash(f"The queued sale for {entry['payload']['customer_name']} could not be completed: {entry['error']}", 'danger')
+        return redirect(url_for('billing'))
+
+    invoice_id = entry['invoice_id'] if entry is not None else _invoice_for_key(get_db(), key)
+    if invoice_id is None:
+        flash('Sale not found.', 'danger')
+        return redirect(url_for('billing'))
+    return redirect(url_for('receipt', invoice_id=invoice_id))
+
 @app.route('/receipt/<int:invoice_id>')
 @login_required
 def receipt(invoice_id):
+    html = receipt_cache.get(invoice_id)
+    if html is not None:
+        return html
+
     cursor = get_db().cursor(cursor_factory=DictCursor)
 
-    cursor.execute("""
-        SELECT *,
-               to_char(created_on, 'YYYY-MM-DD') AS formatted_date,
-               to_char(created_on, 'HH12:MI:SS PM') AS formatted_time
-        FROM invoices WHERE id = %s
-    """, (invoice_id,))
+    cursor.execute("SELECT *, " + RECEIPT_DATE_COLUMNS + " FROM invoices WHERE id = %s", (invoice_id,))
 
     invoice = cursor.fetchone()
     if not invoice:
         flash('Invoice not found.', 'danger')
         return redirect(url_for('dashboard'))
 
-    cursor.execute('SELECT p.name, ii.quantity, ii.price_at_sale, ii.line_total FROM invoice_items ii JOIN products p ON ii.product_id = p.id WHERE ii.invoice_id = %s', (invoice_id,))
+    # Lines carry their invoice's created_on, which narrows the lookup to one partition.
+    cursor.execute('SELECT p.name, ii.quantity, ii.price_at_sale, ii.line_total FROM invoice_items ii JOIN products p ON ii.product_id = p.id '
+                   'WHERE ii.invoice_id = %s AND ii.created_on = %s', (invoice_id, invoice['created_on']))
     items = cursor.fetchall()
 
-    total_amount = float(invoice['total_amount'])
-    subtotal = total_amount / 1.18
-    cgst_amount = subtotal * 0.09
-    sgst_amount = subtotal * 0.09
-
-
-    return render_template('receipt.html', 
-                           invoice=invoice, 
-                           items=items,
-                           subtotal=subtotal,
-                           cgst_amount=cgst_amount,
-                           sgst_amount=sgst_amount,
-                           invoice_date=invoice['formatted_date'],
-                           invoice_time=invoice['formatted_time'])
+    html = _render_receipt(invoice, items)
+    receipt_cache.put(invoice_id, html)
+    return html
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,476 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import date, datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+from cache import DASHBOARD_CACHE_STAMP, Generation
+from db import SHOP_TIMEZONE
+from partitions import (PARTITION_LOCK_ID, PARTITION_LOCK_TIMEOUT, PARTITIONED_TABLES, add_months, current_month,
+                        list_partitions, partition_name)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Each archived month is a directory of gzip CSV files, one per table, plus
+# a manifest with their columns, row counts and SHA-256 checksums.
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+# Months younger than this stay in the database.
+ARCHIVE_KEEP_MONTHS = int(os.environ.get('ARCHIVE_KEEP_MONTHS', 24))
+# Detaching a month's partitions locks their parents exclusively; like
+# adding one (see partitions.py), it gives up after a short wait and retries.
+ARCHIVE_LOCK_ATTEMPTS = 10
+MANIFEST = 'manifest.json'
+
+
+class ArchiveError(Exception):
+    """An archive is missing, damaged or does not match the database."""
+
+
+def parse_month(text):
+    return date.fromisoformat(f"{text}-01")
+
+
+def month_dir(month):
+    return os.path.join(ARCHIVE_DIR, f"{month:%Y_%m}")
+
+
+def _bounds(cursor, month):
+    """The SQL range condition on created_on that matches ``month``'s partition."""
+    return cursor.mogrify("created_on >= %s::timestamp AT TIME ZONE %s AND created_on < %s::timestamp AT TIME ZONE %s",
+                          (month, SHOP_TIMEZONE, add_months(month, 1), SHOP_TIMEZONE)).decode()
+
+
+def _columns(cursor, table):
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# --- Reading archives ---
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _read(directory, entry):
+    """The decompressed contents of one archived table, checked against its manifest entry."""
+    path = os.path.join(directory, entry['file'])
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        raise ArchiveError(f"{path} is missing")
+    if hashlib.sha256(data).hexdigest() != entry['sha256']:
+        raise ArchiveError(f"{path} does not match its checksum")
+    try:
+        return gzip.decompress(data)
+    except (OSError, EOFError) as e:
+        raise ArchiveError(f"{path} is not a readable gzip file: {e}")
+
+
+def read_rows(directory, entry):
+    """Yields the rows of one archived table as dicts of strings (None for NULL)."""
+    reader = csv.reader(io.StringIO(_read(directory, entry).decode(), newline=''))
+    columns = next(reader)
+    for values in reader:
+        # The csv module reads NULL and '' alike; both come back as None.
+        yield {column: value or None for column, value in zip(columns, values)}
+
+
+def verify(directory):
+    """Checks every file of an archived month; returns the manifest."""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise ArchiveError(f"{directory} has no {MANIFEST}")
+    for table, entry in manifest['tables'].items():
+        # Records can span lines, so count them with a CSV reader; minus the header.
+        rows = sum(1 for _ in csv.reader(io.StringIO(_read(directory, entry).decode(), newline=''))) - 1
+        if rows != entry['rows']:
+            raise ArchiveError(f"{table} in {directory} holds {rows} rows, the manifest says {entry['rows']}")
+    return manifest
+
+
+def archived_directories():
+    """``(month, directory)`` of every month with a manifest under ARCHIVE_DIR, oldest first."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    found = []
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        directory = os.path.join(ARCHIVE_DIR, name)
+        try:
+            month = datetime.strptime(name, '%Y_%m').date()
+        except ValueError:
+            continue
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            found.append((month, directory))
+    return found
+
+
+# --- Archiving ---
+def _export(cursor, query, directory, name):
+    path = os.path.join(directory, f"{name}.csv.gz")
+    # mtime=0 keeps the file, and so its checksum, the same for the same rows.
+    with open(path, 'wb') as raw, gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as f:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+    rows = cursor.rowcount
+    _fsync(path)
+    with open(path, 'rb') as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    return {'file': os.path.basename(path), 'rows': rows, 'sha256': checksum}
+
+
+def _retry_on_lock(cursor, work, verbose):
+    """Runs ``work()`` under PARTITION_LOCK_TIMEOUT, undoing and retrying it when a lock is not granted in time."""
+    for attempt in range(1, ARCHIVE_LOCK_ATTEMPTS + 1):
+        cursor.execute("SAVEPOINT archive_lock")
+        try:
+            cursor.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+            work()
+            cursor.execute("RELEASE SAVEPOINT archive_lock")
+            return
+        except psycopg2.errors.LockNotAvailable:
+            cursor.execute("ROLLBACK TO SAVEPOINT archive_lock")
+            if attempt == ARCHIVE_LOCK_ATTEMPTS:
+                raise
+            if verbose:
+                print("  - the tables are busy; retrying")
+            time.sleep(attempt)
+
+
+def archive_month(conn, month, verbose=False):
+    """Moves ``month`` of invoices, invoice_items and sales to ARCHIVE_DIR.
+
+    The files are written and checked before the month's partitions are
+    dropped, in the same transaction, so the rows are never in neither place.
+    Returns the archived_months row, or None if there was nothing to archive.
+    """
+    cursor = conn.cursor()
+    directory = month_dir(month)
+    staging = directory + '.tmp'
+    try:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+        cursor.execute("SET LOCAL TimeZone = %s", (SHOP_TIMEZONE,))
+        cursor.execute("SELECT 1 FROM archived_months WHERE month = %s", (month,))
+        if cursor.fetchone():
+            conn.rollback()
+            return None
+        partitions = {table: partition_name(table, month) for table in PARTITIONED_TABLES}
+        cursor.execute("SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass(name) IS NULL", (list(partitions.values()),))
+        missing = [row[0] for row in cursor.fetchall()]
+        if len(missing) == len(partitions):
+            conn.rollback()
+            return None
+        if missing:
+            raise ArchiveError(f"cannot archive {month:%Y-%m}: {', '.join(missing)} missing")
+        # Nothing may change the month while it is written out.
+        cursor.execute(f"LOCK TABLE {', '.join(partitions.values())} IN SHARE MODE")
+
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        bounds = _bounds(cursor, month)
+        exports = {table: (name, f"SELECT {', '.join(_columns(cursor, name))} FROM {name}") for table, name in partitions.items()}
+        exports['checkout_keys'] = ('checkout_keys', f"SELECT {', '.join(_columns(cursor, 'checkout_keys'))} FROM checkout_keys WHERE {bounds}")
+        tables = {}
+        for table, (name, query) in exports.items():
+            tables[table] = _export(cursor, query, staging, table)
+            tables[table]['columns'] = _columns(cursor, name)
+        # Not restored; lets an audit name the products even after they were renamed or deleted.
+        tables['products'] = _export(cursor, f"""
+            SELECT id, name, category FROM products
+            WHERE id IN (SELECT product_id FROM {partitions['invoice_items']} UNION SELECT product_id FROM {partitions['sales']})
+        """, staging, 'products')
+        cursor.execute(f"""
+            SELECT (SELECT COALESCE(SUM(total_amount), 0) FROM {partitions['invoices']})
+                 + (SELECT COALESCE(SUM(total_price), 0) FROM {partitions['sales']})
+        """)
+        revenue = cursor.fetchone()[0]
+        manifest = {
+            'month': f"{month:%Y-%m}",
+            'timezone': SHOP_TIMEZONE,
+            'archived_on': datetime.now().astimezone().isoformat(timespec='seconds'),
+            'revenue': str(revenue),
+            'tables': tables,
+        }
+        with open(os.path.join(staging, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        _fsync(os.path.join(staging, MANIFEST))
+        verify(staging)
+
+        cursor.execute("""
+            INSERT INTO archived_months (month, invoice_count, item_count, sale_count, revenue, path)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING *
+        """, (month, tables['invoices']['rows'], tables['invoice_items']['rows'], tables['sales']['rows'], revenue, directory))
+        archived = cursor.fetchone()
+        cursor.execute(f"""
+            INSERT INTO archived_customer_totals (month, customer_id, spend, visits, first_visit, last_visit)
+            SELECT %s, customer_id, SUM(total_amount), COUNT(*), MIN(created_on), MAX(created_on)
+            FROM {partitions['invoices']} WHERE customer_id IS NOT NULL
+            GROUP BY customer_id
+        """, (month,))
+
+        def detach():
+            # Line items first: an invoice partition cannot be detached while rows still reference it.
+            for table in reversed(PARTITIONED_TABLES):
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partitions[table]}")
+            cursor.execute(f"DROP TABLE {', '.join(partitions.values())}")
+            cursor.execute(f"DELETE FROM checkout_keys WHERE {bounds}")
+
+        _retry_on_lock(cursor, detach, verbose)
+        # A directory left by an attempt that never committed is replaced.
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(staging, directory)
+        _fsync(ARCHIVE_DIR)
+        conn.commit()
+        Generation(DASHBOARD_CACHE_STAMP).bump()
+        return archived
+    except Exception:
+        conn.rollback()
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def closed_months(cursor, keep_months=ARCHIVE_KEEP_MONTHS):
+    """Months that still have partitions and are more than ``keep_months`` old."""
+    cutoff = add_months(current_month(cursor), -keep_months)
+    months = set()
+    for table in PARTITIONED_TABLES:
+        for name, _ in list_partitions(cursor, table):
+            month = datetime.strptime(name[-7:], '%Y_%m').date()
+            if month < cutoff:
+                months.add(month)
+    return sorted(months)
+
+
+# --- Restoring ---
+def restore_month(conn, month, verbose=False):
+    """Loads an archived month back into its partitions.
+
+    The rows are loaded into new tables first and attached as partitions at
+    the end, so the parent tables are only locked for the attach itself.
+    daily_sales and daily_product_sales already count the month. The files
+    are left where they are.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+        cursor.execute("SELECT path FROM archived_months WHERE month = %s", (month,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ArchiveError(f"{month:%Y-%m} is not archived")
+        directory = row[0]
+        manifest = verify(directory)
+        bounds = _bounds(cursor, month)
+
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, month)
+            cursor.execute("SELECT to_regclass(%s)", (name,))
+            if cursor.fetchone()[0] is not None:
+                raise ArchiveError(f"{name} already exists; drop it (it should be empty) and restore again")
+            cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+            # Proves the rows fit the partition, so attaching it skips that scan.
+            cursor.execute(f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK (created_on IS NOT NULL AND {bounds})")
+        for table in PARTITIONED_TABLES + ('checkout_keys',):
+            entry = manifest['tables'][table]
+            target = partition_name(table, month) if table in PARTITIONED_TABLES else table
+            cursor.copy_expert(f"COPY {target} ({', '.join(entry['columns'])}) FROM STDIN WITH (FORMAT csv, HEADER)",
+                               io.BytesIO(_read(directory, entry)))
+
+        def attach():
+            for table in PARTITIONED_TABLES:
+                name = partition_name(table, month)
+                cursor.execute(f"""
+                    ALTER TABLE {table} ATTACH PARTITION {name}
+                    FOR VALUES FROM (%s::timestamp AT TIME ZONE %s) TO (%s::timestamp AT TIME ZONE %s)
+                """, (month, SHOP_TIMEZONE, add_months(month, 1), SHOP_TIMEZONE))
+
+        _retry_on_lock(cursor, attach, verbose)
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, month)
+            cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds")
+        # Takes the month's archived_customer_totals with it.
+        cursor.execute("DELETE FROM archived_months WHERE month = %s", (month,))
+        conn.commit()
+        Generation(DASHBOARD_CACHE_STAMP).bump()
+        return {table: manifest['tables'][table]['rows'] for table in PARTITIONED_TABLES}
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# --- Searching ---
+def search(text=None, invoice_id=None, months=None):
+    """Yields ``(month, kind, row, lines)`` for archived invoices and manual sales that match.
+
+    ``text`` is matched, ignoring case, against customer, cashier and product
+    names. Reads only the archive files (each checked against its checksum),
+    never the database.
+    """
+    needle = text.casefold() if text else None
+
+    def matches(*values):
+        return needle is not None and any(value and needle in value.casefold() for value in values)
+
+    for month, directory in archived_directories():
+        if months and month not in months:
+            continue
+        manifest = read_manifest(directory)
+        tables = manifest['tables']
+        products = {row['id']: row['name'] for row in read_rows(directory, tables['products'])}
+        lines = {}
+        for item in read_rows(directory, tables['invoice_items']):
+            item['product_name'] = products.get(item['product_id'], f"product #{item['product_id']}")
+            lines.setdefault(item['invoice_id'], []).append(item)
+        for invoice in read_rows(directory, tables['invoices']):
+            items = lines.get(invoice['id'], [])
+            if (invoice_id is not None and invoice['id'] == str(invoice_id)) or \
+                    matches(invoice['customer_name'], invoice['cashier_username'], *(item['product_name'] for item in items)):
+                yield month, 'invoice', invoice, items
+        if invoice_id is None:
+            for sale in read_rows(directory, tables['sales']):
+                sale['product_name'] = products.get(sale['product_id'], f"product #{sale['product_id']}")
+                if matches(sale['customer_name'], sale['product_name']):
+                    yield month, 'sale', sale, []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move closed months of invoices and sales to compressed, checksummed archive files.")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--month', type=parse_month, metavar='YYYY-MM', help="archive only this month")
+    action.add_argument('--list', action='store_true', help="list the archived months")
+    action.add_argument('--verify', nargs='?', const='all', metavar='YYYY-MM', help="check the archive files against their checksums")
+    action.add_argument('--restore', type=parse_month, metavar='YYYY-MM', help="load an archived month back into the database")
+    action.add_argument('--search', metavar='TEXT', help="search the archive files by customer, cashier or product name (read-only)")
+    action.add_argument('--invoice', type=int, metavar='ID', help="print one archived invoice (read-only)")
+    parser.add_argument('--keep-months', type=int, default=ARCHIVE_KEEP_MONTHS,
+                        help=f"months to keep in the database besides the current one (default: {ARCHIVE_KEEP_MONTHS})")
+    parser.add_argument('--in-month', type=parse_month, action='append', metavar='YYYY-MM', help="limit --search to these months")
+    args = parser.parse_args()
+
+    # --- Read-only modes: the archive files alone ---
+    if args.search or args.invoice is not None:
+        found = 0
+        try:
+            for month, kind, row, items in search(args.search, args.invoice, args.in_month):
+                found += 1
+                when = row['created_on'][:16]
+                if kind == 'invoice':
+                    print(f"🧾 {month:%Y-%m} invoice #{row['id']} · {when} · {row['customer_name'] or '-'} · {row['payment_mode']} · "
+                          f"cashier {row['cashier_username']} · ₹{row['total_amount']}")
+                    for item in items:
+                        print(f"     {item['quantity']} × {item['product_name']} @ ₹{item['price_at_sale']} = ₹{item['line_total']}")
+                else:
+                    print(f"✍️  {month:%Y-%m} sale #{row['id']} · {when} · {row['customer_name'] or '-'} · {row['payment_mode'] or '-'} · "
+                          f"{row['quantity']} × {row['product_name']} · ₹{row['total_price']}")
+        except ArchiveError as e:
+            print(f"❌ {e}")
+            return 1
+        print(f"🔎 {found} match(es) in the archive.")
+        return 0
+    if args.verify:
+        directories = archived_directories()
+        if args.verify != 'all':
+            directories = [(month, directory) for month, directory in directories if month == parse_month(args.verify)]
+        if not directories:
+            print("❌ No archived months found.")
+            return 1
+        failed = 0
+        for month, directory in directories:
+            try:
+                verify(directory)
+                print(f"✅ {month:%Y-%m} is intact.")
+            except ArchiveError as e:
+                failed += 1
+                print(f"❌ {e}")
+        return 1 if failed else 0
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return 1
+    if args.keep_months < 1:
+        print("❌ --keep-months must be at least 1; the current month is never archived.")
+        return 1
+
+    conn = None
+    try:
+        conn = psycopg2.connect(db_url)
+        cursor = conn.cursor()
+        cursor.execute("SELECT to_regclass('archived_months')")
+        if cursor.fetchone()[0] is None:
+            print("❌ The archive tables do not exist yet; run migrate_db.py first.")
+            return 1
+
+        if args.list:
+            cursor.execute("SELECT month, invoice_count, item_count, sale_count, revenue, archived_on, path FROM archived_months ORDER BY month")
+            rows = cursor.fetchall()
+            for month, invoices, items, sales, revenue, archived_on, path in rows:
+                print(f"🗄️  {month:%Y-%m}: {invoices:,} invoices, {items:,} items, {sales:,} sales, ₹{revenue:,.2f} "
+                      f"(archived {archived_on:%Y-%m-%d} to {path})")
+            if not rows:
+                print("✅ No months are archived.")
+            conn.rollback()
+            return 0
+
+        if args.restore:
+            print(f"Restoring {args.restore:%Y-%m}...")
+            counts = restore_month(conn, args.restore, verbose=True)
+            print(f"✅ Restored {counts['invoices']:,} invoices, {counts['invoice_items']:,} items and {counts['sales']:,} sales.")
+            return 0
+
+        if args.month:
+            if args.month >= current_month(cursor):
+                print("❌ Only months that have ended can be archived.")
+                return 1
+            months = [args.month]
+        else:
+            months = closed_months(cursor, args.keep_months)
+        conn.rollback()
+        archived = 0
+        for month in months:
+            print(f"Archiving {month:%Y-%m}...")
+            row = archive_month(conn, month, verbose=True)
+            if row is None:
+                print("  - already archived or nothing to archive")
+                continue
+            archived += 1
+            print(f"  - {row[1]:,} invoices, {row[2]:,} items and {row[3]:,} sales written to {row[5]}")
+        print(f"✅ Archived {archived} month(s).")
+        return 0
+
+    except ArchiveError as e:
+        print(f"❌ {e}")
+        return 1
+    except psycopg2.Error as e:
+        print(f"❌ Archiving failed: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+from db import SHOP_TIMEZONE
+from migrate_db import migrate
+
+# Load environment variables from .env file
+load_dotenv()
+
+def backfill(cursor):
+    """Rebuilds the daily rollups and customer totals from the invoice history still in the database."""
+    # Checkouts add to the rollups through queued jobs (see jobs.py). Holding
+    # new invoices back until commit and dropping the jobs of the invoices
+    # already written means each invoice is counted exactly once: here, or
+    # by a job queued after this transaction. A worker applying a batch right
+    # now finishes before its jobs can be deleted.
+    cursor.execute("LOCK TABLE invoices IN SHARE MODE")
+    cursor.execute("DELETE FROM job_queue WHERE kind = 'checkout_rollups'")
+    # Archived months (see archive.py) have no invoices left to rebuild from.
+    cursor.execute("DELETE FROM daily_sales WHERE date_trunc('month', sale_date)::date NOT IN (SELECT month FROM archived_months)")
+    cursor.execute("DELETE FROM daily_product_sales WHERE date_trunc('month', sale_date)::date NOT IN (SELECT month FROM archived_months)")
+
+    cursor.execute("""
+        INSERT INTO daily_sales (sale_date, total_revenue, invoice_count, items_sold)
+        SELECT (i.created_on AT TIME ZONE %s)::date,
+               SUM(i.total_amount),
+               COUNT(*),
+               COALESCE(SUM(items.quantity), 0)
+        FROM invoices i
+        LEFT JOIN (
+            SELECT invoice_id, SUM(quantity) AS quantity FROM invoice_items GROUP BY invoice_id
+        ) items ON items.invoice_id = i.id
+        GROUP BY 1
+    """, (SHOP_TIMEZONE,))
+    days = cursor.rowcount
+
+    cursor.execute("""
+        INSERT INTO daily_product_sales (sale_date, product_id, quantity, revenue)
+        SELECT (ii.created_on AT TIME ZONE %s)::date, ii.product_id, SUM(ii.quantity), SUM(ii.line_total)
+        FROM invoice_items ii
+        GROUP BY 1, 2
+    """, (SHOP_TIMEZONE,))
+    product_days = cursor.rowcount
+    return days, product_days, backfill_customers(cursor)
+
+def backfill_customers(cursor):
+    """Links every invoice to its customer and recomputes the customers' totals.
+
+    Runs inside backfill(), whose lock and job cleanup it relies on.
+    """
+    # The most recent spelling of a name becomes the customer's display name.
+    cursor.execute("""
+        INSERT INTO customers (name_key, display_name)
+        SELECT DISTINCT ON (customer_name_key(customer_name)) customer_name_key(customer_name), regexp_replace(btrim(customer_name), '\\s+', ' ', 'g')
+        FROM invoices
+        WHERE customer_name_key(customer_name) <> ''
+        ORDER BY customer_name_key(customer_name), created_on DESC
+        ON CONFLICT (name_key) DO UPDATE SET display_name = EXCLUDED.display_name
+    """)
+    cursor.execute("""
+        UPDATE invoices i SET customer_id = c.id
+        FROM customers c
+        WHERE c.name_key = customer_name_key(i.customer_name) AND i.customer_id IS DISTINCT FROM c.id
+    """)
+    cursor.execute("""
+        UPDATE customers c SET
+            lifetime_spend = t.spend, visit_count = t.visits, first_visit = t.first_visit, last_visit = t.last_visit
+        FROM (
+            SELECT c.id, COALESCE(SUM(v.spend), 0) AS spend, COALESCE(SUM(v.visits), 0) AS visits,
+                   MIN(v.first_visit) AS first_visit, MAX(v.last_visit) AS last_visit
+            FROM customers c LEFT JOIN (
+                SELECT customer_id, total_amount AS spend, 1 AS visits, created_on AS first_visit, created_on AS last_visit FROM invoices
+                UNION ALL
+                SELECT customer_id, spend, visits, first_visit, last_visit FROM archived_customer_totals
+            ) v ON v.customer_id = c.id
+            GROUP BY c.id
+        ) t
+        WHERE t.id = c.id
+    """)
+    return cursor.rowcount
+
+def main():
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return
+
+    conn = None
+    try:
+        conn = psycopg2.connect(db_url)
+
+        print("Bringing the schema up to date...")
+        migrate(conn)
+        cursor = conn.cursor()
+
+        print("Rebuilding daily rollups and customer totals from invoices...")
+        days, product_days, customers = backfill(cursor)
+        conn.commit()
+        print(f"✅ Rebuilt {days} daily totals, {product_days} daily product totals and {customers} customers.")
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        print(f"❌ Backfill failed: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+# Must be set before app is imported so in-process runs report query counts.
+os.environ.setdefault('QUERY_COUNT_HEADER', '1')
+
+from app import app  # noqa: E402
+
+BENCH_USER = {'username': 'Admin', 'role': 'admin'}
+
+
+# --- Transports ---
+class ClientTransport:
+    """Drives the app in-process through Flask's test client (one per thread)."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = app.test_client()
+            with client.session_transaction() as session:
+                session.update(BENCH_USER)
+        return client
+
+    def request(self, method, path, data=None):
+        response = self._client().open(path, method=method, data=data)
+        body = response.get_data()
+        return response.status_code, response.headers, body
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpTransport:
+    """Drives a running server (e.g. a local gunicorn) over HTTP.
+
+    Instead of logging in, which the app allows only once per user, it signs a
+    session cookie with the app's SECRET_KEY, so the server must share it.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie = f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps(dict(BENCH_USER))}"
+        self._opener = urllib.request.build_opener(_NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers={'Cookie': self.cookie})
+        try:
+            with self._opener.open(req) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+# --- Scenarios ---
+# Each scenario returns (method, path, form data, expected status, expected
+# Location prefix or None) for one request.
+def _report_range():
+    end = date.today()
+    return (end - timedelta(days=30)).isoformat(), end.isoformat()
+
+
+def scenario_checkout(rng, products):
+    cart = {}
+    for product in rng.sample(products, min(len(products), rng.randint(1, 3))):
+        cart[str(product['id'])] = {'name': product['name'], 'quantity': 1}
+    # A fresh key per request, as the till sends; seeded keys would repeat across runs.
+    form = {'customer_name': 'Benchmark', 'payment_mode': 'Cash', 'cart_data': json.dumps(cart),
+            'idempotency_key': str(uuid.uuid4())}
+    return 'POST', '/checkout', form, 302, '/receipt/'
+
+
+SCENARIOS = {
+    'dashboard': lambda rng, products: ('GET', '/dashboard', None, 200, None),
+    'billing': lambda rng, products: ('GET', '/billing', None, 200, None),
+    'catalog': lambda rng, products: ('GET', '/api/catalog', None, 200, None),
+    'sales_report': lambda rng, products: ('GET', '/sales_report?' + urllib.parse.urlencode(
+        dict(zip(('start_date', 'end_date'), _report_range()))), None, 200, None),
+    'export_sales': lambda rng, products: ('GET', '/export_sales?format=csv', None, 200, None),
+    'checkout': scenario_checkout,
+    # Simultaneous checkouts of a single product, see run_contention().
+    'contention': None,
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_scenario(transport, name, products, requests, concurrency, warmup, seed):
+    make_request = SCENARIOS[name]
+    rng_lock = threading.Lock()
+    rng = random.Random(seed)
+
+    def one():
+        with rng_lock:
+            method, path, data, status, location = make_request(rng, products)
+        started = time.perf_counter()
+        code, headers, body = transport.request(method, path, data)
+        elapsed = time.perf_counter() - started
+        ok = code == status and (location is None or location in headers.get('Location', ''))
+        queries = headers.get('X-Query-Count')
+        return elapsed, ok, int(queries) if queries is not None else None, len(body)
+
+    for _ in range(warmup):
+        one()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: one(), range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _, _ in results)
+    queries = [count for _, _, count, _ in results if count is not None]
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok, _, _ in results if not ok),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies),
+        'throughput_rps': requests / wall if wall else None,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+        'max_queries': max(queries) if queries else None,
+        'mean_response_bytes': sum(size for _, _, _, size in results) / len(results),
+    }
+
+
+def _catalog_stock(transport, product_id, since=None):
+    """Returns ``(stock, catalog version)``; with ``since``, from the delta feed.
+
+    The full catalog leaves out sold-out products, the delta feed does not.
+    """
+    path = '/api/catalog' + (f'?since={since}' if since is not None else '')
+    status, _, body = transport.request('GET', path)
+    if status == 304:
+        return None, since
+    catalog = json.loads(body)
+    stock = next((p['stock'] for p in catalog['products'] if p['id'] == product_id), None)
+    return stock, catalog['version']
+
+
+def run_contention(transport, products, requests):
+    """Fires ``requests`` checkouts of the same product at once and audits its stock.
+
+    Every checkout asks for enough units that only about half of them can be
+    served, so the run checks both sides of the stock reservation: the ones
+    that went through must account for exactly the stock that disappeared,
+    and the rest must be turned away rather than drive the stock negative.
+    """
+    product = max(products, key=lambda p: p['stock'])
+    stock_before, version = _catalog_stock(transport, product['id'])
+    quantity = max(1, stock_before // max(1, requests // 2))
+    cart = json.dumps({str(product['id']): {'name': product['name'], 'quantity': quantity}})
+    form = {'customer_name': 'Benchmark', 'payment_mode': 'Cash', 'cart_data': cart}
+    barrier = threading.Barrier(requests)
+
+    def one():
+        barrier.wait()
+        started = time.perf_counter()
+        code, headers, body = transport.request('POST', '/checkout', form)
+        elapsed = time.perf_counter() - started
+        queries = headers.get('X-Query-Count')
+        return elapsed, code, headers.get('Location', ''), int(queries) if queries is not None else None, len(body)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=requests) as pool:
+        results = list(pool.map(lambda _: one(), range(requests)))
+    wall = time.perf_counter() - started
+    stock_after, _ = _catalog_stock(transport, product['id'], since=version)
+    if stock_after is None:
+        # Unchanged since the first read: nothing was sold.
+        stock_after = stock_before
+
+    sold = sum(1 for _, code, location, _, _ in results if code == 302 and '/receipt/' in location)
+    rejected = sum(1 for _, code, location, _, _ in results if code == 302 and '/billing' in location)
+    latencies = sorted(elapsed * 1000 for elapsed, _, _, _, _ in results)
+    queries = [count for _, _, _, count, _ in results if count is not None]
+    return {
+        'requests': requests,
+        'errors': requests - sold - rejected,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies),
+        'throughput_rps': requests / wall if wall else None,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+        'max_queries': max(queries) if queries else None,
+        'mean_response_bytes': sum(size for _, _, _, _, size in results) / len(results),
+        'product_id': product['id'],
+        'quantity': quantity,
+        'stock_before': stock_before,
+        'stock_after': stock_after,
+        'sold': sold,
+        'rejected': rejected,
+        # Overselling: stock went negative, or more left the shelf than was invoiced
+        # (or the other way round), or a till was turned away while stock remained.
+        'oversold': stock_after < 0 or stock_before - stock_after != sold * quantity
+                    or sold != min(requests, stock_before // quantity),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns the regressions of ``results`` against ``baseline`` as printable lines."""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if previous.get(metric) and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {previous[metric]:.1f} -> {current[metric]:.1f}")
+        if previous.get('throughput_rps') and current['throughput_rps'] < previous['throughput_rps'] * (1 - threshold):
+            regressions.append(f"{name}: throughput {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} req/s")
+        # Query counts are deterministic, so any increase is a regression.
+        if previous.get('queries_per_request') is not None and current['queries_per_request'] is not None \
+                and current['queries_per_request'] > previous['queries_per_request'] + 0.01:
+            regressions.append(f"{name}: queries/request {previous['queries_per_request']:.1f} -> {current['queries_per_request']:.1f}")
+        if current.get('oversold'):
+            regressions.append(f"{name}: stock does not match the checkouts that went through")
+        if current['errors'] > previous.get('errors', 0):
+            regressions.append(f"{name}: errors {previous.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot routes against a seeded database (see generate_data.py).")
+    parser.add_argument('--url', help="benchmark a running server (start it with QUERY_COUNT_HEADER=1) instead of the in-process test client")
+    parser.add_argument('--scenarios', default='dashboard,billing,catalog,sales_report,export_sales,checkout',
+                        help=f"comma-separated list from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per scenario (default: 200)")
+    parser.add_argument('--export-requests', type=int, default=10, help="measured requests for export_sales (default: 10)")
+    parser.add_argument('--contention-requests', type=int, default=50,
+                        help="simultaneous checkouts of one product in the contention scenario (default: 50)")
+    parser.add_argument('--concurrency', type=int, default=4, help="concurrent clients (default: 4)")
+    parser.add_argument('--warmup', type=int, default=5, help="unmeasured requests per scenario (default: 5)")
+    parser.add_argument('--seed', type=int, default=42, help="random seed for checkout carts (default: 42)")
+    parser.add_argument('--output', default='benchmark-results.json', help="where to write the JSON results")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown before flagging, 0.2 = 20%% (default)")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"❌ Unknown scenarios: {', '.join(unknown)}")
+        return 2
+
+    transport = HttpTransport(args.url) if args.url else ClientTransport()
+    status, _, body = transport.request('GET', '/api/catalog')
+    if status != 200:
+        print(f"❌ Could not load the product catalog (HTTP {status}). Is the database seeded?")
+        return 2
+    # Well-stocked products only, so checkouts do not fail halfway through the run.
+    products = [p for p in json.loads(body)['products'] if p['stock'] >= 50] or json.loads(body)['products']
+
+    results = {
+        'meta': {
+            'mode': 'http' if args.url else 'test_client',
+            'url': args.url,
+            'concurrency': args.concurrency,
+            'revision': _git_revision(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'catalog_size': len(products),
+        },
+        'scenarios': {},
+    }
+    print(f"{'scenario':<14} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}")
+    for name in names:
+        if name == 'contention':
+            stats = run_contention(transport, products, args.contention_requests)
+        else:
+            count = args.export_requests if name == 'export_sales' else args.requests
+            stats = run_scenario(transport, name, products, count, args.concurrency, args.warmup, args.seed)
+        results['scenarios'][name] = stats
+        queries = f"{stats['queries_per_request']:.1f}" if stats['queries_per_request'] is not None else '-'
+        print(f"{name:<14} {stats['requests']:>5} {stats['errors']:>4} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+              f"{stats['p99_ms']:>8.1f} {stats['throughput_rps']:>8.1f} {queries:>8}")
+        if name == 'contention':
+            verdict = '❌ oversold' if stats['oversold'] else '✅ no overselling'
+            print(f"{'':<14} {verdict}: {stats['sold']} sold, {stats['rejected']} turned away, "
+                  f"stock {stats['stock_before']} -> {stats['stock_after']} ({stats['quantity']} per checkout)")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✅ Results written to {args.output}")
+    if any(stats.get('oversold') for stats in results['scenarios'].values()):
+        print("❌ Stock does not match the checkouts that went through.")
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) against {args.baseline}:")
+            for line in regressions:
+                print(f"   - {line}")
+            return 1
+        print(f"✅ No regressions against {args.baseline} (threshold {args.threshold:.0%}).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
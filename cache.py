@@ -0,0 +1,194 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class Generation:
+    """A change counter shared by every worker process on the host.
+
+    Bumping it touches a stamp file; readers compare the file's mtime with the
+    value they saw when they filled their cache. A stat() is far cheaper than
+    a database round trip and lets one gunicorn worker invalidate all others.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = 0
+
+    def current(self):
+        try:
+            return (os.stat(self.path).st_mtime_ns, self._local)
+        except OSError:
+            return (0, self._local)
+
+    def bump(self):
+        self._local += 1
+        try:
+            with open(self.path, 'a'):
+                pass
+            os.utime(self.path, ns=(time.time_ns(), time.time_ns()))
+        except OSError:
+            # Without a writable stamp file only this worker is invalidated;
+            # the others fall back to their TTLs.
+            pass
+
+
+# Shared by app.py's dashboard cache and the scripts that change its figures
+# behind the app's back (archive.py).
+DASHBOARD_CACHE_STAMP = os.environ.get('DASHBOARD_CACHE_STAMP', os.path.join(tempfile.gettempdir(), 'pos-dashboard-cache.stamp'))
+
+
+class TTLCache:
+    """Caches one value per key, each with its own time-to-live.
+
+    Entries are dropped when their TTL expires or when the shared generation
+    moves on. A TTL of 0 disables caching for that key.
+    """
+
+    def __init__(self, ttls, default_ttl=60, generation=None):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.generation = generation
+        self._entries = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _current_generation(self):
+        return self.generation.current() if self.generation else None
+
+    def _count(self, key, outcome):
+        with self._lock:
+            counters = self._counters.setdefault(key, {'hits': 0, 'misses': 0})
+            counters[outcome] += 1
+
+    def get_or_load(self, key, loader, max_ttl=None):
+        """Returns the cached value for key, calling loader() on a miss.
+
+        ``max_ttl``, if given, is called after loading and may return a
+        shorter TTL for that value (e.g. one read from a lagging replica).
+        """
+        ttl = self.ttls.get(key, self.default_ttl)
+        generation = self._current_generation()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, entry_generation, value = entry
+            if expires_at > time.monotonic() and entry_generation == generation:
+                self._count(key, 'hits')
+                return value
+
+        self._count(key, 'misses')
+        value = loader()
+        if max_ttl is not None:
+            cap = max_ttl()
+            if cap is not None:
+                ttl = min(ttl, cap)
+        if ttl > 0:
+            # Stored under the generation read *before* loading, so an
+            # invalidation that races with the load still wins.
+            self._entries[key] = (time.monotonic() + ttl, generation, value)
+        return value
+
+    def invalidate(self):
+        self._entries.clear()
+        if self.generation:
+            self.generation.bump()
+
+    def stats(self):
+        with self._lock:
+            per_key = {key: dict(counters) for key, counters in self._counters.items()}
+        hits = sum(counters['hits'] for counters in per_key.values())
+        misses = sum(counters['misses'] for counters in per_key.values())
+        for key, counters in per_key.items():
+            counters['ttl'] = self.ttls.get(key, self.default_ttl)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'entries': len(self._entries),
+            'keys': per_key,
+        }
+
+
+class LRUCache:
+    """Keeps the most recently used values, bounded by count and total size.
+
+    ``sizeof(value)`` gives each value's weight in bytes. Whenever either
+    ``max_entries`` or ``max_bytes`` is exceeded the least recently used
+    entries are evicted. A shared ``generation`` works as in TTLCache: once it
+    moves on, every worker drops its entries.
+    """
+
+    def __init__(self, max_entries=500, max_bytes=8 * 1024 * 1024, sizeof=len, generation=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.generation = generation
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._seen_generation = generation.current() if generation else None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'rejected': 0}
+
+    def _sync_generation(self):
+        # Caller holds the lock.
+        if self.generation is None:
+            return
+        current = self.generation.current()
+        if current != self._seen_generation:
+            self._entries.clear()
+            self._bytes = 0
+            self._seen_generation = current
+
+    def get(self, key):
+        with self._lock:
+            self._sync_generation()
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._sync_generation()
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes or self.max_entries <= 0:
+                # Would evict everything else and still not fit.
+                self._stats['rejected'] += 1
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key=None):
+        """Drops ``key`` (or everything) here and, via the generation, in every worker."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._stats['invalidations'] += 1
+            if self.generation:
+                self.generation.bump()
+                self._seen_generation = self.generation.current()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -35,9 +35,11 @@ def main():
 
         # Get all tables in the public schema
         print("📂 Tables in the database:")
+        # Monthly partitions (see partitions.py) are shown as their parent table.
         cursor.execute("""
             SELECT table_name FROM information_schema.tables
             WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
+              AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = format('%I', table_name)::regclass)
             ORDER BY table_name;
         """)
         tables = [row['table_name'] for row in cursor.fetchall()]
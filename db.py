@@ -0,0 +1,354 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import errors, extensions
+from psycopg2.pool import PoolError
+
+# All timestamps are shown and bucketed in the shop's local time.
+SHOP_TIMEZONE = 'Asia/Kolkata'
+
+
+class QueryStats(threading.local):
+    """Statements executed by the current thread and the time spent in them.
+
+    reset() at the start of a request, read ``count`` and ``duration`` at the
+    end. Any statement slower than ``slow_threshold`` seconds is logged to
+    the ``pos.sql`` logger together with ``label`` (e.g. the route name);
+    set it on the class so that every thread sees it.
+    Rows fetched in batches from a named (server-side) cursor are not timed
+    separately from the statement that opened it.
+    """
+
+    slow_threshold = None
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, label=None):
+        self.label = label
+        self.count = 0
+        self.duration = 0.0
+
+    def record(self, query, elapsed):
+        self.count += 1
+        self.duration += elapsed
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            slow_query_log.warning("slow query (%.1f ms) in %s: %s", elapsed * 1000, self.label or '-', normalize_sql(query))
+
+
+slow_query_log = logging.getLogger('pos.sql')
+query_stats = QueryStats()
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(query):
+    """One line per statement shape: literals become ?, whitespace collapses.
+
+    Parameters are still %s placeholders at this point, so their values
+    never reach the log.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    return _WHITESPACE.sub(' ', _LITERALS.sub('?', query)).strip()
+
+
+_timed_cursor_classes = {}
+
+
+def _timed_cursor_class(base):
+    cls = _timed_cursor_classes.get(base)
+    if cls is None:
+        class TimedCursor(base):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    query_stats.record(query, time.perf_counter() - started)
+
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    query_stats.record(query, time.perf_counter() - started)
+
+            def copy_expert(self, sql, file, size=8192):
+                started = time.perf_counter()
+                try:
+                    return super().copy_expert(sql, file, size)
+                finally:
+                    query_stats.record(sql, time.perf_counter() - started)
+
+        TimedCursor.__name__ = f'Timed{base.__name__}'
+        cls = _timed_cursor_classes[base] = TimedCursor
+    return cls
+
+
+class TimedConnection(extensions.connection):
+    """A connection whose cursors, whatever their cursor_factory, feed query_stats."""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or extensions.cursor
+        kwargs['cursor_factory'] = _timed_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+
+# Failures that say nothing about the transaction itself: running it again
+# from the start, once the competing transaction has finished, will succeed.
+RETRYABLE_ERRORS = (errors.SerializationFailure, errors.DeadlockDetected, errors.LockNotAvailable)
+
+
+def run_transaction(conn, work, attempts=3, base_delay=0.02, max_delay=0.5, on_retry=None):
+    """Runs ``work()`` on ``conn`` and commits, retrying on RETRYABLE_ERRORS.
+
+    ``work`` must do all of its reads and writes inside the call, since a
+    retry starts over in a fresh transaction. Between attempts the sleep
+    doubles from ``base_delay`` (capped at ``max_delay``, with jitter so that
+    the tills that collided do not collide again). Any other exception rolls
+    back and propagates at once, as does the last retryable one.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            conn.commit()
+            return result
+        except RETRYABLE_ERRORS as e:
+            conn.rollback()
+            if attempt == attempts:
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+        except Exception:
+            conn.rollback()
+            raise
+
+
+class ConnectionPool:
+    """A per-process pool of PostgreSQL connections.
+
+    Unlike psycopg2's built-in pools this one keeps up to ``maxconn`` idle
+    connections around, blocks (up to ``timeout`` seconds) instead of failing
+    when every connection is in use, and pings connections that have been idle
+    for longer than ``ping_after`` seconds before handing them out.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10.0, ping_after=30.0, connect_timeout=None):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Called on first use and again in a forked child (e.g. a gunicorn worker
+        # started with --preload) so that processes never share sockets.
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._warmed = False
+        self._stats = {
+            'opened': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+            'timeouts': 0,
+        }
+
+    def _connect(self):
+        # The timezone is set once, as a startup parameter of the physical
+        # connection, so checkouts never pay an extra round trip for it.
+        extra = {'connect_timeout': self.connect_timeout} if self.connect_timeout else {}
+        conn = psycopg2.connect(self.dsn, options=f'-c TimeZone={SHOP_TIMEZONE}',
+                                connection_factory=TimedConnection, **extra)
+        with self._lock:
+            self._stats['opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._stats['discarded'] += 1
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - idle_since < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _warm(self):
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        for _ in range(self.minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def getconn(self):
+        """Check a healthy connection out of the pool, waiting if necessary."""
+        if self._pid != os.getpid():
+            self._reset()
+        if not self._warmed:
+            self._warm()
+
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise PoolError("connection pool exhausted")
+        waited = time.monotonic() - start
+
+        try:
+            conn = None
+            while conn is None:
+                try:
+                    candidate, idle_since = self._idle.pop()
+                except IndexError:
+                    conn = self._connect()
+                    break
+                if self._is_healthy(candidate, idle_since):
+                    conn = candidate
+                else:
+                    self._discard(candidate)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['in_use'] += 1
+            self._stats['checkouts'] += 1
+            self._stats['wait_time'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection, rolling back anything left uncommitted."""
+        if self._pid != os.getpid():
+            # Checked out before a fork; it belongs to the parent.
+            return
+        try:
+            if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)
+            else:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = len(self._idle)
+        stats['min_size'] = self.minconn
+        stats['max_size'] = self.maxconn
+        stats['avg_wait'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+
+class ReadReplica:
+    """Hands out connections to a streaming replica while it is current enough.
+
+    getconn() checks the replica on every checkout: it must be reachable,
+    at most ``max_lag`` seconds behind the primary and, if ``min_lsn`` is
+    given, past that point of the primary's WAL. Otherwise it returns None
+    and a reason, and the caller reads from the primary instead. A replica
+    that cannot be reached is left alone for ``retry_after`` seconds.
+    """
+
+    # Lag is 0 once everything received has been replayed; without a WAL
+    # receiver the replica cannot tell how far behind it is (NULL). A server
+    # that is not in recovery is a primary and never behind itself.
+    _CHECK = """
+        SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, true),
+               CASE WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN NULL
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM clock_timestamp() - pg_last_xact_replay_timestamp())
+               END
+    """
+
+    def __init__(self, pool, max_lag=5.0, retry_after=30.0):
+        self.pool = pool
+        self.max_lag = max_lag
+        self.retry_after = retry_after
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'replica': 0, 'stale': 0, 'lagging': 0, 'down': 0, 'busy': 0}
+
+    def _count(self, reason):
+        with self._lock:
+            self._stats[reason] += 1
+        return reason
+
+    def getconn(self, min_lsn=None):
+        """Returns ``(conn, 'replica')``, or ``(None, reason)`` with reason one of 'stale', 'lagging', 'down' or 'busy'."""
+        if time.monotonic() < self._down_until:
+            return None, self._count('down')
+        try:
+            conn = self.pool.getconn()
+        except PoolError:
+            return None, self._count('busy')
+        except psycopg2.Error:
+            self._down_until = time.monotonic() + self.retry_after
+            return None, self._count('down')
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(self._CHECK, (min_lsn,))
+                caught_up, lag = cursor.fetchone()
+            conn.rollback()
+        except psycopg2.Error:
+            # putconn() discards the broken connection.
+            self.pool.putconn(conn)
+            self._down_until = time.monotonic() + self.retry_after
+            return None, self._count('down')
+        if lag is None or lag > self.max_lag:
+            self.pool.putconn(conn)
+            return None, self._count('lagging')
+        if not caught_up:
+            self.pool.putconn(conn)
+            return None, self._count('stale')
+        return conn, self._count('replica')
+
+    def putconn(self, conn):
+        self.pool.putconn(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = {'routed': dict(self._stats)}
+        stats['down_for'] = max(0.0, self._down_until - time.monotonic())
+        stats['pool'] = self.pool.stats()
+        return stats
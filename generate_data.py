@@ -0,0 +1,283 @@
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash
+
+from backfill_rollups import backfill
+from migrate_db import migrate
+from partitions import ensure_partitions
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Generated timestamps are in shop time (Asia/Kolkata has no DST).
+SHOP_UTC_OFFSET = timezone(timedelta(hours=5, minutes=30))
+TAX_RATE = 0.18
+
+CATEGORIES = {
+    # category: (share of the menu, min price, max price)
+    'Appetizer': (0.30, 300, 1300),
+    'Main Dish': (0.35, 900, 2600),
+    'Beverage': (0.25, 150, 550),
+    'Dessert': (0.10, 250, 900),
+}
+STYLES = ['Classic', 'Smoked', 'Spiced', 'Charred', 'Truffle', 'Citrus', 'Herbed', 'Crispy', 'Braised',
+          'Roasted', 'Glazed', 'Stuffed', 'Grilled', 'Pan-Seared', 'Tandoori', 'Garlic', 'Honey', 'Chilli']
+DISHES = {
+    'Appetizer': ['Bruschetta', 'Kebab', 'Tacos', 'Carpaccio', 'Croquettes', 'Tikka', 'Arancini', 'Calamari', 'Samosa', 'Dumplings'],
+    'Main Dish': ['Risotto', 'Biryani', 'Lamb Rack', 'Duck Confit', 'Curry', 'Pasta', 'Sea Bass', 'Steak', 'Paella', 'Ramen'],
+    'Beverage': ['Lemonade', 'Cooler', 'Iced Tea', 'Spritzer', 'Smash', 'Fizz', 'Lassi', 'Cold Brew', 'Mojito', 'Shake'],
+    'Dessert': ['Tiramisu', 'Cheesecake', 'Panna Cotta', 'Brownie', 'Kulfi', 'Creme Brulee', 'Gulab Jamun', 'Tart', 'Sorbet', 'Mousse'],
+}
+FIRST_NAMES = ['Aarav', 'Ananya', 'Rohan', 'Priya', 'Kiran', 'Meera', 'Vikram', 'Sneha', 'Arjun', 'Divya', 'Rahul',
+               'Kavya', 'Nikhil', 'Pooja', 'Sanjay', 'Lakshmi', 'Farhan', 'Ayesha', 'John', 'Maria', 'Ken', 'Touka']
+LAST_NAMES = ['Sharma', 'Reddy', 'Iyer', 'Nair', 'Khan', 'Patel', 'Rao', 'Menon', 'Das', 'Gupta', 'Singh',
+              'Pillai', 'Joshi', 'Varma', 'Kaneki', 'Kirishima', 'Fernandes', 'Thomas', 'Bose', 'Kapoor']
+
+# Most bills are short: weights for 1..8 distinct products per invoice and
+# for a quantity of 1..4 per line.
+LINES_PER_INVOICE = [30, 25, 18, 11, 7, 4, 3, 2]
+QUANTITY_PER_LINE = [70, 20, 7, 3]
+# Open 10:00-23:00 with lunch and dinner peaks; busier at weekends (Mon=0).
+HOURLY_TRAFFIC = {10: 2, 11: 4, 12: 9, 13: 10, 14: 6, 15: 3, 16: 3, 17: 4, 18: 6, 19: 9, 20: 10, 21: 8, 22: 4}
+WEEKDAY_TRAFFIC = [0.8, 0.8, 0.85, 0.9, 1.1, 1.4, 1.3]
+PAYMENT_MODES = (['UPI', 'Card', 'Cash'], [50, 30, 20])
+WALK_IN_SHARE = 0.15
+# Share of bills that also get one of their lines rung up by hand on the
+# Sales page, which writes the sales table rather than an invoice.
+MANUAL_SALES_SHARE = 0.05
+
+
+def _cumulative(weights):
+    total, cumulative = 0, []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def _zipf_weights(n, s=1.1):
+    """Popularity falls off with rank: a few best-sellers, a long tail."""
+    return _cumulative(1 / (rank ** s) for rank in range(1, n + 1))
+
+
+def _copy(cursor, table, columns, rows):
+    """Streams ``rows`` into ``table`` with COPY ... FROM STDIN (text format).
+
+    Generated values never contain tabs, newlines or backslashes, so they
+    need no escaping.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if value is None else str(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def generate_products(rng, count):
+    names = set()
+    categories = list(CATEGORIES)
+    shares = _cumulative(CATEGORIES[c][0] for c in categories)
+    for category in rng.choices(categories, cum_weights=shares, k=count):
+        _, low, high = CATEGORIES[category]
+        name = f"{rng.choice(STYLES)} {rng.choice(DISHES[category])}"
+        # Menus this large need variants to keep names distinct.
+        while name in names:
+            name = f"{rng.choice(STYLES)} {rng.choice(DISHES[category])} No. {rng.randint(2, count)}"
+        names.add(name)
+        yield name, category, rng.randrange(low, high + 1, 10), rng.randint(50, 500)
+
+
+def generate_cashiers(count, offset):
+    # Hashing is deliberately slow, so every generated cashier shares one hash.
+    password = generate_password_hash('cashier123')
+    for n in range(offset + 1, offset + count + 1):
+        yield f"cashier_{n:05d}", password, 'user'
+
+
+def _day_counts(rng, total, start, days):
+    """Splits ``total`` invoices over the days, weighted by weekday and jittered."""
+    weights = [WEEKDAY_TRAFFIC[(start + timedelta(days=d)).weekday()] * rng.uniform(0.85, 1.15) for d in range(days)]
+    scale = total / sum(weights)
+    counts, carry = [], 0.0
+    for weight in weights:
+        exact = weight * scale + carry
+        counts.append(int(exact))
+        carry = exact - int(exact)
+    counts[-1] += total - sum(counts)
+    return counts
+
+
+def generate_invoices(rng, args, products, cashiers, customers, first_id):
+    """Yields ``(invoice, items)`` in chronological order with consecutive ids."""
+    product_weights = _zipf_weights(len(products))
+    # The best-sellers are spread over the menu rather than being the first rows.
+    ranked = products[:]
+    rng.shuffle(ranked)
+    customer_weights = _zipf_weights(len(customers), s=0.8)
+    cashier_weights = _zipf_weights(len(cashiers), s=0.5)
+    hours, hour_weights = list(HOURLY_TRAFFIC), _cumulative(HOURLY_TRAFFIC.values())
+    line_weights = _cumulative(LINES_PER_INVOICE)
+    quantity_weights = _cumulative(QUANTITY_PER_LINE)
+    payment_weights = _cumulative(PAYMENT_MODES[1])
+
+    start = args.end_date - timedelta(days=args.days - 1)
+    invoice_id = first_id
+    for offset, count in enumerate(_day_counts(rng, args.invoices, start, args.days)):
+        day = start + timedelta(days=offset)
+        seconds = sorted(
+            hour * 3600 + rng.randrange(3600)
+            for hour in rng.choices(hours, cum_weights=hour_weights, k=count)
+        )
+        for second in seconds:
+            created_on = datetime(day.year, day.month, day.day, tzinfo=SHOP_UTC_OFFSET) + timedelta(seconds=second)
+            line_count = rng.choices(range(1, len(LINES_PER_INVOICE) + 1), cum_weights=line_weights)[0]
+            chosen = {}
+            for product_id, price in rng.choices(ranked, cum_weights=product_weights, k=line_count):
+                chosen.setdefault(product_id, price)
+            items, subtotal = [], 0
+            for product_id, price in chosen.items():
+                quantity = rng.choices(range(1, len(QUANTITY_PER_LINE) + 1), cum_weights=quantity_weights)[0]
+                line_total = round(price * quantity, 2)
+                subtotal += line_total
+                items.append((product_id, quantity, f"{price:.2f}", f"{line_total:.2f}"))
+
+            customer = 'Walk-in' if rng.random() < WALK_IN_SHARE else rng.choices(customers, cum_weights=customer_weights)[0]
+            payment_mode = rng.choices(PAYMENT_MODES[0], cum_weights=payment_weights)[0]
+            cashier = rng.choices(cashiers, cum_weights=cashier_weights)[0]
+            total_amount = round(subtotal * (1 + TAX_RATE), 2)
+            yield (invoice_id, customer, payment_mode, f"{total_amount:.2f}", created_on.isoformat(), cashier), items
+            invoice_id += 1
+
+
+def load_invoices(conn, cursor, rng, args, products, cashiers, customers):
+    cursor.execute("LOCK TABLE invoices IN EXCLUSIVE MODE")
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM invoices")
+    first_id = cursor.fetchone()[0] + 1
+
+    invoices, invoice_items, sales = [], [], []
+    loaded = item_count = sale_count = 0
+    started = time.monotonic()
+    # A stream of its own, so --manual-sales does not change the invoices.
+    manual_rng = random.Random(args.seed + 1)
+
+    def flush():
+        _copy(cursor, 'invoices', ['id', 'customer_name', 'payment_mode', 'total_amount', 'created_on', 'cashier_username'], invoices)
+        _copy(cursor, 'invoice_items', ['invoice_id', 'created_on', 'product_id', 'quantity', 'price_at_sale', 'line_total'], invoice_items)
+        _copy(cursor, 'sales', ['product_id', 'quantity', 'total_price', 'customer_name', 'payment_mode', 'created_on'], sales)
+        invoices.clear()
+        invoice_items.clear()
+        sales.clear()
+
+    for invoice, items in generate_invoices(rng, args, products, cashiers, customers, first_id):
+        invoices.append(invoice)
+        invoice_id, customer, payment_mode, _, created_on, _ = invoice
+        for product_id, quantity, price, line_total in items:
+            invoice_items.append((invoice_id, created_on, product_id, quantity, price, line_total))
+        if manual_rng.random() < args.manual_sales:
+            product_id, quantity, _, line_total = manual_rng.choice(items)
+            sales.append((product_id, quantity, line_total, customer, payment_mode, created_on))
+            sale_count += 1
+        item_count += len(items)
+        loaded += 1
+        if len(invoices) >= args.batch_size:
+            flush()
+            conn.commit()
+            cursor.execute("LOCK TABLE invoices IN EXCLUSIVE MODE")
+            rate = loaded / (time.monotonic() - started)
+            print(f"   {loaded:,} / {args.invoices:,} invoices ({rate:,.0f}/s)")
+    if invoices:
+        flush()
+
+    cursor.execute("SELECT setval(pg_get_serial_sequence('invoices', 'id'), (SELECT MAX(id) FROM invoices))")
+    return loaded, item_count, sale_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the database with a large, reproducible synthetic dataset.")
+    parser.add_argument('--products', type=int, default=10000, help="products to add (default: 10000)")
+    parser.add_argument('--invoices', type=int, default=100000, help="invoices to add (default: 100000)")
+    parser.add_argument('--cashiers', type=int, default=50, help="cashier accounts to add (default: 50)")
+    parser.add_argument('--customers', type=int, default=20000, help="size of the returning-customer pool (default: 20000)")
+    parser.add_argument('--manual-sales', type=float, default=MANUAL_SALES_SHARE,
+                        help=f"share of invoices with a matching hand-entered sale (default: {MANUAL_SALES_SHARE})")
+    parser.add_argument('--days', type=int, default=365, help="days of history, ending at --end-date (default: 365)")
+    parser.add_argument('--end-date', type=date.fromisoformat, default=date.today(),
+                        help="last day of history, YYYY-MM-DD (default: today; fix it for identical reruns)")
+    parser.add_argument('--seed', type=int, default=42, help="random seed (default: 42)")
+    parser.add_argument('--batch-size', type=int, default=50000, help="invoices per COPY batch and commit (default: 50000)")
+    parser.add_argument('--truncate', action='store_true', help="delete all products, sales and invoices first")
+    args = parser.parse_args()
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return 1
+
+    rng = random.Random(args.seed)
+    conn = None
+    started = time.monotonic()
+    try:
+        conn = psycopg2.connect(db_url)
+        print("Bringing the schema up to date...")
+        migrate(conn)
+        cursor = conn.cursor()
+
+        if args.truncate:
+            print("Removing existing products, invoices and sales...")
+            # Queued rollup jobs belong to the invoices removed here.
+            cursor.execute("TRUNCATE invoice_items, invoices, checkout_keys, archived_customer_totals, archived_months, customers, sales, "
+                           "daily_sales, daily_product_sales, job_queue, product_tombstones, products RESTART IDENTITY CASCADE")
+            cursor.execute("DELETE FROM users WHERE username LIKE 'cashier\\_%'")
+
+        print(f"Generating {args.products:,} products...")
+        _copy(cursor, 'products', ['name', 'category', 'price', 'stock'], generate_products(rng, args.products))
+
+        cursor.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'cashier\\_%'")
+        print(f"Generating {args.cashiers:,} cashiers...")
+        _copy(cursor, 'users', ['username', 'password', 'role'], generate_cashiers(args.cashiers, cursor.fetchone()[0]))
+        conn.commit()
+
+        cursor.execute("SELECT id, price FROM products ORDER BY id")
+        products = [(product_id, float(price)) for product_id, price in cursor.fetchall()]
+        cursor.execute("SELECT username FROM users ORDER BY id")
+        cashiers = [row[0] for row in cursor.fetchall()]
+        customers = [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}" for _ in range(args.customers)]
+        if not products:
+            print("❌ There are no products to sell; use --products.")
+            return 1
+
+        print(f"Generating {args.invoices:,} invoices over {args.days} days...")
+        ensure_partitions(conn, first_month=args.end_date - timedelta(days=args.days - 1), last_month=args.end_date)
+        invoices, items, sales = load_invoices(conn, cursor, rng, args, products, cashiers, customers)
+        conn.commit()
+        print(f"✅ Loaded {invoices:,} invoices with {items:,} line items and {sales:,} manual sales.")
+
+        print("Rebuilding daily rollups, customers and planner statistics...")
+        backfill(cursor)
+        conn.commit()
+        conn.autocommit = True
+        cursor.execute("ANALYZE products, users, customers, invoices, invoice_items, sales, daily_sales, daily_product_sales")
+
+        print(f"✅ Done in {time.monotonic() - started:,.1f}s.")
+        return 0
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        print(f"❌ Data generation failed: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
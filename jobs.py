@@ -0,0 +1,312 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import DictCursor
+
+# Load environment variables from .env file
+load_dotenv()
+
+job_log = logging.getLogger('pos.jobs')
+
+
+class JobQueue:
+    """Work that may run after a transaction commits, queued in PostgreSQL.
+
+    defer() inserts the job in the caller's own transaction, so it exists
+    exactly when the work that asked for it was committed. Workers, either a
+    thread in every web process (ensure_started()) or a separate
+    ``python jobs.py`` process, claim due jobs with FOR UPDATE SKIP LOCKED.
+    They hand each kind's payloads to its handler in one batch and delete
+    the jobs in the same transaction. If a batch fails, its jobs are retried
+    one by one with exponential backoff. After ``max_attempts`` a job moves
+    to job_dead_letters. Maintenance registered with every() runs on the
+    same workers.
+
+    ``mode`` 'queue' always uses the job_queue table, 'inline' never does:
+    defer() then runs the handler at once in the caller's transaction. 'auto'
+    uses the table when the schema has it (migration 8).
+    """
+
+    def __init__(self, max_attempts=5, batch_size=100, interval=1.0, base_delay=2.0, max_delay=300.0, mode='auto'):
+        self.mode = mode
+        self._table_exists = None
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._handlers = {}
+        self._committed = {}
+        self._periodic = []
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {'processed': defaultdict(int), 'retried': defaultdict(int), 'dead_lettered': defaultdict(int)}
+        self._depth = {'queued': 0, 'oldest_age': 0.0, 'dead_letters': 0}
+
+    def register(self, kind, handler, committed=None):
+        """``handler(cursor, payloads)`` applies a batch of ``kind`` jobs in the worker's transaction.
+
+        ``committed(payloads)``, if given, runs once that transaction has committed.
+        """
+        self._handlers[kind] = handler
+        if committed is not None:
+            self._committed[kind] = committed
+
+    def every(self, seconds, task):
+        """Has the worker call ``task(conn)`` when it starts and about every ``seconds`` after.
+
+        Every process's worker does, so ``task`` must tolerate running concurrently.
+        """
+        self._periodic.append({'task': task, 'seconds': seconds, 'due': 0.0})
+
+    def queued(self, cursor):
+        """Whether defer() queues jobs, rather than running them inline."""
+        if self.mode != 'auto':
+            return self.mode == 'queue'
+        if self._table_exists is None:
+            cursor.execute("SELECT to_regclass('job_queue') IS NOT NULL")
+            self._table_exists = cursor.fetchone()[0]
+        return self._table_exists
+
+    def defer(self, cursor, kind, payload):
+        if self.queued(cursor):
+            cursor.execute("INSERT INTO job_queue (kind, payload) VALUES (%s, %s)", (kind, json.dumps(payload)))
+        else:
+            # Now, in the caller's transaction, on the payload as a worker would
+            # read it back. The caller knows when it commits; no hook runs.
+            self._handlers[kind](cursor, [json.loads(json.dumps(payload))])
+
+    def wake(self):
+        """Lets this process's worker look for new jobs now instead of at its next poll."""
+        self._wake.set()
+
+    # --- Processing ---
+    def _count(self, counter, kind, value=1):
+        with self._lock:
+            self._stats[counter][kind] += value
+
+    def _handle(self, cursor, jobs):
+        by_kind = defaultdict(list)
+        for job in jobs:
+            by_kind[job['kind']].append(job['payload'])
+        for kind, payloads in by_kind.items():
+            handler = self._handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"no handler registered for job kind {kind!r}")
+            handler(cursor, payloads)
+        cursor.execute("DELETE FROM job_queue WHERE id = ANY(%s)", ([job['id'] for job in jobs],))
+
+    def run_once(self, conn):
+        """Runs one batch of due jobs; returns how many were claimed."""
+        cursor = conn.cursor(cursor_factory=DictCursor)
+        cursor.execute("""
+            SELECT id, kind, payload, attempts FROM job_queue
+            WHERE run_after <= CURRENT_TIMESTAMP
+            ORDER BY run_after, id LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (self.batch_size,))
+        jobs = cursor.fetchall()
+        if not jobs:
+            conn.rollback()
+            return 0
+        try:
+            self._handle(cursor, jobs)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # Isolate the job that broke the batch; the others go through.
+            for job in jobs:
+                self._run_single(conn, job['id'])
+        else:
+            self._done(jobs)
+        return len(jobs)
+
+    def _done(self, jobs):
+        by_kind = defaultdict(list)
+        for job in jobs:
+            by_kind[job['kind']].append(job['payload'])
+            self._count('processed', job['kind'])
+        for kind, payloads in by_kind.items():
+            committed = self._committed.get(kind)
+            if committed is not None:
+                try:
+                    committed(payloads)
+                except Exception:
+                    job_log.exception("post-commit hook for %s jobs failed", kind)
+
+    def _run_single(self, conn, job_id):
+        cursor = conn.cursor(cursor_factory=DictCursor)
+        cursor.execute("SELECT id, kind, payload, attempts FROM job_queue WHERE id = %s FOR UPDATE SKIP LOCKED", (job_id,))
+        job = cursor.fetchone()
+        if job is None:
+            conn.rollback()
+            return
+        try:
+            self._handle(cursor, [job])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            self._fail(conn, job, e)
+        else:
+            self._done([job])
+
+    def _fail(self, conn, job, error):
+        attempts = job['attempts'] + 1
+        message = f"{type(error).__name__}: {error}"
+        cursor = conn.cursor()
+        if attempts >= self.max_attempts:
+            job_log.error("job %s (%s) failed %d times, moved to job_dead_letters: %s", job['id'], job['kind'], attempts, message)
+            cursor.execute("""
+                INSERT INTO job_dead_letters (id, kind, payload, attempts, last_error, enqueued_on)
+                SELECT id, kind, payload, %s, %s, enqueued_on FROM job_queue WHERE id = %s
+            """, (attempts, message, job['id']))
+            cursor.execute("DELETE FROM job_queue WHERE id = %s", (job['id'],))
+            self._count('dead_lettered', job['kind'])
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            job_log.warning("job %s (%s) failed, retrying in %.0fs: %s", job['id'], job['kind'], delay, message)
+            cursor.execute("""
+                UPDATE job_queue SET attempts = %s, last_error = %s,
+                    run_after = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                WHERE id = %s
+            """, (attempts, message, delay, job['id']))
+            self._count('retried', job['kind'])
+        conn.commit()
+
+    def _run_periodic(self, conn):
+        for entry in self._periodic:
+            now = time.monotonic()
+            if entry['due'] > now:
+                continue
+            entry['due'] = now + entry['seconds']
+            try:
+                entry['task'](conn)
+            except Exception:
+                conn.rollback()
+                job_log.exception("periodic task %s failed", entry['task'].__name__)
+
+    def _refresh_depth(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*), COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(enqueued_on)), 0),
+                   (SELECT COUNT(*) FROM job_dead_letters)
+            FROM job_queue
+        """)
+        queued, oldest_age, dead_letters = cursor.fetchone()
+        conn.rollback()
+        with self._lock:
+            self._depth = {'queued': queued, 'oldest_age': float(oldest_age), 'dead_letters': dead_letters}
+
+    def run_pending(self, pool):
+        """Runs batches until nothing is due; returns the number of jobs claimed."""
+        conn = pool.getconn()
+        try:
+            total = 0
+            queued = self.queued(conn.cursor())
+            conn.rollback()
+            while queued:
+                claimed = self.run_once(conn)
+                total += claimed
+                if not claimed:
+                    break
+            self._run_periodic(conn)
+            if queued:
+                self._refresh_depth(conn)
+            return total
+        finally:
+            pool.putconn(conn)
+
+    def run_forever(self, pool):
+        while True:
+            self._wake.clear()
+            try:
+                self.run_pending(pool)
+            except Exception:
+                # The database is unreachable or the pool exhausted; jobs wait.
+                job_log.exception("job worker round failed")
+            self._wake.wait(self.interval)
+
+    def ensure_started(self, pool):
+        """Starts this process's worker thread (again after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self.run_forever, args=(pool,), name='job-worker', daemon=True).start()
+
+    def stats(self):
+        """Jobs handled by this process, plus the queue depth seen at its last poll."""
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+            stats.update(self._depth)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the background job worker outside the web processes.")
+    parser.add_argument('--once', action='store_true', help="run every due job, then exit (e.g. from cron)")
+    parser.add_argument('--status', action='store_true', help="print the queue depth and dead letters, change nothing")
+    parser.add_argument('--requeue-dead', action='store_true', help="move every dead-lettered job back to the queue")
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return 1
+
+    # The handlers live with the code that defers the jobs.
+    from app import db_pool, job_queue
+
+    conn = db_pool.getconn()
+    try:
+        cursor = conn.cursor()
+        if args.requeue_dead:
+            cursor.execute("""
+                WITH moved AS (DELETE FROM job_dead_letters RETURNING kind, payload, enqueued_on)
+                INSERT INTO job_queue (kind, payload, enqueued_on) SELECT kind, payload, enqueued_on FROM moved
+            """)
+            conn.commit()
+            print(f"✅ Requeued {cursor.rowcount} dead-lettered job(s).")
+            return 0
+        if args.status:
+            cursor.execute("SELECT kind, COUNT(*), MIN(enqueued_on) FROM job_queue GROUP BY kind ORDER BY kind")
+            queued = cursor.fetchall()
+            cursor.execute("SELECT kind, COUNT(*), MAX(failed_on) FROM job_dead_letters GROUP BY kind ORDER BY kind")
+            dead = cursor.fetchall()
+            conn.rollback()
+            for kind, count, oldest in queued:
+                print(f"⏳ {kind}: {count} queued, oldest from {oldest:%Y-%m-%d %H:%M:%S}")
+            for kind, count, latest in dead:
+                print(f"💀 {kind}: {count} dead-lettered, latest at {latest:%Y-%m-%d %H:%M:%S}")
+            if not queued and not dead:
+                print("✅ The job queue is empty.")
+            return 0
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"❌ Database error: {e}")
+        return 1
+    finally:
+        db_pool.putconn(conn)
+
+    if args.once:
+        print(f"✅ Ran {job_queue.run_pending(db_pool)} job(s).")
+        return 0
+    print("👷 Job worker running (Ctrl+C to stop)...")
+    try:
+        job_queue.run_forever(db_pool)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
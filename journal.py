@@ -0,0 +1,204 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+journal_log = logging.getLogger('pos.journal')
+
+
+class JournalRejected(Exception):
+    """Raised by a drain handler for an entry that can never be applied (e.g. out of stock)."""
+
+
+class JournalUnavailable(Exception):
+    """Raised by a drain handler that could not try the entry at all (e.g. the database is down)."""
+
+
+class CheckoutJournal:
+    """A durable, local, append-only queue of checkouts waiting for PostgreSQL.
+
+    Entries live in a SQLite file (WAL, synchronous=FULL, so an acknowledged
+    enqueue survives a crash) and are keyed by the checkout's idempotency
+    key, so enqueueing the same checkout twice keeps the first. One thread
+    per process drains them oldest first; a lock file makes sure only one
+    process at a time does, so entries reach PostgreSQL in the order they
+    were taken. A failed attempt stops the drain, leaving the entry and
+    everything queued after it until the entry is retried, after a delay
+    that doubles from ``base_delay`` up to ``max_delay``. An entry that
+    fails ``max_attempts`` times is marked failed, so the entries behind it
+    are not held up for good; JournalUnavailable does not count as an attempt.
+    """
+
+    def __init__(self, path, interval=1.0, retention=7 * 24 * 3600, max_attempts=8, base_delay=1.0, max_delay=300.0):
+        self.path = path
+        self.interval = interval
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._wake = threading.Event()
+        self._pid = None
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=FULL")
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS checkouts (
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            idempotency_key TEXT NOT NULL UNIQUE,
+                            payload TEXT NOT NULL,
+                            status TEXT NOT NULL DEFAULT 'pending',
+                            invoice_id INTEGER,
+                            error TEXT,
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            queued_at REAL NOT NULL,
+                            drained_at REAL,
+                            retry_at REAL
+                        )
+                    """)
+                    # Journals written before entries had a retry delay.
+                    columns = {row['name'] for row in conn.execute("PRAGMA table_info(checkouts)")}
+                    if 'retry_at' not in columns:
+                        conn.execute("ALTER TABLE checkouts ADD COLUMN retry_at REAL")
+                    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkouts_pending ON checkouts (status, seq)")
+                    self._initialized = True
+        return conn
+
+    @staticmethod
+    def _entry(row):
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['payload'] = json.loads(entry['payload'])
+        return entry
+
+    # --- Queue ---
+    def enqueue(self, key, payload):
+        """Stores a checkout; returns its entry (the earlier one for a repeated key)."""
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR IGNORE INTO checkouts (idempotency_key, payload, queued_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(payload), time.time()))
+            entry = self._entry(conn.execute("SELECT * FROM checkouts WHERE idempotency_key = ?", (key,)).fetchone())
+        finally:
+            conn.close()
+        self._wake.set()
+        return entry
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            return self._entry(conn.execute("SELECT * FROM checkouts WHERE idempotency_key = ?", (key,)).fetchone())
+        finally:
+            conn.close()
+
+    def _update(self, seq, **values):
+        conn = self._connect()
+        try:
+            assignments = ', '.join(f"{column} = ?" for column in values)
+            conn.execute(f"UPDATE checkouts SET {assignments} WHERE seq = ?", (*values.values(), seq))
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM checkouts GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(queued_at) FROM checkouts WHERE status = 'pending'").fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            'pending': counts.get('pending', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending_age': time.time() - oldest if oldest is not None else 0.0,
+        }
+
+    # --- Draining ---
+    def drain(self, handle, limit=100):
+        """Applies pending entries in order with ``handle(key, payload)``.
+
+        ``handle`` returns the invoice id, or raises JournalRejected to mark
+        the entry failed. Returns the number of entries handled, or None if
+        another process holds the drain lock.
+        """
+        with open(self.path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            handled = 0
+            while True:
+                conn = self._connect()
+                try:
+                    rows = conn.execute("SELECT * FROM checkouts WHERE status = 'pending' ORDER BY seq LIMIT ?", (limit,)).fetchall()
+                finally:
+                    conn.close()
+                if not rows:
+                    break
+                for entry in map(self._entry, rows):
+                    if entry['retry_at'] is not None and entry['retry_at'] > time.time():
+                        # Keep the order: nothing behind this entry goes first.
+                        return handled
+                    attempts = entry['attempts'] + 1
+                    try:
+                        invoice_id = handle(entry['idempotency_key'], entry['payload'])
+                    except JournalRejected as e:
+                        journal_log.warning("checkout %s rejected: %s", entry['idempotency_key'], e)
+                        self._update(entry['seq'], status='failed', error=str(e), attempts=attempts, drained_at=time.time())
+                    except JournalUnavailable as e:
+                        journal_log.warning("checkout %s waits for the database: %s", entry['idempotency_key'], e)
+                        self._update(entry['seq'], error=str(e))
+                        return handled
+                    except Exception as e:
+                        if attempts < self.max_attempts:
+                            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                            journal_log.warning("checkout %s failed, retrying in %.0fs: %s", entry['idempotency_key'], delay, e)
+                            self._update(entry['seq'], error=str(e), attempts=attempts, retry_at=time.time() + delay)
+                            return handled
+                        journal_log.error("checkout %s failed %d times, marked failed: %s", entry['idempotency_key'], attempts, e)
+                        self._update(entry['seq'], status='failed', error=f"gave up after {attempts} attempts: {e}",
+                                     attempts=attempts, drained_at=time.time())
+                    else:
+                        self._update(entry['seq'], status='done', invoice_id=invoice_id, error=None,
+                                     attempts=entry['attempts'] + 1, drained_at=time.time())
+                    handled += 1
+            self._prune()
+            return handled
+
+    def _prune(self):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM checkouts WHERE status = 'done' AND drained_at < ?", (time.time() - self.retention,))
+        finally:
+            conn.close()
+
+    def ensure_started(self, handle):
+        """Starts this process's drain thread (again after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._init_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(handle,), name='checkout-journal', daemon=True).start()
+
+    def _run(self, handle):
+        while True:
+            self._wake.clear()
+            try:
+                self.drain(handle)
+            except Exception:
+                # The journal itself failed (disk full?); entries stay queued.
+                journal_log.exception("checkout journal drain failed")
+            self._wake.wait(self.interval)
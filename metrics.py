@@ -0,0 +1,196 @@
+import glob
+import json
+import os
+import threading
+import time
+
+# Latency buckets in seconds, from a cached page up to a slow export.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Every gunicorn worker keeps its own values and writes them as a JSON
+    snapshot to ``directory`` (at most every ``flush_interval`` seconds), and
+    render() merges the snapshots of all workers, so whichever worker answers
+    a scrape reports the whole server. Counters and histograms of workers that
+    have exited are kept; their gauges are dropped. Clear the directory on
+    deploy, as with any Prometheus multi-process setup.
+    """
+
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+
+    def _check_fork(self):
+        # A worker forked from a --preload master starts with empty values.
+        if self._pid != os.getpid():
+            self._reset()
+
+    # --- Definitions ---
+    def counter(self, name, help_text):
+        self._definitions[name] = ('counter', help_text, None)
+
+    def gauge(self, name, help_text):
+        self._definitions[name] = ('gauge', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    def register_collector(self, collect):
+        """``collect()`` returns ``(name, labels, value)`` tuples read at flush time.
+
+        Use it for values another object already tracks (pool and cache
+        stats), whether counters or gauges.
+        """
+        self._collectors.append(collect)
+
+    # --- Updates ---
+    def inc(self, name, labels=None, value=1):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        buckets = self._definitions[name][2]
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    # --- Snapshots ---
+    def _snapshot(self):
+        with self._lock:
+            self._check_fork()
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), dict(entry, buckets=list(entry['buckets']))]
+                          for (name, labels), entry in self._histograms.items()]
+        collected = []
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                collected.append([name, list(_label_key(labels)), value])
+        return {'pid': os.getpid(), 'written_at': time.time(),
+                'counters': counters, 'histograms': histograms, 'collected': collected}
+
+    def flush(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'worker-{os.getpid()}.json')
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Metrics must never break a request; this worker's numbers will
+            # simply be missing from scrapes until the directory is writable.
+            pass
+        self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    # --- Exposition ---
+    def _load_snapshots(self):
+        snapshots = {os.getpid(): self._snapshot()}
+        for path in glob.glob(os.path.join(self.directory, 'worker-*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.setdefault(snapshot['pid'], snapshot)
+        return snapshots.values()
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format."""
+        values, histograms = {}, {}
+        for snapshot in self._load_snapshots():
+            alive = self._alive(snapshot['pid'])
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                values[key] = values.get(key, 0) + value
+            for name, labels, value in snapshot['collected']:
+                kind = self._definitions.get(name, ('gauge',))[0]
+                if kind == 'gauge':
+                    if not alive:
+                        continue
+                    # Per-worker gauges (pool usage, cache entries) keep a pid label.
+                    labels = labels + [['pid', snapshot['pid']]]
+                key = (name, tuple(map(tuple, labels)))
+                values[key] = values.get(key, 0) + value
+            for name, labels, entry in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, {'buckets': [0] * len(entry['buckets']), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], entry['buckets'])]
+                merged['sum'] += entry['sum']
+                merged['count'] += entry['count']
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._definitions.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (metric, labels), entry in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, entry['buckets']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(labels, [("le", _format_value(bound))])} {cumulative}')
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {entry["count"]}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(entry["sum"])}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {entry["count"]}')
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,807 @@
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db import SHOP_TIMEZONE
+from partitions import MONTHS_AHEAD, PARTITIONED_TABLES, add_months, create_partition, is_partitioned
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Arbitrary key for pg_advisory_lock so two deploys never migrate at once.
+MIGRATION_LOCK_ID = 7316001
+
+
+class Migration:
+    """One schema version.
+
+    ``statements`` run in a single transaction. ``indexes`` (and
+    ``unique_indexes``) are ``(name, table, definition)`` tuples built
+    afterwards with CREATE [UNIQUE] INDEX CONCURRENTLY, so they never block
+    checkouts on a live database. Everything must be safe to re-run: a migration is only recorded
+    once all of its statements and indexes have succeeded.
+
+    ``run(conn, verbose)``, if given, is called between the two for work
+    that cannot be one transaction (e.g. copying a large table in batches).
+    ``dropped_indexes`` names earlier migrations' indexes this one removes,
+    which verify() then no longer expects.
+
+    An ``optional`` migration that fails (e.g. an extension the server does
+    not ship) is skipped with a warning and retried on the next run; the app
+    falls back to working without it.
+    """
+
+    def __init__(self, version, name, statements=(), indexes=(), unique_indexes=(), run=None, dropped_indexes=(),
+                 optional=False):
+        self.version = version
+        self.name = name
+        self.statements = list(statements)
+        self.indexes = list(indexes)
+        self.unique_indexes = list(unique_indexes)
+        self.run = run
+        self.dropped_indexes = list(dropped_indexes)
+        self.optional = optional
+
+
+@contextmanager
+def _transaction(conn):
+    """A cursor whose statements commit together, on a connection otherwise in autocommit."""
+    conn.autocommit = False
+    try:
+        with conn, conn.cursor() as cursor:
+            yield cursor
+    finally:
+        conn.autocommit = True
+
+
+# --- Monthly partitions (migration 11) ---
+# Partitioned copies of invoices, invoice_items and sales are created next to
+# the live tables, kept in step by triggers while the existing rows are copied
+# over in batches, and checked row for row against them. The swap then takes
+# a lock held only for a check of the rows added since and the renames.
+# Indexes and constraints get their final names there.
+#
+# The live invoice_items gains a nullable created_on first, filled in by its
+# mirror trigger and, for the existing lines, in batches before the copy.
+# The new code can be deployed once that is done (the migration says so),
+# and the swap is then the only time checkouts wait.
+PARTITION_COPY_BATCH = 10000
+PARTITION_SWAP_ATTEMPTS = 10
+
+# The live tables' columns, as the earlier migrations left them (plus
+# invoice_items.created_on, added by migration 11 itself).
+PARTITION_COLUMNS = {
+    'invoices': ['id', 'customer_name', 'payment_mode', 'total_amount', 'created_on', 'cashier_username',
+                 'idempotency_key', 'customer_id'],
+    'invoice_items': ['id', 'invoice_id', 'product_id', 'quantity', 'price_at_sale', 'line_total'],
+    'sales': ['id', 'product_id', 'quantity', 'total_price', 'customer_name', 'payment_mode', 'created_on'],
+}
+
+PARTITIONED_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS invoices_partitioned (
+        id INTEGER NOT NULL DEFAULT nextval('invoices_id_seq'),
+        customer_name TEXT,
+        payment_mode TEXT NOT NULL,
+        total_amount NUMERIC(10, 2) NOT NULL,
+        created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        cashier_username TEXT NOT NULL,
+        idempotency_key UUID,
+        customer_id INTEGER CONSTRAINT invoices_customer_id_fkey REFERENCES customers(id),
+        CONSTRAINT invoices_partitioned_pkey PRIMARY KEY (id, created_on)
+    ) PARTITION BY RANGE (created_on)
+    """,
+    # Every line carries its invoice's created_on, so both land in the same month.
+    """
+    CREATE TABLE IF NOT EXISTS invoice_items_partitioned (
+        id INTEGER NOT NULL DEFAULT nextval('invoice_items_id_seq'),
+        invoice_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL CONSTRAINT invoice_items_product_id_fkey REFERENCES products(id),
+        quantity INTEGER NOT NULL,
+        price_at_sale NUMERIC(10, 2) NOT NULL,
+        line_total NUMERIC(10, 2) NOT NULL,
+        created_on TIMESTAMPTZ NOT NULL,
+        CONSTRAINT invoice_items_partitioned_pkey PRIMARY KEY (id, created_on),
+        CONSTRAINT invoice_items_invoice_id_fkey FOREIGN KEY (invoice_id, created_on)
+            REFERENCES invoices_partitioned (id, created_on)
+    ) PARTITION BY RANGE (created_on)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_partitioned (
+        id INTEGER NOT NULL DEFAULT nextval('sales_id_seq'),
+        product_id INTEGER NOT NULL CONSTRAINT sales_product_id_fkey REFERENCES products(id),
+        quantity INTEGER NOT NULL,
+        total_price NUMERIC(10, 2),
+        customer_name TEXT,
+        payment_mode TEXT,
+        created_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT sales_partitioned_pkey PRIMARY KEY (id, created_on)
+    ) PARTITION BY RANGE (created_on)
+    """,
+]
+
+# The invoice branch exposes the line's created_on and joins on it, so a date
+# filter on the view prunes invoice_items and each invoice lookup is pruned to
+# its month at run time.
+SALES_LEDGER_VIEW = """
+    CREATE OR REPLACE VIEW sales_ledger AS
+    SELECT 'invoice'::text AS source, ii.id, ii.invoice_id, ii.product_id, ii.quantity,
+           ii.line_total AS total_price, i.customer_name, i.payment_mode, ii.created_on
+    FROM invoice_items ii JOIN invoices i ON i.id = ii.invoice_id AND i.created_on = ii.created_on
+    UNION ALL
+    SELECT 'manual'::text, s.id, NULL::integer, s.product_id, s.quantity,
+           s.total_price, s.customer_name, s.payment_mode, s.created_on
+    FROM sales s
+"""
+
+# Superseded by idx_invoices_created_on_id and by checkout_keys: a unique
+# index on a partitioned table has to include created_on.
+PARTITION_DROPPED_INDEXES = ['idx_invoices_created_on', 'idx_invoices_idempotency_key']
+
+
+def _partition_row_sql(table, row):
+    """The ``(columns)`` and ``(values)`` lists for copying ``row`` (NEW, OLD or an alias) of ``table``."""
+    columns = PARTITION_COLUMNS[table]
+    values = [f"{row}.{column}" for column in columns]
+    if table == 'invoice_items':
+        columns = columns + ['created_on']
+        values.append(f"COALESCE({row}.created_on, (SELECT created_on FROM invoices WHERE id = {row}.invoice_id))")
+    return ', '.join(columns), ', '.join(values)
+
+
+def _mirror_trigger_sql(table):
+    """A trigger that repeats every write to ``table`` on its partitioned copy.
+
+    On invoice_items it runs before the write, to fill in the created_on
+    that the code from before migration 11 leaves out.
+    """
+    columns, new_values = _partition_row_sql(table, 'NEW')
+    target = f"{table}_partitioned"
+    key = "id = OLD.id" + (" AND created_on = OLD.created_on" if 'created_on' in PARTITION_COLUMNS[table] else "")
+    timing, fill = 'AFTER', ""
+    if table == 'invoice_items':
+        timing, fill = 'BEFORE', """
+            IF TG_OP <> 'DELETE' AND NEW.created_on IS NULL THEN
+                NEW.created_on := (SELECT created_on FROM invoices WHERE id = NEW.invoice_id);
+            END IF;"""
+    extra = ""
+    if table == 'invoices':
+        extra = """
+            IF NEW.idempotency_key IS NOT NULL THEN
+                INSERT INTO checkout_keys (idempotency_key, invoice_id, created_on)
+                VALUES (NEW.idempotency_key, NEW.id, NEW.created_on) ON CONFLICT DO NOTHING;
+            END IF;"""
+    return [f"""
+        CREATE OR REPLACE FUNCTION mirror_{target}() RETURNS trigger AS $$
+        BEGIN{fill}
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO {target} ({columns}) VALUES ({new_values});{extra}
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE {target} SET ({columns}) = ({new_values}) WHERE {key};
+            ELSE
+                DELETE FROM {target} WHERE {key};
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """, f"DROP TRIGGER IF EXISTS mirror_{target} ON {table}", f"""
+        CREATE TRIGGER mirror_{target}
+        {timing} INSERT OR UPDATE OR DELETE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION mirror_{target}()
+    """]
+
+
+def _carried_indexes(cursor):
+    """The earlier migrations' indexes on the partitioned tables, rebuilt on the copies."""
+    done = applied_versions(cursor)
+    return [(name, table, definition)
+            for migration in MIGRATIONS if migration.version in done
+            for name, table, definition in migration.indexes
+            if table in PARTITIONED_TABLES and name not in PARTITION_DROPPED_INDEXES]
+
+
+def _fill_item_dates(conn, verbose):
+    """Sets created_on on the invoice_items written before migration 11.
+
+    The new code's receipts and reports join lines on it. Rows written from
+    here on get it from the code or the mirror trigger.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM invoice_items")
+        last_id = cursor.fetchone()[0]
+    for low in range(0, last_id, PARTITION_COPY_BATCH):
+        with _transaction(conn) as cursor:
+            # Their copies do not exist yet, so the mirror trigger's update finds nothing to do.
+            cursor.execute("""
+                UPDATE invoice_items t SET created_on = i.created_on FROM invoices i
+                WHERE i.id = t.invoice_id AND t.id > %s AND t.id <= %s AND t.created_on IS NULL
+            """, (low, low + PARTITION_COPY_BATCH))
+    if verbose:
+        print("  - every invoice line has its created_on; the new code can be deployed now")
+
+
+def _copy_in_batches(conn, table, verbose):
+    target = f"{table}_partitioned"
+    columns, values = _partition_row_sql(table, 't')
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        last_id = cursor.fetchone()[0]
+    copied = 0
+    for low in range(0, last_id, PARTITION_COPY_BATCH):
+        with _transaction(conn) as cursor:
+            # FOR SHARE holds off an update or delete of these rows until
+            # the batch commits; the trigger then finds them in the copy.
+            cursor.execute(f"""
+                INSERT INTO {target} ({columns})
+                SELECT {values} FROM {table} t WHERE t.id > %s AND t.id <= %s
+                FOR SHARE
+                ON CONFLICT DO NOTHING
+            """, (low, low + PARTITION_COPY_BATCH))
+            copied += cursor.rowcount
+            if table == 'invoices':
+                cursor.execute("""
+                    INSERT INTO checkout_keys (idempotency_key, invoice_id, created_on)
+                    SELECT idempotency_key, id, created_on FROM invoices
+                    WHERE id > %s AND id <= %s AND idempotency_key IS NOT NULL
+                    ON CONFLICT DO NOTHING
+                """, (low, low + PARTITION_COPY_BATCH))
+    if verbose:
+        print(f"  - copied {copied:,} rows of {table}")
+
+
+def _check_partitioned_copies(conn):
+    """Checks that every copy holds as many rows as its table, without blocking writers.
+
+    Both counts come from one snapshot, in which the mirror triggers keep
+    them equal. Returns each table's highest id in that snapshot.
+    """
+    marks = {}
+    with _transaction(conn) as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        for table in PARTITION_COLUMNS:
+            cursor.execute(f"""
+                DO $$ BEGIN
+                    IF (SELECT COUNT(*) FROM {table}) <> (SELECT COUNT(*) FROM {table}_partitioned) THEN
+                        RAISE EXCEPTION 'the partitioned copy of {table} is incomplete; run the migration again';
+                    END IF;
+                END $$
+            """)
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+            marks[table] = cursor.fetchone()[0]
+    return marks
+
+
+def _swap_in_partitions(conn, indexes, marks):
+    with _transaction(conn) as cursor:
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        # Dropping the old tables also locks the tables their foreign keys
+        # point at; taking those first, as checkouts do, avoids a deadlock.
+        cursor.execute("LOCK TABLE products, customers, invoices, invoice_items, sales IN ACCESS EXCLUSIVE MODE")
+        # Since the full check, only the mirror triggers could keep the copies
+        # in step, and only rows above the marks are new: both are cheap to see.
+        cursor.execute("""
+            SELECT COUNT(*) FROM pg_trigger
+            WHERE tgname = ANY(%s) AND tgenabled <> 'D'
+        """, ([f"mirror_{table}_partitioned" for table in PARTITION_COLUMNS],))
+        if cursor.fetchone()[0] != len(PARTITION_COLUMNS):
+            cursor.execute("DO $$ BEGIN RAISE EXCEPTION 'a mirror trigger was dropped or disabled; run the migration again'; END $$")
+        for table, mark in marks.items():
+            cursor.execute(f"""
+                DO $$ BEGIN
+                    IF (SELECT COUNT(*) FROM {table} WHERE id > {int(mark)}) <> (SELECT COUNT(*) FROM {table}_partitioned WHERE id > {int(mark)})
+                       OR (SELECT MAX(id) FROM {table}) IS DISTINCT FROM (SELECT MAX(id) FROM {table}_partitioned) THEN
+                        RAISE EXCEPTION 'the partitioned copy of {table} is incomplete; run the migration again';
+                    END IF;
+                END $$
+            """)
+        cursor.execute("DROP VIEW IF EXISTS sales_ledger")
+        for table in PARTITION_COLUMNS:
+            cursor.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}_partitioned.id")
+        cursor.execute("DROP TABLE invoice_items, invoices, sales")
+        for table in PARTITION_COLUMNS:
+            cursor.execute(f"ALTER TABLE {table}_partitioned RENAME TO {table}")
+            cursor.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {table}_partitioned_pkey TO {table}_pkey")
+            cursor.execute(f"DROP FUNCTION mirror_{table}_partitioned()")
+        for name, _, _ in indexes:
+            cursor.execute(f"ALTER INDEX {name}_partitioned RENAME TO {name}")
+        cursor.execute(SALES_LEDGER_VIEW)
+
+
+def partition_sales_tables(conn, verbose):
+    """Moves invoices, invoice_items and sales into monthly partitions."""
+    with conn.cursor() as cursor:
+        if is_partitioned(cursor, 'invoices'):
+            return
+        indexes = _carried_indexes(cursor)
+
+    with _transaction(conn) as cursor:
+        # Rows without a timestamp have no month to go to.
+        cursor.execute("""
+            DO $$ BEGIN
+                IF EXISTS (SELECT 1 FROM invoices WHERE created_on IS NULL) OR EXISTS (SELECT 1 FROM sales WHERE created_on IS NULL) THEN
+                    RAISE EXCEPTION 'set created_on on every invoice and sale before partitioning them';
+                END IF;
+            END $$
+        """)
+        for statement in PARTITIONED_SCHEMA:
+            cursor.execute(statement)
+        # From the oldest row's month to MONTHS_AHEAD months from now; after
+        # that partitions.ensure_partitions() keeps adding them.
+        cursor.execute("""
+            SELECT date_trunc('month', MIN(created_on) AT TIME ZONE %(timezone)s)::date,
+                   date_trunc('month', MAX(created_on) AT TIME ZONE %(timezone)s)::date,
+                   date_trunc('month', CURRENT_TIMESTAMP AT TIME ZONE %(timezone)s)::date
+            FROM (SELECT created_on FROM invoices UNION ALL SELECT created_on FROM sales) t
+        """, {'timezone': SHOP_TIMEZONE})
+        first_month, last_month, this_month = cursor.fetchone()
+        month = min(first_month or this_month, this_month)
+        last_month = max(last_month or this_month, add_months(this_month, MONTHS_AHEAD))
+        while month <= last_month:
+            for table in PARTITIONED_TABLES:
+                create_partition(cursor, table, month, parent=f"{table}_partitioned")
+            month = add_months(month, 1)
+        for name, table, definition in indexes:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name}_partitioned ON {table}_partitioned {definition}")
+        for table in PARTITION_COLUMNS:
+            for statement in _mirror_trigger_sql(table):
+                cursor.execute(statement)
+
+    _fill_item_dates(conn, verbose)
+    for table in PARTITION_COLUMNS:
+        _copy_in_batches(conn, table, verbose)
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE invoices_partitioned, invoice_items_partitioned, sales_partitioned")
+    marks = _check_partitioned_copies(conn)
+
+    for attempt in range(1, PARTITION_SWAP_ATTEMPTS + 1):
+        try:
+            _swap_in_partitions(conn, indexes, marks)
+            break
+        except (psycopg2.errors.LockNotAvailable, psycopg2.errors.DeadlockDetected):
+            if attempt == PARTITION_SWAP_ATTEMPTS:
+                raise
+            if verbose:
+                print("  - the tables are busy; retrying the swap")
+            time.sleep(attempt)
+
+
+MIGRATIONS = [
+    Migration(1, 'daily sales rollup tables', statements=[
+        '''
+        CREATE TABLE IF NOT EXISTS daily_sales (
+            sale_date DATE PRIMARY KEY,
+            total_revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            items_sold INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_product_sales (
+            sale_date DATE NOT NULL,
+            product_id INTEGER NOT NULL REFERENCES products(id),
+            quantity INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (sale_date, product_id)
+        )
+        ''',
+    ]),
+    Migration(2, 'indexes for date ranges and foreign keys', indexes=[
+        ('idx_invoices_created_on', 'invoices', '(created_on)'),
+        ('idx_invoice_items_invoice_id', 'invoice_items', '(invoice_id)'),
+        ('idx_invoice_items_product_id', 'invoice_items', '(product_id)'),
+        ('idx_sales_product_id', 'sales', '(product_id)'),
+        ('idx_products_stock', 'products', '(stock)'),
+    ]),
+    Migration(3, 'keyset pagination index for the sales report', indexes=[
+        ('idx_invoices_created_on_id', 'invoices', '(created_on, id)'),
+    ]),
+    Migration(4, 'pg_trgm indexes for substring search', optional=True, statements=[
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    ], indexes=[
+        ('idx_products_name_trgm', 'products', 'USING gin (name gin_trgm_ops)'),
+        ('idx_sales_customer_name_trgm', 'sales', 'USING gin (customer_name gin_trgm_ops)'),
+        ('idx_invoices_customer_name_trgm', 'invoices', 'USING gin (customer_name gin_trgm_ops)'),
+        ('idx_invoices_cashier_username_trgm', 'invoices', 'USING gin (cashier_username gin_trgm_ops)'),
+    ]),
+    Migration(5, 'catalog versions for billing delta sync', statements=[
+        "CREATE SEQUENCE IF NOT EXISTS catalog_version_seq",
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS catalog_version BIGINT NOT NULL DEFAULT nextval('catalog_version_seq')",
+        '''
+        CREATE TABLE IF NOT EXISTS product_tombstones (
+            product_id INTEGER PRIMARY KEY,
+            catalog_version BIGINT NOT NULL
+        )
+        ''',
+        # Every change the billing screen can see stamps the row with a fresh
+        # version; deletes leave a tombstone so clients can drop the product.
+        '''
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO product_tombstones (product_id, catalog_version)
+                VALUES (OLD.id, nextval('catalog_version_seq'))
+                ON CONFLICT (product_id) DO UPDATE SET catalog_version = EXCLUDED.catalog_version;
+                RETURN OLD;
+            END IF;
+            NEW.catalog_version := nextval('catalog_version_seq');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS products_catalog_version ON products",
+        '''
+        CREATE TRIGGER products_catalog_version
+        BEFORE INSERT OR UPDATE OF name, category, price, stock ON products
+        FOR EACH ROW EXECUTE FUNCTION bump_catalog_version()
+        ''',
+        "DROP TRIGGER IF EXISTS products_catalog_tombstone ON products",
+        '''
+        CREATE TRIGGER products_catalog_tombstone
+        AFTER DELETE ON products
+        FOR EACH ROW EXECUTE FUNCTION bump_catalog_version()
+        ''',
+    ], indexes=[
+        ('idx_products_catalog_version', 'products', '(catalog_version)'),
+        ('idx_product_tombstones_catalog_version', 'product_tombstones', '(catalog_version)'),
+    ]),
+    # checkout() used to copy every invoice line into the legacy sales table.
+    # The sales pages now read this view instead, and sales only holds the
+    # sales recorded by hand on the Sales page.
+    Migration(6, 'sales ledger view over invoices and manual sales', statements=[
+        '''
+        CREATE OR REPLACE VIEW sales_ledger AS
+        SELECT 'invoice'::text AS source, ii.id, ii.invoice_id, ii.product_id, ii.quantity,
+               ii.line_total AS total_price, i.customer_name, i.payment_mode, i.created_on
+        FROM invoice_items ii JOIN invoices i ON i.id = ii.invoice_id
+        UNION ALL
+        SELECT 'manual'::text, s.id, NULL::integer, s.product_id, s.quantity,
+               s.total_price, s.customer_name, s.payment_mode, s.created_on
+        FROM sales s
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS legacy_sales_archive (
+            id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            total_price NUMERIC(10, 2),
+            customer_name TEXT,
+            payment_mode TEXT,
+            created_on TIMESTAMPTZ,
+            invoice_id INTEGER NOT NULL,
+            matches_invoice_item BOOLEAN NOT NULL,
+            archived_on TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # A checkout's copies were written in the invoice's own transaction,
+        # so they carry exactly its created_on; a sale entered by hand never
+        # does. Copies an admin edited afterwards are archived too (flagged
+        # matches_invoice_item = false), since the invoice is authoritative.
+        '''
+        INSERT INTO legacy_sales_archive
+            (id, product_id, quantity, total_price, customer_name, payment_mode, created_on, invoice_id, matches_invoice_item)
+        SELECT DISTINCT ON (c.id) c.*
+        FROM (
+            SELECT s.id, s.product_id, s.quantity, s.total_price, s.customer_name, s.payment_mode, s.created_on, i.id AS invoice_id,
+                   EXISTS (
+                       SELECT 1 FROM invoice_items ii
+                       WHERE ii.invoice_id = i.id AND ii.product_id = s.product_id
+                         AND ii.quantity = s.quantity AND ii.line_total = s.total_price
+                   ) AND s.customer_name IS NOT DISTINCT FROM i.customer_name
+                     AND s.payment_mode IS NOT DISTINCT FROM i.payment_mode AS matches_invoice_item
+            FROM sales s JOIN invoices i ON i.created_on = s.created_on
+        ) c
+        -- Should two invoices share a timestamp, prefer the one the row copies.
+        ORDER BY c.id, c.matches_invoice_item DESC, c.invoice_id
+        ON CONFLICT (id) DO NOTHING
+        ''',
+        "DELETE FROM sales s USING legacy_sales_archive a WHERE a.id = s.id",
+    ], indexes=[
+        ('idx_sales_created_on_id', 'sales', '(created_on, id)'),
+    ]),
+    Migration(7, 'idempotency keys for checkout', statements=[
+        # Sent by the till with every checkout; NULL for invoices created before.
+        "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS idempotency_key UUID",
+    ], unique_indexes=[
+        ('idx_invoices_idempotency_key', 'invoices', '(idempotency_key)'),
+    ]),
+    Migration(8, 'background job queue and dead letters', statements=[
+        '''
+        CREATE TABLE IF NOT EXISTS job_queue (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            enqueued_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS job_dead_letters (
+            id BIGINT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            enqueued_on TIMESTAMPTZ NOT NULL,
+            failed_on TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ], indexes=[
+        ('idx_job_queue_run_after_id', 'job_queue', '(run_after, id)'),
+    ]),
+    Migration(9, 'per-product reorder levels and low-stock index', statements=[
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS reorder_level INTEGER NOT NULL DEFAULT 10 CHECK (reorder_level >= 0)",
+    ], indexes=[
+        # Holds only the products at or below their reorder level, most
+        # urgent first, so finding them does not depend on the catalog size.
+        # Queries must repeat the predicate to use it.
+        ('idx_products_low_stock', 'products', '((reorder_level - stock), id) WHERE stock <= reorder_level'),
+    ]),
+    Migration(10, 'customers dimension with lifetime totals', statements=[
+        # One customer per name, ignoring case and spacing ("  ravi  KUMAR" is "ravi kumar").
+        '''
+        CREATE OR REPLACE FUNCTION customer_name_key(name TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE AS $$ SELECT lower(regexp_replace(btrim(name), '\\s+', ' ', 'g')) $$
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS customers (
+            id SERIAL PRIMARY KEY,
+            name_key TEXT NOT NULL UNIQUE,
+            display_name TEXT NOT NULL,
+            lifetime_spend NUMERIC(12, 2) NOT NULL DEFAULT 0,
+            visit_count INTEGER NOT NULL DEFAULT 0,
+            first_visit TIMESTAMPTZ,
+            last_visit TIMESTAMPTZ,
+            created_on TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Filled for existing invoices by backfill_rollups.py.
+        "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS customer_id INTEGER REFERENCES customers(id)",
+    ], indexes=[
+        ('idx_customers_lifetime_spend', 'customers', '(lifetime_spend, id)'),
+        ('idx_invoices_customer_id', 'invoices', '(customer_id)'),
+        ('idx_invoices_cashier_username', 'invoices', '(cashier_username)'),
+    ]),
+    Migration(11, 'monthly partitions for invoices, invoice_items and sales', statements=[
+        # Checkout's idempotency keys; invoices can no longer hold them unique.
+        '''
+        CREATE TABLE IF NOT EXISTS checkout_keys (
+            idempotency_key UUID PRIMARY KEY,
+            invoice_id INTEGER NOT NULL,
+            created_on TIMESTAMPTZ NOT NULL
+        )
+        ''',
+        # Lets the new code write and join on it while the copy runs.
+        'ALTER TABLE invoice_items ADD COLUMN IF NOT EXISTS created_on TIMESTAMPTZ',
+    ], run=partition_sales_tables, dropped_indexes=PARTITION_DROPPED_INDEXES),
+    # Months moved out to archive files by archive.py. daily_sales and
+    # daily_product_sales keep their rows for those days; the customers'
+    # share of each month is kept here so backfill_rollups.py can still
+    # recompute lifetime totals.
+    Migration(12, 'archived months and their customer totals', statements=[
+        '''
+        CREATE TABLE IF NOT EXISTS archived_months (
+            month DATE PRIMARY KEY,
+            invoice_count INTEGER NOT NULL,
+            item_count INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL,
+            revenue NUMERIC(14, 2) NOT NULL,
+            path TEXT NOT NULL,
+            archived_on TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS archived_customer_totals (
+            month DATE NOT NULL REFERENCES archived_months(month) ON DELETE CASCADE,
+            customer_id INTEGER NOT NULL REFERENCES customers(id),
+            spend NUMERIC(12, 2) NOT NULL,
+            visits INTEGER NOT NULL,
+            first_visit TIMESTAMPTZ,
+            last_visit TIMESTAMPTZ,
+            PRIMARY KEY (month, customer_id)
+        )
+        ''',
+    ]),
+    # Sequence stamps are taken before commit, so a row stamped V-1 could
+    # become visible after a client had already been sent V and never reach
+    # it. Rows are now stamped with their transaction id, and /api/catalog
+    # hands out its snapshot's xmin, below which every transaction has ended.
+    Migration(13, 'transaction-id catalog versions', statements=[
+        '''
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO product_tombstones (product_id, catalog_version)
+                VALUES (OLD.id, pg_current_xact_id()::text::bigint)
+                ON CONFLICT (product_id) DO UPDATE SET catalog_version = EXCLUDED.catalog_version;
+                RETURN OLD;
+            END IF;
+            NEW.catalog_version := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "ALTER TABLE products ALTER COLUMN catalog_version SET DEFAULT pg_current_xact_id()::text::bigint",
+        # Old sequence stamps are not comparable with transaction ids.
+        "UPDATE products SET catalog_version = pg_current_xact_id()::text::bigint",
+        "UPDATE product_tombstones SET catalog_version = pg_current_xact_id()::text::bigint",
+        "DROP SEQUENCE IF EXISTS catalog_version_seq",
+    ]),
+]
+
+
+def _ensure_version_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_on TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def applied_versions(cursor):
+    _ensure_version_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def index_state(cursor, name):
+    """Returns 'valid', 'invalid' (a failed concurrent build) or None."""
+    cursor.execute("""
+        SELECT ix.indisvalid FROM pg_class c JOIN pg_index ix ON ix.indexrelid = c.oid
+        WHERE c.relname = %s AND c.relkind IN ('i', 'I')
+    """, (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return 'valid' if row[0] else 'invalid'
+
+
+def _build_index(cursor, name, table, definition, unique=False):
+    if is_partitioned(cursor, table):
+        _build_partitioned_index(cursor, name, table, definition, unique)
+        return
+    # An interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    # that IF NOT EXISTS would happily skip; drop it and build it again.
+    if index_state(cursor, name) == 'invalid':
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+
+
+def _build_partitioned_index(cursor, name, table, definition, unique):
+    # A partitioned table cannot be indexed concurrently. The parent's index
+    # is created on the parent alone (invalid until complete), each
+    # partition's concurrently and then attached; new partitions get theirs
+    # when they are created.
+    if index_state(cursor, name) == 'valid':
+        return
+    cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass AND NOT EXISTS (
+            SELECT 1 FROM pg_inherits attached JOIN pg_index ix ON ix.indexrelid = attached.inhrelid
+            WHERE attached.inhparent = %s::regclass AND ix.indrelid = c.oid
+        )
+    """, (table, name))
+    for (partition,) in cursor.fetchall():
+        partition_index = f"{name}_{partition.removeprefix(table + '_')}"
+        _build_index(cursor, partition_index, partition, definition, unique)
+        cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def _apply(conn, cursor, migration, verbose):
+    if migration.statements:
+        with _transaction(conn) as tx_cursor:
+            for statement in migration.statements:
+                tx_cursor.execute(statement)
+
+    if migration.run:
+        migration.run(conn, verbose)
+
+    for unique, indexes in ((False, migration.indexes), (True, migration.unique_indexes)):
+        for name, table, definition in indexes:
+            if verbose:
+                print(f"  - building {'unique ' if unique else ''}index {name} on {table}")
+            _build_index(cursor, name, table, definition, unique=unique)
+
+
+def migrate(conn, verbose=True):
+    """Applies every pending migration in order. Returns the versions applied."""
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+    newly_applied = []
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        done = applied_versions(cursor)
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            if verbose:
+                print(f"Applying migration {migration.version}: {migration.name}...")
+
+            try:
+                _apply(conn, cursor, migration, verbose)
+            except psycopg2.Error as e:
+                if not migration.optional:
+                    raise
+                print(f"⚠️  Skipping optional migration {migration.version} ({migration.name}): {e}")
+                continue
+
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                           (migration.version, migration.name))
+            newly_applied.append(migration.version)
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        cursor.close()
+        conn.autocommit = previous_autocommit
+    return newly_applied
+
+
+def verify(conn):
+    """Checks that every applied migration's indexes exist and are valid."""
+    cursor = conn.cursor()
+    done = applied_versions(cursor)
+    dropped = {name for migration in MIGRATIONS if migration.version in done for name in migration.dropped_indexes}
+    ok = True
+    for migration in MIGRATIONS:
+        if migration.version not in done:
+            if migration.optional:
+                print(f"⚠️  {migration.version}: {migration.name} (optional, not applied)")
+            else:
+                print(f"❌ {migration.version}: {migration.name} (PENDING)")
+                ok = False
+            continue
+        print(f"✅ {migration.version}: {migration.name} (applied)")
+        for name, table, _ in migration.indexes + migration.unique_indexes:
+            if name in dropped:
+                continue
+            state = index_state(cursor, name)
+            if state != 'valid':
+                ok = False
+            print(f"   {'✅' if state == 'valid' else '❌'} {name} on {table}: {state or 'missing'}")
+    conn.rollback()
+    cursor.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply or verify the versioned schema migrations.")
+    parser.add_argument('--verify', action='store_true', help="only check migrations and indexes, change nothing")
+    args = parser.parse_args()
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return 1
+
+    conn = None
+    try:
+        conn = psycopg2.connect(db_url)
+        if args.verify:
+            return 0 if verify(conn) else 1
+
+        applied = migrate(conn)
+        if applied:
+            print(f"✅ Applied migrations: {', '.join(str(version) for version in applied)}")
+        else:
+            print("✅ Database schema is already up to date.")
+        return 0 if verify(conn) else 1
+
+    except psycopg2.Error as e:
+        print(f"❌ Migration failed: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
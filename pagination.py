@@ -0,0 +1,165 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+
+import psycopg2
+
+
+class Page:
+    """One page of a keyset (seek) paginated listing.
+
+    ``next_cursor`` / ``prev_cursor`` are opaque tokens for the ``after`` and
+    ``before`` query arguments; they are None when there is nothing further
+    in that direction.
+    """
+
+    def __init__(self, rows, next_cursor, prev_cursor, reset=False):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        # True when the cursor did not fit the key columns and the first page was served instead.
+        self.reset = reset
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Returns the key values in ``token``, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    # Keys are plain scalars; anything else was not produced by encode_cursor().
+    if any(isinstance(value, bool) or not isinstance(value, (str, int, float)) for value in values):
+        return None
+    return values
+
+
+def fetch_page(cursor, select_sql, where_clauses, params, key_columns, row_key,
+               after=None, before=None, per_page=10):
+    """Fetches one page of ``select_sql`` ordered by ``key_columns`` descending.
+
+    ``select_sql`` is a ``SELECT ... FROM ...`` without WHERE or ORDER BY;
+    ``key_columns`` must uniquely order the rows (end with a primary key) and
+    ``row_key(row)`` must return their values for a fetched row. Instead of
+    an OFFSET the page starts with a row-value comparison against the cursor,
+    so every page costs the same index seek.
+    """
+    clauses, args = list(where_clauses), list(params)
+    key_sql = ', '.join(key_columns)
+    placeholders = ', '.join(['%s'] * len(key_columns))
+
+    after_key = decode_cursor(after, len(key_columns))
+    before_key = decode_cursor(before, len(key_columns)) if after_key is None else None
+    # Key values are sent as untyped literals so PostgreSQL reads them back
+    # with each key column's own type (a float4 rank compared as numeric
+    # would never equal itself).
+    if after_key is not None:
+        clauses.append(f"({key_sql}) < ({placeholders})")
+        args.extend(str(value) for value in after_key)
+    elif before_key is not None:
+        clauses.append(f"({key_sql}) > ({placeholders})")
+        args.extend(str(value) for value in before_key)
+
+    # Walking backwards reads the preceding rows in ascending order and flips them.
+    direction = 'ASC' if before_key is not None else 'DESC'
+    query = select_sql
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY " + ', '.join(f"{column} {direction}" for column in key_columns)
+    query += " LIMIT %s"
+    if after_key is None and before_key is None:
+        cursor.execute(query, args + [per_page + 1])
+        rows = cursor.fetchall()
+    else:
+        # A stale or tampered cursor can hold values the key columns reject
+        # (a date that is not a date); serve the first page instead of failing.
+        cursor.execute("SAVEPOINT page_cursor")
+        try:
+            cursor.execute(query, args + [per_page + 1])
+        except psycopg2.DataError:
+            cursor.execute("ROLLBACK TO SAVEPOINT page_cursor")
+            page = fetch_page(cursor, select_sql, where_clauses, params, key_columns, row_key, per_page=per_page)
+            page.reset = True
+            return page
+        rows = cursor.fetchall()
+        cursor.execute("RELEASE SAVEPOINT page_cursor")
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before_key is not None:
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, after_key is not None
+
+    next_cursor = encode_cursor(row_key(rows[-1])) if rows and has_next else None
+    prev_cursor = encode_cursor(row_key(rows[0])) if rows and has_prev else None
+    return Page(rows, next_cursor, prev_cursor)
+
+
+def count_rows(cursor, from_sql, where_clauses, params, exact=False, exact_limit=10000):
+    """Counts the rows of ``FROM ... WHERE ...``.
+
+    Unless ``exact`` is set, the planner's row estimate is used whenever it is
+    above ``exact_limit``, which keeps large listings from paying for a full
+    COUNT(*) on every page. Returns ``(count, is_exact)``.
+    """
+    query = from_sql
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    if not exact:
+        cursor.execute("EXPLAIN (FORMAT JSON) SELECT 1 " + query, params)
+        estimate = int(cursor.fetchone()[0][0]['Plan']['Plan Rows'])
+        if estimate > exact_limit:
+            return estimate, False
+    cursor.execute("SELECT COUNT(*) " + query, params)
+    return cursor.fetchone()[0], True
+
+
+def fetch_merged_page(cursor, branches, row_key, after=None, before=None, per_page=10):
+    """Keyset pagination over the union of several queries.
+
+    ``branches`` are ``(select_sql, where_clauses, params, key_columns)``
+    tuples whose key columns produce comparable, jointly unique values (e.g.
+    a timestamp, a constant naming the branch and an id). Each branch is
+    paged on its own index with fetch_page() and the short results are
+    merged here; PostgreSQL would otherwise sort the whole UNION ALL.
+    """
+    pages = [fetch_page(cursor, select_sql, where_clauses, params, key_columns, row_key,
+                        after=after, before=before, per_page=per_page)
+             for select_sql, where_clauses, params, key_columns in branches]
+    if any(page.reset for page in pages) and (after or before):
+        return fetch_merged_page(cursor, branches, row_key, per_page=per_page)
+    rows = sorted((row for page in pages for row in page.rows), key=row_key, reverse=True)
+
+    size = len(branches[0][3])
+    after_key = decode_cursor(after, size)
+    before_key = decode_cursor(before, size) if after_key is None else None
+    if before_key is not None:
+        # Each branch returned the rows just above the cursor; keep the closest.
+        has_prev = len(rows) > per_page or any(page.prev_cursor for page in pages)
+        has_next = True
+        rows = rows[-per_page:]
+    else:
+        has_next = len(rows) > per_page or any(page.next_cursor for page in pages)
+        has_prev = after_key is not None
+        rows = rows[:per_page]
+
+    next_cursor = encode_cursor(row_key(rows[-1])) if rows and has_next else None
+    prev_cursor = encode_cursor(row_key(rows[0])) if rows and has_prev else None
+    return Page(rows, next_cursor, prev_cursor)
@@ -0,0 +1,146 @@
+import argparse
+import os
+import sys
+from datetime import date
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db import SHOP_TIMEZONE
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Split into one partition per calendar month (shop time) of created_on, see
+# migration 11 in migrate_db.py. Referenced tables come first.
+PARTITIONED_TABLES = ('invoices', 'invoice_items', 'sales')
+# Partitions are created this many months before they are needed.
+MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+# Adding a partition locks its parent exclusively; rather than queue every
+# checkout behind a long-running report, give up and try again later.
+PARTITION_LOCK_TIMEOUT = os.environ.get('PARTITION_LOCK_TIMEOUT', '2s')
+# Arbitrary key for pg_advisory_xact_lock so two processes never add the same partition.
+PARTITION_LOCK_ID = 7316002
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def current_month(cursor, timezone=SHOP_TIMEZONE):
+    """The first day of the current month in ``timezone``."""
+    cursor.execute("SELECT date_trunc('month', CURRENT_TIMESTAMP AT TIME ZONE %s)::date", (timezone,))
+    return cursor.fetchone()[0]
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def list_partitions(cursor, table):
+    """``(name, bounds)`` of every partition of ``table``, oldest first."""
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (table,))
+    return cursor.fetchall()
+
+
+def create_partition(cursor, table, month, parent=None, timezone=SHOP_TIMEZONE):
+    """Creates ``table``'s partition for ``month``, attached to ``parent`` (default: ``table``)."""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {parent or table}
+        FOR VALUES FROM (%s::timestamp AT TIME ZONE %s) TO (%s::timestamp AT TIME ZONE %s)
+    """, (month, timezone, add_months(month, 1), timezone))
+
+
+def ensure_partitions(conn, first_month=None, last_month=None, months_ahead=MONTHS_AHEAD, timezone=SHOP_TIMEZONE):
+    """Creates the missing monthly partitions of every partitioned table.
+
+    Covers ``first_month`` (default: the current month) through ``months_ahead``
+    months from now, or ``last_month`` if that is later. Earlier months are
+    left alone, so archived months are not recreated, and tables that are not
+    partitioned (yet) are skipped. Returns the names of the new partitions.
+    """
+    cursor = conn.cursor()
+    created = []
+    try:
+        cursor.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+        this_month = current_month(cursor, timezone)
+        first = (first_month or this_month).replace(day=1)
+        last = add_months(this_month, months_ahead)
+        if last_month is not None:
+            last = max(last, last_month.replace(day=1))
+
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(cursor, table):
+                continue
+            existing = {name for name, _ in list_partitions(cursor, table)}
+            month = first
+            while month <= last:
+                if partition_name(table, month) not in existing:
+                    create_partition(cursor, table, month, timezone=timezone)
+                    created.append(partition_name(table, month))
+                month = add_months(month, 1)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the upcoming monthly partitions of invoices, invoice_items and sales.")
+    parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD,
+                        help=f"months to create beyond the current one (default: {MONTHS_AHEAD})")
+    parser.add_argument('--status', action='store_true', help="list the partitions and their sizes, change nothing")
+    args = parser.parse_args()
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL not found in .env file. Please ensure it is set correctly.")
+        return 1
+
+    conn = None
+    try:
+        conn = psycopg2.connect(db_url)
+        cursor = conn.cursor()
+        if not args.status:
+            created = ensure_partitions(conn, months_ahead=args.months_ahead)
+            print(f"✅ Created {len(created)} partition(s){': ' + ', '.join(created) if created else ''}.")
+
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(cursor, table):
+                print(f"⚠️  {table} is not partitioned; run migrate_db.py.")
+                continue
+            print(f"📂 {table}:")
+            cursor.execute("""
+                SELECT c.relname, c.reltuples, pg_size_pretty(pg_total_relation_size(c.oid))
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                ORDER BY c.relname
+            """, (table,))
+            for name, rows, size in cursor.fetchall():
+                print(f"   {name}: ~{max(int(rows), 0):,} rows, {size}")
+        conn.rollback()
+        return 0
+
+    except psycopg2.Error as e:
+        print(f"❌ Partition maintenance failed: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
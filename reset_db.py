@@ -3,6 +3,8 @@ import psycopg2
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash
 
+from migrate_db import migrate
+
 # This line loads the DATABASE_URL from your .env file
 load_dotenv()
 
@@ -15,7 +17,13 @@ cursor = conn.cursor()
 
 print("Dropping existing tables...")
 # Use CASCADE to handle dependencies (foreign keys)
-cursor.execute("DROP TABLE IF EXISTS invoice_items, invoices, sales, products, users CASCADE;")
+cursor.execute("DROP VIEW IF EXISTS sales_ledger;")
+cursor.execute("DROP TABLE IF EXISTS schema_migrations, archived_customer_totals, archived_months, checkout_keys, job_dead_letters, job_queue, legacy_sales_archive, product_tombstones, daily_product_sales, daily_sales, invoice_items, invoices, customers, sales, products, users CASCADE;")
+# Left behind if a partitioning migration was interrupted (see migrate_db.py).
+cursor.execute("DROP TABLE IF EXISTS invoice_items_partitioned, invoices_partitioned, sales_partitioned CASCADE;")
+cursor.execute("DROP FUNCTION IF EXISTS customer_name_key(TEXT);")
+
+cursor.execute("DROP SEQUENCE IF EXISTS catalog_version_seq;")
 
 print("Recreating all tables for PostgreSQL...")
 
@@ -138,6 +146,9 @@ cursor.execute("INSERT INTO products (name, category, price, stock) VALUES (%s,
 
 conn.commit()
 cursor.close()
+
+print("Applying schema migrations (rollups, indexes)...")
+migrate(conn)
 conn.close()
 
 print("\n✅ PostgreSQL reset script is ready!")
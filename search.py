@@ -0,0 +1,52 @@
+import os
+
+from pagination import fetch_page
+
+# 'auto' uses pg_trgm when the extension is installed, 'trigram' assumes it is,
+# 'basic' never uses it (plain ILIKE, newest rows first).
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'auto')
+
+_trigram_available = None
+
+
+def trigram_enabled(cursor):
+    """Whether search results can be ranked with pg_trgm similarity."""
+    global _trigram_available
+    if SEARCH_MODE == 'basic':
+        return False
+    if SEARCH_MODE == 'trigram':
+        return True
+    if _trigram_available is None:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        _trigram_available = cursor.fetchone()[0]
+    return _trigram_available
+
+
+def match_clause(columns, term):
+    """An ILIKE '%term%' predicate over ``columns``.
+
+    The GIN trigram indexes created by migrate_db.py serve this predicate
+    directly, so it stays an index scan instead of a sequential scan.
+    """
+    pattern = f"%{term}%"
+    sql = "(" + " OR ".join(f"{column} ILIKE %s" for column in columns) + ")"
+    return sql, [pattern] * len(columns)
+
+
+def ranked_page(cursor, select_sql, where_clauses, params, rank_columns, term, tiebreak='id', **page_args):
+    """Like fetch_page(), but orders matches by trigram similarity to ``term``.
+
+    ``rank_columns`` name output columns of ``select_sql``; the rank is added
+    as a trailing ``search_rank`` column so positional row access is unchanged.
+    The unique ``tiebreak`` column (``id`` by default) breaks ties between
+    equal ranks.
+    """
+    where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+    rank_sql = "COALESCE(GREATEST(" + ", ".join(f"word_similarity(%s, matches.{column})" for column in rank_columns) + "), 0)"
+    ranked_sql = f"""
+        SELECT * FROM (
+            SELECT matches.*, {rank_sql} AS search_rank FROM ({select_sql} {where_sql}) matches
+        ) ranked
+    """
+    return fetch_page(cursor, ranked_sql, [], [term] * len(rank_columns) + list(params),
+                      ['search_rank', tiebreak], lambda row: [row['search_rank'], row[tiebreak]], **page_args)
@@ -0,0 +1,189 @@
+"""Concurrent checkouts against a real PostgreSQL: stock is never oversold.
+
+Set TEST_DATABASE_URL to a scratch database to run these; otherwise they
+are skipped. They remove the products and invoices they create and take
+those invoices back out of the daily rollups; the rest of the database is
+left as it was.
+
+    TEST_DATABASE_URL=postgresql://localhost/pos_test python -m pytest tests
+
+The throughput test fails when the 95th percentile checkout takes longer
+than CHECKOUT_P95_LIMIT seconds (default 5).
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+import uuid
+
+import psycopg2
+from psycopg2.extras import DictCursor
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+CHECKOUT_P95_LIMIT = float(os.environ.get('CHECKOUT_P95_LIMIT', 5))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import SHOP_TIMEZONE  # noqa: E402
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL is not set")
+class StockReservationTest(unittest.TestCase):
+    TILLS = 50
+    STOCK = 20
+
+    @classmethod
+    def setUpClass(cls):
+        # app.py opens its pool on DATABASE_URL at import.
+        os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+        from migrate_db import migrate
+        from partitions import ensure_partitions
+        import app
+        cls.app = app
+        conn = psycopg2.connect(TEST_DATABASE_URL)
+        try:
+            migrate(conn, verbose=False)
+            ensure_partitions(conn)
+        finally:
+            conn.close()
+
+    def setUp(self):
+        self.conn = psycopg2.connect(TEST_DATABASE_URL, cursor_factory=DictCursor)
+        self.customer = f"Stock Test {uuid.uuid4().hex[:8]}"
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT INTO products (name, category, price, stock)
+            SELECT %s || ' ' || n, 'Test', 100, %s FROM generate_series(1, 2) AS n
+            RETURNING id
+        """, (self.customer, self.STOCK))
+        self.product_ids = [row['id'] for row in cursor.fetchall()]
+        self.conn.commit()
+
+    def tearDown(self):
+        cursor = self.conn.cursor()
+        # Rollup jobs still queued for these checkouts are applied first, so
+        # that every one of them is in the totals taken back out below.
+        cursor.execute("SELECT to_regclass('job_queue') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                DELETE FROM job_queue
+                WHERE kind = 'checkout_rollups'
+                  AND EXISTS (SELECT 1 FROM jsonb_array_elements(payload->'lines') AS l WHERE (l->>0)::int = ANY(%s))
+                RETURNING payload
+            """, (self.product_ids,))
+            payloads = [row['payload'] for row in cursor.fetchall()]
+            if payloads:
+                self.app._apply_checkout_rollups(cursor, payloads)
+
+        cursor.execute("""
+            UPDATE daily_sales d SET
+                total_revenue = d.total_revenue - t.revenue,
+                invoice_count = d.invoice_count - t.invoices,
+                items_sold = d.items_sold - t.items
+            FROM (
+                SELECT (i.created_on AT TIME ZONE %s)::date AS sale_date, SUM(i.total_amount) AS revenue,
+                       COUNT(*) AS invoices, SUM(l.quantity) AS items
+                FROM invoices i
+                JOIN (SELECT invoice_id, SUM(quantity) AS quantity FROM invoice_items WHERE product_id = ANY(%s) GROUP BY invoice_id) l
+                  ON l.invoice_id = i.id
+                GROUP BY 1
+            ) t
+            WHERE d.sale_date = t.sale_date
+            RETURNING d.sale_date
+        """, (SHOP_TIMEZONE, self.product_ids))
+        days = [row['sale_date'] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM daily_sales WHERE sale_date = ANY(%s) AND invoice_count = 0", (days,))
+        cursor.execute("DELETE FROM daily_product_sales WHERE product_id = ANY(%s)", (self.product_ids,))
+
+        cursor.execute("SELECT DISTINCT invoice_id FROM invoice_items WHERE product_id = ANY(%s)", (self.product_ids,))
+        invoice_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM invoice_items WHERE invoice_id = ANY(%s)", (invoice_ids,))
+        cursor.execute("DELETE FROM invoices WHERE id = ANY(%s)", (invoice_ids,))
+        # The customer was made by these checkouts, so their totals go with them.
+        cursor.execute("DELETE FROM customers WHERE display_name = %s", (self.customer,))
+        cursor.execute("DELETE FROM products WHERE id = ANY(%s)", (self.product_ids,))
+        cursor.execute("DELETE FROM product_tombstones WHERE product_id = ANY(%s)", (self.product_ids,))
+        self.conn.commit()
+        self.conn.close()
+
+    def _race(self, work):
+        """Runs ``work(conn)`` on TILLS connections at once.
+
+        Returns the seconds each committed checkout took, and the seconds
+        from the start until the last till finished.
+        """
+        barrier = threading.Barrier(self.TILLS + 1)
+        latencies, errors = [], []
+
+        def till():
+            conn = psycopg2.connect(TEST_DATABASE_URL)
+            try:
+                barrier.wait()
+                started = time.perf_counter()
+                self.app.run_transaction(conn, lambda: work(conn), attempts=self.app.TRANSACTION_ATTEMPTS)
+                latencies.append(time.perf_counter() - started)
+            except self.app.InsufficientStock:
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=till) for _ in range(self.TILLS)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        self.assertEqual(errors, [])
+        return sorted(latencies), elapsed
+
+    def _stock(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, stock FROM products WHERE id = ANY(%s) ORDER BY id", (self.product_ids,))
+        self.conn.commit()
+        return [row['stock'] for row in cursor.fetchall()]
+
+    def test_reserve_stock_never_oversells(self):
+        product_id = self.product_ids[0]
+        latencies, _ = self._race(lambda conn: self.app._reserve_stock(conn.cursor(cursor_factory=DictCursor), {product_id: 3}))
+        self.assertEqual(len(latencies), self.STOCK // 3)
+        self.assertEqual(self._stock()[0], self.STOCK % 3)
+
+    def test_place_order_never_oversells(self):
+        # Every cart holds both products, so tills also contend on the lock order.
+        first, second = self.product_ids
+        latencies, _ = self._race(lambda conn: self.app._place_order(conn, {second: 2, first: 4}, self.customer, 'Cash', 'Admin'))
+        served = len(latencies)
+        self.assertEqual(served, self.STOCK // 4)
+        stock = self._stock()
+        self.assertEqual(stock, [self.STOCK - 4 * served, self.STOCK - 2 * served])
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT product_id, SUM(quantity) FROM invoice_items WHERE product_id = ANY(%s) GROUP BY product_id ORDER BY product_id",
+                       (self.product_ids,))
+        self.assertEqual([row[1] for row in cursor.fetchall()], [4 * served, 2 * served])
+        self.conn.commit()
+
+    def test_checkout_throughput(self):
+        # Enough stock for every till: all of them queue on the same two rows.
+        cursor = self.conn.cursor()
+        cursor.execute("UPDATE products SET stock = %s WHERE id = ANY(%s)", (self.TILLS, self.product_ids))
+        self.conn.commit()
+        first, second = self.product_ids
+        latencies, elapsed = self._race(lambda conn: self.app._place_order(conn, {first: 1, second: 1}, self.customer, 'Cash', 'Admin'))
+        self.assertEqual(len(latencies), self.TILLS)
+        self.assertEqual(self._stock(), [0, 0])
+
+        p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95) - 1]
+        report = (f"{self.TILLS} concurrent checkouts in {elapsed:.2f}s ({self.TILLS / elapsed:.0f}/s), "
+                  f"p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms")
+        print(report, file=sys.stderr)
+        self.assertLess(p95, CHECKOUT_P95_LIMIT, report)
+
+
+if __name__ == '__main__':
+    unittest.main()